@@ -1,34 +1,229 @@
 import cv2
 import imutils
+import queue
 import socket
-import pickle
-import struct
+import threading
 import time
+import argparse
+
+from camera_protocol import CODEC_JPEG, send_frame, send_hello, tune_socket
+from camera_stats import LinkStats
 
 # Adresse IP et port du serveur
 HOST = '127.0.0.1'  # Adresse IP locale (vous pouvez la changer si nécessaire)
 PORT = 8485
 
-# Création du socket
-client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-client_socket.connect((HOST, PORT))
+# Pipeline : capture -> encodage -> envoi, chacun dans son thread. Files bornées : quand l'étape
+# suivante prend du retard, l'image la plus ancienne est jetée (la plus récente gagne), jamais empilée.
+QUEUE_DEPTH = 2
+DEFAULT_FPS = 30
+DEFAULT_QUALITY = 80        # qualité JPEG de départ (cv2 : 0-100)
+MIN_QUALITY = 30
+MAX_QUALITY = 90
+QUALITY_DOWN = 0.85         # baisse multiplicative dès qu'il y a contre-pression
+QUALITY_UP_AFTER = 15       # images envoyées sans contre-pression avant de remonter d'un cran
+SEND_BUDGET = 0.5           # part de la période d'une image qu'un envoi peut bloquer sans être "lent"
+
+
+class Pacer:
+    """Cadence absolue de fps images/s : pas de dérive, pas de rafale de rattrapage après un retard."""
+
+    def __init__(self, fps):
+        self.period = 1.0 / fps if fps > 0 else 0
+        self.next = time.monotonic()
+
+    def _advance(self, now):
+        if now - self.next > self.period:
+            self.next = now   # retard de plus d'une période : on repart de maintenant
+        self.next += self.period
+
+    def wait(self):
+        """Source fichier : dort jusqu'à l'échéance de l'image suivante."""
+        if not self.period:
+            return
+        now = time.monotonic()
+        if self.next > now:
+            time.sleep(self.next - now)
+            now = self.next
+        self._advance(now)
+
+    def due(self):
+        """Caméra : l'image qui vient d'être lue est-elle à envoyer ? (sinon elle est ignorée ;
+        dormir laisserait vieillir les images dans le tampon du pilote)"""
+        if not self.period:
+            return True
+        now = time.monotonic()
+        if now < self.next:
+            return False
+        self._advance(now)
+        return True
+
+
+class AdaptiveQuality:
+    """Qualité JPEG pilotée par la contre-pression du socket (envoi bloquant, file d'envoi pleine)."""
+
+    def __init__(self, quality, min_quality, max_quality, budget):
+        self.value = quality
+        self.min = min_quality
+        self.max = max_quality
+        self.budget = budget
+        self.calm = 0
+
+    def update(self, send_seconds, backlog):
+        if send_seconds > self.budget or backlog:
+            self.value = max(self.min, int(self.value * QUALITY_DOWN))
+            self.calm = 0
+        else:
+            self.calm += 1
+            if self.calm >= QUALITY_UP_AFTER:
+                self.value = min(self.max, self.value + 1)
+                self.calm = 0
+
+
+def put_latest(q, item):
+    """Dépose item sans bloquer ; file pleine : l'élément le plus ancien est jeté. True si jeté."""
+    dropped = False
+    while True:
+        try:
+            q.put_nowait(item)
+            return dropped
+        except queue.Full:
+            try:
+                q.get_nowait()
+                dropped = True
+            except queue.Empty:
+                pass
+
+
+def open_source(source):
+    """'0', '1'... : caméra ; sinon fichier vidéo (exécution sans caméra, CI)."""
+    live = source.isdigit()
+    vid = cv2.VideoCapture(int(source) if live else source)
+    if not vid.isOpened():
+        raise SystemExit(f'Source vidéo illisible : {source}')
+    return vid, live
+
+
+def capture_stage(args, vid, live, frames, stop, stats):
+    pacer = Pacer(args.fps)
+    deadline = time.monotonic() + args.seconds if args.seconds else None
+    seq = 0
+    try:
+        while not stop.is_set() and (deadline is None or time.monotonic() < deadline):
+            if not live:
+                pacer.wait()
+            t0 = time.perf_counter()
+            ret, frame = vid.read()
+            if not ret:
+                if live or not args.loop:
+                    break
+                vid.release()
+                vid, live = open_source(args.source)
+                continue
+            if live and not pacer.due():
+                continue
+            stats.stage('capture', time.perf_counter() - t0)
+            stats.count('captured')
+            if put_latest(frames, (seq, time.time_ns(), frame)):
+                stats.count('dropped_encode')
+            seq += 1
+    finally:
+        vid.release()
+        put_latest(frames, None)
+
+
+def encode_stage(args, frames, packets, stop, quality, stats):
+    while not stop.is_set():
+        item = frames.get()
+        if item is None:
+            break
+        seq, captured_ns, frame = item
+        t0 = time.perf_counter()
+        frame = imutils.resize(frame, width=args.width)
+        frame = cv2.flip(frame, 1)
+        ok, jpeg = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, quality.value])
+        if not ok:
+            continue
+        stats.stage('encode', time.perf_counter() - t0)
+        if put_latest(packets, (seq, captured_ns, jpeg)):
+            stats.count('dropped_send')
+    put_latest(packets, None)
+
+
+def send_stage(sock, packets, stop, quality, stats):
+    while True:
+        item = packets.get()
+        if item is None:
+            break
+        seq, captured_ns, jpeg = item
+        started = time.monotonic()
+        try:
+            # JPEG brut + en-tête binaire (camera_protocol.py), sans pickle ni copie
+            sent = send_frame(sock, jpeg, seq, captured_ns, CODEC_JPEG)
+        except OSError as e:
+            print(f'Connexion perdue : {e}')
+            stop.set()
+            break
+        duration = time.monotonic() - started
+        stats.stage('send', duration)
+        stats.count('frames')
+        stats.count('bytes', sent)
+        # côté client : de la capture à la remise au noyau
+        stats.latency((time.time_ns() - captured_ns) / 1e6)
+        quality.update(duration, packets.full())
+        stats.gauge('quality', quality.value)
+        stats.tick()
+
 
-# Capture vidéo
-vid = cv2.VideoCapture(0)
+def main():
+    ap = argparse.ArgumentParser(description='Client caméra : capture, encodage et envoi en pipeline.')
+    ap.add_argument('--host', default=HOST)
+    ap.add_argument('--port', type=int, default=PORT)
+    ap.add_argument('--source', default='0', help='Numéro de caméra ou fichier vidéo (exécution sans caméra)')
+    ap.add_argument('--loop', action='store_true', help='Fichier vidéo : reprendre au début à la fin')
+    ap.add_argument('--fps', type=float, default=DEFAULT_FPS, help='Cadence visée (0 = au plus vite)')
+    ap.add_argument('--seconds', type=float, default=0, help='Durée maximale (0 = sans fin)')
+    ap.add_argument('--width', type=int, default=360)
+    ap.add_argument('--quality', type=int, default=DEFAULT_QUALITY, help='Qualité JPEG de départ')
+    ap.add_argument('--min-quality', type=int, default=MIN_QUALITY)
+    ap.add_argument('--max-quality', type=int, default=MAX_QUALITY)
+    ap.add_argument('--name', help='Nom annoncé au relais (camera_relay.py)')
+    ap.add_argument('--stats-interval', type=float, default=5, help='Bilan toutes les N secondes (0 = à la fin seulement)')
+    ap.add_argument('--stats-log', help='Ajoute les bilans à ce fichier JSON-lines')
+    args = ap.parse_args()
 
-while(vid.isOpened()):
-    ret, frame = vid.read()
-    if not ret:
-        break
+    # source ouverte avant la connexion : une source illisible arrête le client tout de suite
+    vid, live = open_source(args.source)
 
-    frame = imutils.resize(frame, width=360)
-    frame = cv2.flip(frame, 1)
-    data = pickle.dumps(cv2.imencode('.jpg', frame)[1].tobytes(), 0)
-    size = len(data)
+    # Création du socket
+    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    client_socket.connect((args.host, args.port))
+    tune_socket(client_socket)
+    if args.name:
+        send_hello(client_socket, args.name)
 
-    client_socket.sendall(struct.pack(">L", size) + data)
+    budget = SEND_BUDGET / args.fps if args.fps > 0 else SEND_BUDGET / DEFAULT_FPS
+    quality = AdaptiveQuality(args.quality, args.min_quality, args.max_quality, budget)
+    frames = queue.Queue(QUEUE_DEPTH)
+    packets = queue.Queue(QUEUE_DEPTH)
+    stop = threading.Event()
+    stats = LinkStats('client', args.stats_interval, args.stats_log)
+    threads = [
+        threading.Thread(target=capture_stage, args=(args, vid, live, frames, stop, stats), name='capture', daemon=True),
+        threading.Thread(target=encode_stage, args=(args, frames, packets, stop, quality, stats), name='encode', daemon=True),
+        threading.Thread(target=send_stage, args=(client_socket, packets, stop, quality, stats), name='send', daemon=True),
+    ]
+    for t in threads:
+        t.start()
+    try:
+        for t in threads:
+            while t.is_alive():
+                t.join(0.5)
+    except KeyboardInterrupt:
+        stop.set()
+    client_socket.close()
+    stats.close()
 
-    time.sleep(0.01)
 
-vid.release()
-client_socket.close()
+if __name__ == '__main__':
+    main()
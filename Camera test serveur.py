@@ -1,41 +1,148 @@
 import cv2
-import imutils
+import numpy as np
+import os
 import socket
-import pickle
-import struct
+import subprocess
+import sys
+import time
+import argparse
+
+from camera_protocol import CODEC_HELLO, FrameReader, tune_socket
+from camera_stats import LinkStats
 
 # Adresse IP et port du serveur
 HOST = '127.0.0.1'  # Adresse IP locale (vous pouvez la changer si nécessaire)
 PORT = 8485
 
-# Création du socket
-server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-server_socket.bind((HOST, PORT))
-server_socket.listen(10)
-conn, addr = server_socket.accept()
+BENCH_CONNECT_TIMEOUT = 30   # secondes laissées au client pour ouvrir sa source et se connecter
+CLIENT_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'Camera test client.py')
+
+
+def receive(conn, stats, headless=False):
+    """Reçoit, décode et affiche les images d'un client jusqu'à la fin du flux (ou 'q')."""
+    tune_socket(conn)
+    # tampon de réception préalloué (recv_into), agrandi à la plus grande image reçue
+    reader = FrameReader(conn)
+    last_seq = None
+
+    while True:
+        # en-tête binaire (n° d'image, horodatage de capture, codec, taille) + image encodée brute
+        t0 = time.perf_counter()
+        msg = reader.read_frame()
+        if msg is None:
+            break
+        header, payload = msg
+        if header.codec == CODEC_HELLO:
+            continue
+        t1 = time.perf_counter()
+        # attente comprise : proche de la période d'envoi tant que le réseau suit
+        stats.stage('recv', t1 - t0)
+        stats.count('frames')
+        stats.count('bytes', len(payload))
+        if last_seq is not None:
+            # numéros attribués à la capture : un trou = images jetées en route (client ou relais)
+            gap = (header.seq - last_seq - 1) & 0xFFFFFFFF
+            if 0 < gap < 2 ** 31:
+                stats.count('dropped', gap)
+        last_seq = header.seq
+
+        # décodage directement depuis le tampon de réception (memoryview, aucune copie)
+        frame = cv2.imdecode(np.frombuffer(payload, dtype=np.uint8), cv2.IMREAD_COLOR)
+        t2 = time.perf_counter()
+        stats.stage('decode', t2 - t1)
+        if frame is None:
+            stats.count('undecodable')
+            continue
+
+        if not headless:
+            cv2.imshow('Camera distante', frame)
+            key = cv2.waitKey(1) & 0xFF
+            stats.stage('display', time.perf_counter() - t2)
+            if key == ord('q'):
+                break
+        # de la capture chez le client jusqu'à l'image décodée / affichée ici
+        stats.latency((time.time_ns() - header.timestamp_ns) / 1e6)
+        stats.tick()
+
+    conn.close()
+
 
-data = b""
-payload_size = struct.calcsize(">L")
+def bench(args):
+    """Banc d'essai sans écran : ce serveur et le client (source vidéo) sur la boucle locale."""
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.bind(('127.0.0.1', 0))
+    server_socket.listen(1)
+    port = server_socket.getsockname()[1]
+    cmd = [sys.executable, CLIENT_SCRIPT, '--host', '127.0.0.1', '--port', str(port), '--source', args.source,
+           '--loop', '--seconds', str(args.seconds), '--fps', str(args.fps),
+           '--stats-interval', str(args.stats_interval)]
+    if args.stats_log:
+        cmd += ['--stats-log', args.stats_log]
+    client = subprocess.Popen(cmd)
+    stats = LinkStats('serveur', args.stats_interval, args.stats_log)
+    try:
+        # le client peut échouer avant de se connecter (source illisible, cv2 absent...) : on le
+        # surveille pendant l'attente plutôt que d'attendre le délai complet
+        server_socket.settimeout(0.5)
+        deadline = time.monotonic() + BENCH_CONNECT_TIMEOUT
+        while True:
+            try:
+                conn, addr = server_socket.accept()
+                break
+            except socket.timeout:
+                code = client.poll()
+                if code is None and time.monotonic() < deadline:
+                    continue
+                if code is None:
+                    client.kill()
+                    code = client.wait()
+                raise SystemExit(f'Banc d\'essai : le client ne s\'est pas connecté (code de retour {code})')
+        receive(conn, stats, headless=True)
+        client.wait()
+    finally:
+        server_socket.close()
+        # réception interrompue (exception, Ctrl-C) : le client ne doit pas continuer seul
+        if client.poll() is None:
+            client.kill()
+            client.wait()
+    return stats.close()
 
-while True:
-    while len(data) < payload_size:
-        data += conn.recv(4096)
 
-    packed_msg_size = data[:payload_size]
-    data = data[payload_size:]
-    msg_size = struct.unpack(">L", packed_msg_size)[0]
+def main():
+    ap = argparse.ArgumentParser(description='Serveur caméra : reçoit, décode et affiche un flux camera_protocol.')
+    ap.add_argument('--host', default=HOST)
+    ap.add_argument('--port', type=int, default=PORT)
+    ap.add_argument('--headless', action='store_true', help='Décode sans afficher')
+    ap.add_argument('--stats-interval', type=float, default=5, help='Bilan toutes les N secondes (0 = à la fin seulement)')
+    ap.add_argument('--stats-log', help='Ajoute les bilans à ce fichier JSON-lines')
+    ap.add_argument('--bench', action='store_true',
+                    help='Banc d\'essai : lance le client sur la boucle locale avec --source, sans affichage')
+    ap.add_argument('--source', help='--bench : fichier vidéo lu en boucle par le client')
+    ap.add_argument('--seconds', type=float, default=10, help='--bench : durée')
+    ap.add_argument('--fps', type=float, default=30, help='--bench : cadence visée du client')
+    args = ap.parse_args()
 
-    while len(data) < msg_size:
-        data += conn.recv(4096)
-    frame_data = data[:msg_size]
-    data = data[msg_size:]
+    if args.bench:
+        if not args.source:
+            ap.error('--bench demande --source (fichier vidéo)')
+        bench(args)
+        return
 
-    frame = pickle.loads(frame_data, fix_imports=True, encoding="bytes")
-    frame = cv2.imdecode(frame, cv2.IMREAD_COLOR)
+    # Création du socket
+    server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    server_socket.bind((args.host, args.port))
+    server_socket.listen(10)
+    conn, addr = server_socket.accept()
+    stats = LinkStats('serveur', args.stats_interval, args.stats_log)
+    try:
+        receive(conn, stats, args.headless)
+    except KeyboardInterrupt:
+        pass
+    stats.close()
+    server_socket.close()
+    if not args.headless:
+        cv2.destroyAllWindows()
 
-    cv2.imshow('Camera distante', frame)
-    if cv2.waitKey(1) & 0xFF == ord('q'):
-        break
 
-conn.close()
-cv2.destroyAllWindows()
+if __name__ == '__main__':
+    main()
@@ -12,13 +12,26 @@ Usage:
 
   # Importer
   python3 sms_sqlite_flask_exporter.py --import --xml /chemin/backup.xml --out ./export --split-by-year
+  #   (--split-by-year : une base par année dans ./export/years/, écrites en parallèle par --shard-writers
+  #    processus ; messages.db devient le catalogue, le serveur interroge les bases utiles et fusionne)
+  #   (--batch-size N : nombre de messages écrits par transaction, défaut 5000)
+  #   (--defer-fts : index plein texte construit en une passe à la fin ; --fts-tokenize / --fts-prefix)
+  #   (--incremental : sauvegarde du jour, seuls les nouveaux messages sont traités ; --resume après un crash)
+  #   (--store-html : texte rendu en HTML une fois pour toutes à l'import, servi tel quel ensuite)
+  #   (miniatures des images dans media/thumbs/ si Pillow est installé ; --thumb-size 0 pour s'en passer)
 
   # Lancer le serveur web (après import)
   python3 sms_sqlite_flask_exporter.py --serve --db ./export/messages.db --media ./export/media
+  #   (--server async --workers 4 --threads 8 : serveur asyncio multi-processus, voir serveur_async.py)
 
 Notes:
-- Conçu pour fonctionner en streaming (xml.etree.ElementTree.iterparse)
+- Conçu pour fonctionner en streaming : le XML est découpé en paquets d'enregistrements
+  (sms_commun.py), décodés par un pool de processus (--workers N) puis écrits dans
+  l'ordre du fichier par un seul écrivain SQLite
 - Crée une table 'messages' et 'media' et une FTS5 'messages_fts' si SQLite le supporte
+- Tient à jour par lot des agrégats par correspondant ('contacts', 'contact_years') pour la page d'accueil
+- Archive découpée par année : ids propres à chaque année (année << 32), recherche et conversations
+  réparties sur les seules bases dont les dates recoupent la requête
 - Le serveur Flask est volontairement minimaliste et utilise des templates embarqués
 """
 
@@ -26,13 +39,28 @@ import os
 import sys
 import re
 import time
-import base64
 import argparse
+import shutil
+import queue
+import multiprocessing
 import sqlite3
+import json
 import html
-import xml.etree.ElementTree as ET
+import gzip
+import zlib
+import hashlib
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+from functools import partial
+from pathlib import Path
 from datetime import datetime
 
+from sms_commun import (DEFAULT_CHUNK_BYTES, DEFAULT_SPOOL_BYTES, DEFAULT_THUMB_PX, RENDER_VERSION, MediaStore,
+                        SpooledBlob, ThumbnailPool, run_pipeline, parse_chunk, message_fields, discard_spooled,
+                        render_text, thumbnails_supported, media_validators, etag_matches)
+
 # Flask import deferred (import only when --serve)
 
 # -------------------- Utils --------------------
@@ -75,17 +103,477 @@ def guess_ext(ct: str, suggested: str = None):
 
 # -------------------- Importer --------------------
 
-def import_xml_to_sqlite(xml_path, out_dir, split_by_year=False, limit=0):
-    """Lit le XML en streaming et alimente SQLite + sauvegarde médias dans out_dir/media"""
-    ensure_dir(out_dir)
-    media_dir = os.path.join(out_dir, 'media')
-    ensure_dir(media_dir)
-    db_path = os.path.join(out_dir, 'messages.db')
+DEFAULT_BATCH_SIZE = 5000
+DEFAULT_SHARD_WRITERS = 4   # processus écrivains de --split-by-year
+
+
+class BatchWriter:
+    """Tampons bornés pour messages / FTS / médias, vidés par executemany dans une transaction explicite.
+
+    Les ids sont attribués côté Python (à partir de MAX(id)) pour pouvoir relier
+    les lignes FTS et médias sans dépendre de cur.lastrowid ligne par ligne.
+    Les messages déjà présents (clé naturelle) sont ignorés par INSERT OR IGNORE ;
+    leurs lignes FTS et médias sont filtrées par l'existence de l'id dans messages.
+    Avec id_base (base annuelle), les ids partent de id_base + 1 : uniques dans toute l'archive découpée.
+    Chaque flush enregistre un point de reprise (offset XML, lignes lues) dans la même transaction,
+    et ajoute aux agrégats contacts / contact_years les messages réellement insérés (plage d'ids du lot).
+    """
+
+    def __init__(self, conn, media_dir, has_fts, batch_size=DEFAULT_BATCH_SIZE, xml_signature=None, id_base=0):
+        self.conn = conn
+        self.store = MediaStore(media_dir)
+        self.has_fts = has_fts
+        self.batch_size = max(1, int(batch_size))
+        self.xml_signature = xml_signature
+        cur = conn.cursor()
+        # id_base : plage d'ids propre à une base annuelle (voir shard_id_base)
+        self.next_id = max(cur.execute('SELECT COALESCE(MAX(id), 0) FROM messages').fetchone()[0], id_base) + 1
+        self.next_media_id = (cur.execute('SELECT COALESCE(MAX(id), 0) FROM media').fetchone()[0]) + 1
+        self.messages = []
+        self.fts = []
+        self.media = []
+        self.blobs = []
+        self.batch_blobs = {}  # sha256 -> filename des blobs vus dans le lot en cours
+        self.flushes = 0
+        self.inserted = 0
+        self.duplicates = 0
+        # point de reprise : début du paquet XML en cours, et nb d'enregistrements lus avant lui
+        self.resume_offset = 0
+        self.resume_rows = 0
+
+    # même expression que l'index unique idx_messages_natural (NATURAL_KEY) : recherche par l'index,
+    # message sans date (date_ms NULL) compris
+    KNOWN_SQL = ('SELECT 1 FROM messages WHERE address=? AND IFNULL(date_ms, -1) = IFNULL(?, -1) '
+                 'AND typ=? AND direction=? AND body_hash=?')
+
+    def is_known(self, address, date_ms, typ, direction, body_hash):
+        if isinstance(date_ms, str):
+            # date XML brute : à l'insertion, l'affinité INTEGER de la colonne la convertit, mais pas
+            # une comparaison sur l'expression de l'index (entier stocké != texte)
+            try:
+                date_ms = int(date_ms)
+            except ValueError:
+                pass
+        return self.conn.execute(self.KNOWN_SQL, (address, date_ms, typ, direction, body_hash)).fetchone() is not None
+
+    def add(self, typ, address, contact_name, date_ms, date_iso, direction, body, body_hash, media_items, body_html=None):
+        if media_items and self.is_known(address, date_ms, typ, direction, body_hash):
+            # doublon avec pièces jointes : ne pas réécrire les fichiers médias
+            for m in media_items:
+                if isinstance(m[2], SpooledBlob):
+                    m[2].discard()
+            self.duplicates += 1
+            return None
+        mid = self.next_id
+        self.next_id += 1
+        self.messages.append((mid, typ, address, contact_name, date_ms, date_iso, direction, body, body_hash, body_html))
+        if self.has_fts:
+            self.fts.append((mid,))
+        for ctype, oname, blob, digest in media_items:
+            media_id = self.next_media_id
+            self.next_media_id += 1
+            self.media.append((media_id, mid, self.blob_filename(blob, digest, guess_ext(ctype, oname)), ctype, oname, digest, mid))
+        if len(self.messages) >= self.batch_size:
+            self.flush()
+        return mid
+
+    def blob_filename(self, blob, digest, ext):
+        """Chemin du blob dans le stockage ; écrit le fichier seulement si ce contenu est nouveau."""
+        fname = self.batch_blobs.get(digest)
+        if fname is None:
+            row = self.conn.execute('SELECT filename FROM blobs WHERE sha256=?', (digest,)).fetchone()
+            fname = row[0] if row else None
+        if fname is not None:
+            self.store.reused += 1
+            if isinstance(blob, SpooledBlob):
+                blob.discard()
+        else:
+            fname = self.store.put(blob, ext, digest)[1]
+            self.blobs.append((digest, fname, len(blob)))
+        self.batch_blobs[digest] = fname
+        return fname
+
+    def flush(self, done=False):
+        cur = self.conn.cursor()
+        cur.execute('BEGIN')
+        try:
+            if self.messages:
+                cur.executemany('INSERT OR IGNORE INTO messages (id, typ, address, contact_name, date_ms, date_iso, direction, body, body_hash, body_html) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)', self.messages)
+                n = max(cur.rowcount, 0)
+                self.inserted += n
+                self.duplicates += len(self.messages) - n
+            if self.fts:
+                cur.executemany('INSERT INTO messages_fts(rowid, body, address, contact_name) SELECT id, body, address, contact_name FROM messages WHERE id=?', self.fts)
+            if self.blobs:
+                cur.executemany('INSERT OR IGNORE INTO blobs (sha256, filename, size) VALUES (?, ?, ?)', self.blobs)
+            if self.media:
+                # le trigger media_blob_ref incrémente blobs.refcount pour chaque ligne réellement insérée
+                cur.executemany('INSERT INTO media (id, message_id, filename, content_type, orig_name, sha256) SELECT ?, ?, ?, ?, ?, ? WHERE EXISTS (SELECT 1 FROM messages WHERE id=?)', self.media)
+            if self.messages:
+                update_contacts(cur, self.messages[0][0], self.messages[-1][0])
+                if n:
+                    bump_generation(cur)
+            if self.xml_signature:
+                set_meta(cur, 'checkpoint_xml', self.xml_signature)
+                set_meta(cur, 'checkpoint_offset', self.resume_offset)
+                set_meta(cur, 'checkpoint_rows', self.resume_rows)
+                set_meta(cur, 'checkpoint_done', '1' if done else '0')
+            cur.execute('COMMIT')
+        except Exception:
+            cur.execute('ROLLBACK')
+            raise
+        if self.messages:
+            self.flushes += 1
+        self.messages.clear()
+        self.fts.clear()
+        self.media.clear()
+        self.blobs.clear()
+        self.batch_blobs.clear()
+
+
+def ensure_contacts(cur):
+    """Tables d'agrégats par correspondant (page d'accueil du serveur sans parcourir messages).
+    Renvoie True si elles viennent d'être créées sur une base qui a déjà des messages (à recalculer)."""
+    exists = cur.execute("SELECT 1 FROM sqlite_master WHERE name='contacts'").fetchone() is not None
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS contacts (
+        address TEXT PRIMARY KEY,
+        contact_name TEXT,
+        messages INTEGER NOT NULL DEFAULT 0,
+        sent INTEGER NOT NULL DEFAULT 0,
+        first_date_ms INTEGER,
+        last_date_ms INTEGER,
+        media INTEGER NOT NULL DEFAULT 0,
+        media_bytes INTEGER NOT NULL DEFAULT 0
+    )
+    ''')
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS contact_years (
+        address TEXT,
+        year TEXT,
+        messages INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (address, year)
+    ) WITHOUT ROWID
+    ''')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_contacts_messages ON contacts(messages)')
+    if exists or cur.execute("SELECT 1 FROM sqlite_master WHERE name='messages'").fetchone() is None:
+        # déjà là, ou catalogue d'une archive découpée (agrégats fusionnés depuis les bases annuelles)
+        return False
+    return cur.execute('SELECT 1 FROM messages LIMIT 1').fetchone() is not None
+
+
+# fusion d'une ligne d'agrégats dans contacts (lot d'import, ou base annuelle dans le catalogue)
+CONTACTS_MERGE = '''
+    ON CONFLICT(address) DO UPDATE SET
+        contact_name = COALESCE(excluded.contact_name, contact_name),
+        messages = messages + excluded.messages,
+        sent = sent + excluded.sent,
+        first_date_ms = MIN(COALESCE(first_date_ms, excluded.first_date_ms), COALESCE(excluded.first_date_ms, first_date_ms)),
+        last_date_ms = MAX(COALESCE(last_date_ms, excluded.last_date_ms), COALESCE(excluded.last_date_ms, last_date_ms)),
+        media = media + excluded.media,
+        media_bytes = media_bytes + excluded.media_bytes
+'''
+
+
+def update_contacts(cur, first_id, last_id):
+    """Ajoute aux agrégats les messages d'ids first_id..last_id (ids attribués par lot, doublons absents)."""
+    cur.execute('''
+    INSERT INTO contacts (address, contact_name, messages, sent, first_date_ms, last_date_ms, media, media_bytes)
+    SELECT m.address, MAX(NULLIF(m.contact_name, '')), COUNT(*), SUM(m.direction = 'out'), MIN(m.date_ms), MAX(m.date_ms),
+           COALESCE(SUM(x.n), 0), COALESCE(SUM(x.bytes), 0)
+    FROM messages m
+    LEFT JOIN (SELECT d.message_id, COUNT(*) AS n, SUM(b.size) AS bytes FROM media d LEFT JOIN blobs b ON b.sha256 = d.sha256
+               WHERE d.message_id BETWEEN :lo AND :hi GROUP BY d.message_id) x ON x.message_id = m.id
+    WHERE m.id BETWEEN :lo AND :hi
+    GROUP BY m.address
+    ''' + CONTACTS_MERGE, {'lo': first_id, 'hi': last_id})
+    cur.execute('''
+    INSERT INTO contact_years (address, year, messages)
+    SELECT address, substr(date_iso, 1, 4), COUNT(*) FROM messages
+    WHERE id BETWEEN ? AND ? AND date_iso IS NOT NULL
+    GROUP BY 1, 2
+    ON CONFLICT(address, year) DO UPDATE SET messages = messages + excluded.messages
+    ''', (first_id, last_id))
+
+
+def rebuild_contacts(cur):
+    """Recalcule entièrement les agrégats (base antérieure, ou doublons supprimés)."""
+    cur.execute('BEGIN')
+    cur.execute('DELETE FROM contacts')
+    cur.execute('DELETE FROM contact_years')
+    max_id = cur.execute('SELECT COALESCE(MAX(id), 0) FROM messages').fetchone()[0]
+    update_contacts(cur, 0, max_id)
+    cur.execute('COMMIT')
+
+
+def get_meta(cur, key, default=None):
+    row = cur.execute('SELECT value FROM meta WHERE key=?', (key,)).fetchone()
+    return row[0] if row else default
+
+
+def set_meta(cur, key, value):
+    cur.execute('INSERT INTO meta (key, value) VALUES (?, ?) ON CONFLICT(key) DO UPDATE SET value=excluded.value', (key, str(value)))
+
+
+def bump_generation(cur):
+    """Compteur de version des données, lu par le serveur pour invalider son cache de recherche."""
+    cur.execute("INSERT INTO meta (key, value) VALUES ('generation', '1') "
+                "ON CONFLICT(key) DO UPDATE SET value = CAST(value AS INTEGER) + 1")
+
+
+def fts_options(tokenize=None, prefix=None):
+    """Options fts5 (tokenizer, index de préfixes) sous forme SQL, ex: ", tokenize='porter unicode61', prefix='2 3'"."""
+    opts = ''
+    if tokenize:
+        opts += ", tokenize='" + tokenize.replace("'", "''") + "'"
+    if prefix:
+        opts += ", prefix='" + ' '.join(str(int(p)) for p in str(prefix).replace(',', ' ').split()) + "'"
+    return opts
+
+
+def setup_fts(cur, tokenize=None, prefix=None):
+    """Crée messages_fts (external content sur messages). Si la config tokenizer/prefix a changé,
+    la table est recréée et un rebuild est nécessaire. Renvoie (has_fts, rebuild_needed)."""
+    opts = fts_options(tokenize, prefix)
+    exists = cur.execute("SELECT 1 FROM sqlite_master WHERE name='messages_fts'").fetchone() is not None
+    rebuild = False
+    if exists and (tokenize or prefix) and get_meta(cur, 'fts_options', '') != opts:
+        cur.execute('DROP TABLE messages_fts')
+        exists = False
+        rebuild = True
+    try:
+        cur.execute("CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(body, address, contact_name, content='messages', content_rowid='id'" + opts + ")")
+    except sqlite3.OperationalError:
+        print('FTS5 non disponible, recherche texte utilisera LIKE (plus lent).')
+        return False, False
+    if not exists:
+        set_meta(cur, 'fts_options', opts)
+        rebuild = rebuild or cur.execute('SELECT 1 FROM messages LIMIT 1').fetchone() is not None
+    return True, rebuild
+
+
+def ensure_body_html(conn, cur, store_html=False, batch=50000):
+    """Colonne body_html : HTML du texte rendu par sms_commun.render_text, version notée dans meta.
+
+    Activée par store_html (puis gardée pour les imports suivants). Si le moteur de rendu a changé
+    (RENDER_VERSION), les lignes existantes sont recalculées par lots. Renvoie True si le rendu est actif.
+    """
+    if 'body_html' not in [r[1] for r in cur.execute('PRAGMA table_info(messages)')]:
+        cur.execute('ALTER TABLE messages ADD COLUMN body_html TEXT')
+    version = get_meta(cur, 'render_version')
+    if not store_html and version is None:
+        return False
+    if version != str(RENDER_VERSION):
+        conn.create_function('render_text', 1, render_text, deterministic=True)
+        min_id, max_id = cur.execute('SELECT COALESCE(MIN(id), 1), COALESCE(MAX(id), 0) FROM messages').fetchone()
+        if max_id:
+            print(f'Rendu HTML (version {RENDER_VERSION}) des messages existants...')
+        # ids d'une base annuelle : à partir de shard_id_base(année), pas de 1
+        for lo in range(min_id, max_id + 1, batch):
+            cur.execute('BEGIN')
+            cur.execute('UPDATE messages SET body_html = render_text(body) WHERE id BETWEEN ? AND ?', (lo, lo + batch - 1))
+            cur.execute('COMMIT')
+        # la version n'est notée qu'une fois toutes les lignes à jour (sinon tout est refait au prochain import)
+        set_meta(cur, 'render_version', RENDER_VERSION)
+    return True
+
+
+def rebuild_fts(cur):
+    """Reconstruit l'index FTS en une passe depuis la table messages, puis le compacte."""
+    t0 = time.perf_counter()
+    cur.execute('BEGIN')
+    cur.execute("INSERT INTO messages_fts(messages_fts) VALUES('rebuild')")
+    cur.execute("INSERT INTO messages_fts(messages_fts) VALUES('optimize')")
+    set_meta(cur, 'fts_dirty', '0')
+    cur.execute('COMMIT')
+    print(f'Index FTS reconstruit en {time.perf_counter() - t0:.1f}s')
+
+
+def body_hash(body):
+    """Empreinte du texte pour la clé naturelle (address, date_ms, typ, direction, body_hash)."""
+    return hashlib.sha1((body or '').encode('utf-8')).hexdigest()[:16]
+
+
+def import_worker(chunk, min_date_ms=None, render=False):
+    """Worker du pipeline : parse un paquet XML, décode les parts base64, formate les dates.
+    Renvoie des tuples prêts pour BatchWriter.add(). Avec min_date_ms (import incrémental),
+    les messages plus anciens sont écartés avant tout décodage. Avec render, le HTML du texte
+    est calculé ici (dans les workers) pour la colonne body_html."""
+    out = []
+    for elem in parse_chunk(chunk):
+        if min_date_ms is not None:
+            try:
+                if int(elem.attrib.get('date') or 0) < min_date_ms:
+                    discard_spooled(elem)
+                    out.append(None)
+                    continue
+            except ValueError:
+                pass
+        f = message_fields(elem)
+        body_chunks = [f['body']] if f['body'] else []
+        media_items = []
+        for part in f['parts']:
+            if part[0] == 'text':
+                body_chunks.append(part[1])
+            elif part[0] == 'media':
+                # content-type, nom d'origine, octets bruts, sha256
+                media_items.append(part[1:])
+            else:
+                # not inlined media
+                body_chunks.append(f"[pièce jointe: {part[1]}]")
+        ts = ms_to_ts(f['date_ms'])
+        body = '\n'.join(body_chunks)
+        out.append((f['typ'], f['address'], f['name'], f['date_ms'], ts.isoformat() if ts else None,
+                    f['direction'], body, body_hash(body), media_items, render_text(body) if render else None))
+    return out
+
+
+def ensure_blob_store(cur):
+    """Table blobs (un fichier par contenu distinct) + compteurs de références tenus par triggers sur media."""
+    if 'sha256' not in [r[1] for r in cur.execute('PRAGMA table_info(media)')]:
+        # base créée avant le stockage par contenu : anciens fichiers media_%09d gardés tels quels
+        cur.execute('ALTER TABLE media ADD COLUMN sha256 TEXT')
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS blobs (
+        sha256 TEXT PRIMARY KEY,
+        filename TEXT NOT NULL,
+        size INTEGER,
+        refcount INTEGER NOT NULL DEFAULT 0
+    )
+    ''')
+    cur.execute('''CREATE TRIGGER IF NOT EXISTS media_blob_ref AFTER INSERT ON media WHEN NEW.sha256 IS NOT NULL
+                   BEGIN UPDATE blobs SET refcount = refcount + 1 WHERE sha256 = NEW.sha256; END''')
+    cur.execute('''CREATE TRIGGER IF NOT EXISTS media_blob_unref AFTER DELETE ON media WHEN OLD.sha256 IS NOT NULL
+                   BEGIN UPDATE blobs SET refcount = refcount - 1 WHERE sha256 = OLD.sha256; END''')
+
+
+def ensure_thumb_column(cur):
+    """Colonne media.thumb (chemin de la miniature) + index sha256 pour la renseigner par contenu."""
+    if 'thumb' not in [r[1] for r in cur.execute('PRAGMA table_info(media)')]:
+        cur.execute('ALTER TABLE media ADD COLUMN thumb TEXT')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_media_sha256 ON media(sha256)')
+
+
+def gc_media(db_path, media_dir):
+    """Supprime les blobs sans référence (refcount <= 0) et les fichiers que la base ne connaît pas
+    (écritures interrompues, médias de doublons supprimés). Archive découpée : toutes les bases
+    annuelles sont consultées, un contenu pouvant être partagé entre années."""
+    shards = read_shards(db_path)
+    store = MediaStore(media_dir)
+    dead, known = set(), set()
+    for path in ([s['path'] for s in shards] if shards is not None else [db_path]):
+        conn = sqlite3.connect(path, isolation_level=None)
+        cur = conn.cursor()
+        cur.execute('BEGIN')
+        dead.update(r[0] for r in cur.execute('SELECT filename FROM blobs WHERE refcount <= 0'))
+        cur.execute('DELETE FROM blobs WHERE refcount <= 0')
+        cur.execute('COMMIT')
+        known.update(r[0] for r in cur.execute("SELECT filename FROM blobs UNION SELECT filename FROM media "
+                                               "UNION SELECT thumb FROM media WHERE thumb != ''"))
+        conn.close()
+    dead -= known
+    for fname in dead:
+        store.remove(fname)
+    orphans = 0
+    for rel in store.iter_files():
+        if rel not in known:
+            store.remove(rel)
+            orphans += 1
+    print(f'Médias nettoyés : {len(dead)} blobs sans référence, {orphans} fichiers orphelins supprimés')
+
 
-    conn = sqlite3.connect(db_path)
+def make_thumbnails(conn, media_dir, size=DEFAULT_THUMB_PX, workers=1, batch=1000):
+    """Miniatures des images sans colonne thumb (nouvelles ou base antérieure), par un pool de processus.
+
+    media.thumb reçoit le chemin relatif de la miniature, ou '' si l'image est illisible (pas de nouvel essai).
+    """
+    if not thumbnails_supported():
+        print('Pillow absent : pas de miniatures, les pages afficheront les images originales (pip install pillow)')
+        return
+    cur = conn.cursor()
+    results = []
+    pool = ThumbnailPool(media_dir, size=size, workers=workers, on_done=lambda digest, trel: results.append((trel or '', digest)))
+
+    def save():
+        cur.execute('BEGIN')
+        cur.executemany('UPDATE media SET thumb = ? WHERE sha256 = ?', results)
+        if results:
+            bump_generation(cur)
+        cur.execute('COMMIT')
+        results.clear()
+
+    last = ''
+    try:
+        while True:
+            # pagination keyset sur sha256 : une image par contenu, mémoire bornée
+            rows = cur.execute("SELECT sha256, MIN(filename) FROM media WHERE thumb IS NULL AND sha256 > ? "
+                               "AND content_type LIKE 'image/%' AND content_type != 'image/svg+xml' "
+                               "GROUP BY sha256 ORDER BY sha256 LIMIT ?", (last, batch)).fetchall()
+            if not rows:
+                break
+            for digest, fname in rows:
+                pool.submit(digest, fname)
+            last = rows[-1][0]
+            save()
+    finally:
+        pool.close()
+        save()
+    print(f'Miniatures : {pool.made} créées, {pool.cached} déjà présentes, {pool.failed} images illisibles')
+
+
+def xml_signature(xml_path):
+    """Identité d'un fichier XML pour la reprise : chemin, taille, date de modification."""
+    st = os.stat(xml_path)
+    return f'{os.path.abspath(xml_path)}|{st.st_size}|{int(st.st_mtime)}'
+
+
+# date_ms NULL (message sans date) ramené à -1 : dans un index unique, les NULL sont tous distincts
+# et INSERT OR IGNORE laisserait passer chaque réimport d'un message non daté
+NATURAL_KEY = 'address, IFNULL(date_ms, -1), typ, direction, body_hash'
+
+
+def ensure_natural_key(conn, cur):
+    """Ajoute body_hash + l'index unique de clé naturelle (migration des bases existantes,
+    doublons éventuels supprimés en gardant le plus ancien id). Renvoie True si l'index FTS est à refaire."""
+    cols = [r[1] for r in cur.execute('PRAGMA table_info(messages)')]
+    dirty = False
+    if 'body_hash' not in cols:
+        cur.execute('ALTER TABLE messages ADD COLUMN body_hash TEXT')
+        conn.create_function('body_hash', 1, body_hash, deterministic=True)
+        cur.execute('UPDATE messages SET body_hash = body_hash(body)')
+    old = cur.execute("SELECT sql FROM sqlite_master WHERE type='index' AND name='idx_messages_natural'").fetchone()
+    if old and 'IFNULL' not in old[0]:
+        # ancienne clé sur date_ms brut : les messages sans date ont pu être dupliqués
+        cur.execute('DROP INDEX idx_messages_natural')
+    try:
+        cur.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS idx_messages_natural ON messages({NATURAL_KEY})')
+    except sqlite3.IntegrityError:
+        cur.execute('BEGIN')
+        cur.execute(f'DELETE FROM messages WHERE id NOT IN (SELECT MIN(id) FROM messages GROUP BY {NATURAL_KEY})')
+        print(f'{cur.rowcount} doublons supprimés (réimports précédents)')
+        cur.execute('DELETE FROM media WHERE message_id NOT IN (SELECT id FROM messages)')
+        cur.execute(f'CREATE UNIQUE INDEX idx_messages_natural ON messages({NATURAL_KEY})')
+        cur.execute('COMMIT')
+        dirty = True
+    return dirty
+
+
+def throughput_line(total, nbytes, t0):
+    """Ligne de débit : messages/s et Mo/s de XML lu."""
+    dt = max(time.perf_counter() - t0, 1e-9)
+    return f'{total} messages en {dt:.1f}s — {total / dt:,.0f} msg/s, {nbytes / dt / 1e6:.2f} Mo/s XML'
+
+
+def open_archive(db_path, fts_tokenize=None, fts_prefix=None, defer_fts=False, cache_mb=64):
+    """Ouvre une base d'archive en autocommit (transactions ouvertes par BatchWriter.flush()),
+    en créant ou migrant son schéma : messages, médias, agrégats par contact, FTS.
+    Renvoie (conn, has_fts, fts_rebuild)."""
+    conn = sqlite3.connect(db_path, isolation_level=None)
     cur = conn.cursor()
     cur.execute('PRAGMA journal_mode=WAL')
     cur.execute('PRAGMA synchronous=NORMAL')
+    cur.execute('PRAGMA temp_store=MEMORY')
+    cur.execute(f'PRAGMA cache_size=-{int(cache_mb * 1024)}')
 
     # Tables
     cur.execute('''
@@ -97,7 +585,9 @@ def import_xml_to_sqlite(xml_path, out_dir, split_by_year=False, limit=0):
         date_ms INTEGER,
         date_iso TEXT,
         direction TEXT,
-        body TEXT
+        body TEXT,
+        body_hash TEXT,
+        body_html TEXT
     )
     ''')
 
@@ -108,115 +598,398 @@ def import_xml_to_sqlite(xml_path, out_dir, split_by_year=False, limit=0):
         filename TEXT,
         content_type TEXT,
         orig_name TEXT,
+        sha256 TEXT,
+        thumb TEXT,
         FOREIGN KEY(message_id) REFERENCES messages(id)
     )
     ''')
+    ensure_blob_store(cur)
+    ensure_thumb_column(cur)
+
+    # index pour charger les médias d'une page de résultats en une requête (serveur)
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_media_message ON media(message_id)')
+    # conversation par correspondant, pagination keyset sur (COALESCE(date_ms, 0), id) (id = rowid, inclus
+    # dans l'index) ; l'ancien index sur date_ms brut ne sert plus à ce tri
+    cur.execute('DROP INDEX IF EXISTS idx_messages_address_date')
+    cur.execute('CREATE INDEX IF NOT EXISTS idx_messages_address_day ON messages(address, COALESCE(date_ms, 0))')
+    cur.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+    dedup_dirty = ensure_natural_key(conn, cur)
+    if ensure_contacts(cur) or dedup_dirty:
+        rebuild_contacts(cur)
+        print('Agrégats par contact recalculés')
 
     # FTS for fast text search (FTS5)
-    try:
-        cur.execute("CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(body, address, contact_name, content='messages', content_rowid='id')")
-        has_fts = True
-    except sqlite3.OperationalError:
-        print('FTS5 non disponible, recherche texte utilisera LIKE (plus lent).')
-        has_fts = False
+    has_fts, fts_rebuild = setup_fts(cur, tokenize=fts_tokenize, prefix=fts_prefix)
+    fts_rebuild = fts_rebuild or dedup_dirty
+    if has_fts and defer_fts:
+        # index périmé tant que le rebuild final n'a pas eu lieu (repris au prochain import si crash)
+        set_meta(cur, 'fts_dirty', '1')
+    return conn, has_fts, fts_rebuild
+
 
-    conn.commit()
+def import_xml_to_sqlite(xml_path, out_dir, split_by_year=False, limit=0, batch_size=DEFAULT_BATCH_SIZE,
+                         defer_fts=False, fts_tokenize=None, fts_prefix=None, workers=1,
+                         chunk_bytes=DEFAULT_CHUNK_BYTES, incremental=False, resume=False,
+                         spool_threshold=DEFAULT_SPOOL_BYTES, thumb_size=DEFAULT_THUMB_PX, store_html=False,
+                         shard_writers=DEFAULT_SHARD_WRITERS):
+    """Lit le XML en streaming et alimente SQLite + sauvegarde médias dans out_dir/media
 
-    context = ET.iterparse(xml_path, events=('start', 'end'))
-    _, root = next(context)
+    split_by_year : une base par année (out_dir/years/), écrites en parallèle ; messages.db devient
+    le catalogue (voir import_sharded).
+    incremental : ignore d'emblée les messages antérieurs au plus récent déjà importé (high-water mark
+    sur date_ms) ; les autres passent par la clé naturelle, donc un réimport ne crée pas de doublons.
+    resume : repart de l'offset du dernier point de reprise si le même XML avait été interrompu.
+    spool_threshold : les pièces jointes base64 plus grosses sont décodées en flux vers media/.spool.
+    thumb_size : côté des miniatures d'images (media/thumbs/), 0 pour ne pas en produire.
+    store_html : stocke le texte déjà rendu en HTML (body_html) ; reste actif pour les imports suivants.
+    """
+    ensure_dir(out_dir)
+    media_dir = os.path.join(out_dir, 'media')
+    ensure_dir(media_dir)
+    spool_dir = os.path.join(media_dir, '.spool')
+    ensure_dir(spool_dir)
+    db_path = os.path.join(out_dir, 'messages.db')
 
+    sharded = os.path.exists(db_path) and read_shards(db_path) is not None
+    if split_by_year:
+        return import_sharded(xml_path, out_dir, limit=limit, batch_size=batch_size, defer_fts=defer_fts,
+                              fts_tokenize=fts_tokenize, fts_prefix=fts_prefix, workers=workers,
+                              chunk_bytes=chunk_bytes, incremental=incremental, resume=resume,
+                              spool_threshold=spool_threshold, thumb_size=thumb_size, store_html=store_html,
+                              shard_writers=shard_writers)
+    if sharded:
+        raise SystemExit(f'Erreur: {db_path} est le catalogue d\'une archive découpée par année : relancer avec --split-by-year')
+
+    conn, has_fts, fts_rebuild = open_archive(db_path, fts_tokenize, fts_prefix, defer_fts)
+    cur = conn.cursor()
+
+    signature = xml_signature(xml_path)
+    writer = BatchWriter(conn, media_dir, has_fts and not defer_fts, batch_size=batch_size, xml_signature=signature)
+
+    start = 0
     total = 0
-    media_counter = 0
-    batch = []
-
-    def insert_message(typ, address, contact_name, date_ms, direction, body, media_items):
-        nonlocal media_counter
-        cur.execute('INSERT INTO messages (typ, address, contact_name, date_ms, date_iso, direction, body) VALUES (?, ?, ?, ?, ?, ?, ?)',
-                    (typ, address, contact_name, date_ms, ms_to_ts(date_ms).isoformat() if ms_to_ts(date_ms) else None, direction, body))
-        mid = cur.lastrowid
-        if has_fts:
-            cur.execute('INSERT INTO messages_fts(rowid, body, address, contact_name) VALUES (?, ?, ?, ?)', (mid, body or '', address or '', contact_name or ''))
-        for m in media_items:
-            fname, ctype, oname = m
-            media_counter += 1
-            ext = os.path.splitext(fname)[1] or guess_ext(ctype, oname)
-            saved_name = f'media_{media_counter:09d}{ext}'
-            with open(os.path.join(media_dir, saved_name), 'wb') as f:
-                f.write(m[3])
-            cur.execute('INSERT INTO media (message_id, filename, content_type, orig_name) VALUES (?, ?, ?, ?)',
-                        (mid, saved_name, ctype, oname))
-        return
+    if resume and get_meta(cur, 'checkpoint_xml') == signature and get_meta(cur, 'checkpoint_done') == '0':
+        start = int(get_meta(cur, 'checkpoint_offset', 0))
+        total = int(get_meta(cur, 'checkpoint_rows', 0))
+        print(f'Reprise à l\'octet {start} ({total} enregistrements déjà lus)')
 
-    for event, elem in context:
-        if event != 'end':
-            continue
-        tag = elem.tag.lower()
-
-        if tag == 'sms':
-            address = elem.attrib.get('address') or elem.attrib.get('address_email') or ''
-            name = elem.attrib.get('contact_name') or elem.attrib.get('name') or ''
-            body = elem.attrib.get('body') or ''
-            date_ms = elem.attrib.get('date')
-            type_ = elem.attrib.get('type')
-            direction = 'in' if type_ == '1' else 'out'
-            insert_message('sms', address, name, date_ms, direction, body, [])
-            total += 1
-            if total % 10000 == 0:
-                conn.commit(); print(f'[{total}] messages importés...')
-
-        elif tag == 'mms':
-            address = elem.attrib.get('address') or elem.attrib.get('address_email') or ''
-            name = elem.attrib.get('contact_name') or elem.attrib.get('name') or ''
-            date_ms = elem.attrib.get('date')
-            box = elem.attrib.get('msg_box') or elem.attrib.get('box') or elem.attrib.get('m_type')
-            direction = 'in' if (box == '1') else 'out'
-            # parts
-            parts_parent = elem.find('parts')
-            if parts_parent is None:
-                parts = elem.findall('part')
-            else:
-                parts = parts_parent.findall('part')
-            body_chunks = []
-            media_items = []
-            for part in parts:
-                ct = part.attrib.get('ct') or ''
-                text = part.attrib.get('text')
-                data = part.attrib.get('data')
-                name_attr = part.attrib.get('name') or part.attrib.get('cl')
-                if ct.startswith('text') or (ct == '' and text):
-                    if text:
-                        body_chunks.append(text)
-                    continue
-                if data:
-                    try:
-                        blob = base64.b64decode(data, validate=False)
-                    except Exception:
-                        blob = base64.b64decode(data + '==')
-                    # store temp name, content-type, orig name, and raw bytes
-                    media_items.append((name_attr or 'part', ct, name_attr or '', blob))
+    render = ensure_body_html(conn, cur, store_html)
+    worker = partial(import_worker, render=render)
+    if incremental:
+        hwm = cur.execute('SELECT MAX(date_ms) FROM messages').fetchone()[0]
+        if hwm is not None:
+            # >= : les messages de la même milliseconde passent par la clé naturelle
+            worker = partial(import_worker, min_date_ms=int(hwm), render=render)
+            print(f'Import incrémental : messages antérieurs à {ms_to_ts(hwm)} ignorés')
+
+    total0 = total
+    skipped = 0
+    completed = False
+    nbytes = start
+    t0 = time.perf_counter()
+
+    # lecteur (paquets d'enregistrements) -> workers (décodage, normalisation) -> cet écrivain unique
+    with closing(run_pipeline(xml_path, worker, workers=workers, chunk_bytes=chunk_bytes, start=start,
+                              spool_dir=spool_dir, spool_threshold=spool_threshold)) as pipeline:
+        for lo, nbytes, records in pipeline:
+            writer.resume_offset, writer.resume_rows = lo, total
+            if limit:
+                records = records[:limit - total]
+            for rec in records:
+                total += 1
+                if rec is None:
+                    skipped += 1
                 else:
-                    # not inlined media
-                    if name_attr:
-                        body_chunks.append(f"[pièce jointe: {name_attr}]")
-            body = '\n'.join(body_chunks)
-            insert_message('mms', address, name, date_ms, direction, body, media_items)
-            total += 1
-            if total % 10000 == 0:
-                conn.commit(); print(f'[{total}] messages importés...')
-
-        # clear to free memory
-        root.clear()
-
-        if limit and total >= limit:
-            break
-
-    conn.commit()
+                    writer.add(*rec)
+                if total % 10000 == 0:
+                    print(f'[{total}] messages lus... ({throughput_line(total - total0, nbytes - start, t0)})')
+            if limit and total >= limit:
+                break
+            writer.resume_offset, writer.resume_rows = nbytes, total
+        else:
+            completed = True
+
+    writer.flush(done=completed)
+    # fichiers décodés non réclamés (--limit, erreurs)
+    shutil.rmtree(spool_dir, ignore_errors=True)
+    if thumb_size:
+        make_thumbnails(conn, media_dir, size=thumb_size, workers=workers)
+    if has_fts and (defer_fts or fts_rebuild or get_meta(cur, 'fts_dirty') == '1'):
+        rebuild_fts(cur)
+        bump_generation(cur)
     conn.close()
-    print(f"Import terminé. {total} messages. DB: {db_path} | media dir: {media_dir}")
+    print(f"Import terminé. {total} messages lus : {writer.inserted} nouveaux, {writer.duplicates} déjà présents, "
+          f"{skipped} sous le high-water mark. DB: {db_path} | media dir: {media_dir}")
+    print(f"Débit: {throughput_line(total - total0, nbytes - start, t0)} ({writer.flushes} lots de {writer.batch_size} max)")
+    print(f"Médias : {writer.store.written} nouveaux fichiers, {writer.store.reused} contenus déjà stockés")
+    return db_path, media_dir
+
+# -------------------- Archive découpée par année --------------------
+
+SHARD_DIR = 'years'
+SHARD_ID_BITS = 32           # ids d'une base annuelle : année << 32 + n
+SHARD_SEND_RECORDS = 500     # enregistrements envoyés d'un coup à un écrivain
+SHARD_QUEUE_DEPTH = 4        # envois en attente par écrivain (mémoire bornée)
+SHARD_CACHE_MB = 16          # cache SQLite par base annuelle ouverte
+
+
+def shard_year(date_iso):
+    """Année (base annuelle) d'un message ; 0 pour les messages sans date."""
+    try:
+        return int(date_iso[:4])
+    except (TypeError, ValueError):
+        return 0
+
+
+def shard_id_base(year):
+    return year << SHARD_ID_BITS
+
+
+def shard_of(message_id):
+    """Année de la base qui contient ce message (ids attribués par shard_id_base)."""
+    return message_id >> SHARD_ID_BITS
+
+
+def shard_filename(year):
+    """Chemin de la base annuelle, relatif au dossier du catalogue."""
+    return f'{SHARD_DIR}/messages_{year:04d}.db'
+
+
+def read_shards(catalog_path):
+    """Bases annuelles d'un catalogue [{year, path, messages, first_date_ms, last_date_ms}] par année croissante,
+    ou None si la base n'est pas un catalogue (archive en un seul fichier)."""
+    with closing(sqlite3.connect(Path(catalog_path).resolve().as_uri() + '?mode=ro', uri=True)) as conn:
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name='shards'").fetchone() is None:
+            return None
+        base = os.path.dirname(os.path.abspath(catalog_path))
+        return [{'year': y, 'path': os.path.join(base, fn), 'messages': n, 'first_date_ms': lo, 'last_date_ms': hi}
+                for y, fn, n, lo, hi in conn.execute('SELECT year, filename, messages, first_date_ms, last_date_ms '
+                                                     'FROM shards ORDER BY year')]
+
+
+def shard_writer(index, inbox, results, out_dir, media_dir, opts):
+    """Processus écrivain : reçoit des lots [(année, enregistrement)] et les écrit dans les bases
+    annuelles qui lui reviennent, avec une connexion et un BatchWriter par année.
+
+    En fin de flux : dernier flush, miniatures, rebuild FTS éventuel ; les compteurs par année
+    (ou la trace d'une erreur) repartent par results.
+    """
+    shards = {}
+    try:
+        while True:
+            batch = inbox.get()
+            if batch is None:
+                break
+            for year, rec in batch:
+                shard = shards.get(year)
+                if shard is None:
+                    conn, has_fts, fts_rebuild = open_archive(os.path.join(out_dir, shard_filename(year)),
+                                                              opts['fts_tokenize'], opts['fts_prefix'],
+                                                              opts['defer_fts'], cache_mb=SHARD_CACHE_MB)
+                    ensure_body_html(conn, conn.cursor(), opts['store_html'])
+                    writer = BatchWriter(conn, media_dir, has_fts and not opts['defer_fts'],
+                                         batch_size=opts['batch_size'], id_base=shard_id_base(year))
+                    shard = shards[year] = (writer, has_fts, fts_rebuild)
+                shard[0].add(*rec)
+        stats = {}
+        for year, (writer, has_fts, fts_rebuild) in sorted(shards.items()):
+            writer.flush(done=True)
+            cur = writer.conn.cursor()
+            if opts['thumb_size']:
+                make_thumbnails(writer.conn, media_dir, size=opts['thumb_size'])
+            if has_fts and (opts['defer_fts'] or fts_rebuild or get_meta(cur, 'fts_dirty') == '1'):
+                rebuild_fts(cur)
+                bump_generation(cur)
+            writer.conn.close()
+            stats[year] = (writer.inserted, writer.duplicates, writer.flushes, writer.store.written, writer.store.reused)
+        results.put((index, stats, None))
+    except BaseException:
+        import traceback
+        results.put((index, None, traceback.format_exc()))
+
+
+def update_catalog(catalog, out_dir):
+    """Catalogue = liste des bases annuelles (bornes de dates pour l'élagage) + agrégats par contact
+    fusionnés depuis chacune. Renvoie le nombre de bases."""
+    cur = catalog.cursor()
+    cur.execute('BEGIN')
+    cur.execute('DELETE FROM shards')
+    cur.execute('DELETE FROM contacts')
+    cur.execute('DELETE FROM contact_years')
+    generations = 0
+    years = sorted(int(fn[len('messages_'):-len('.db')]) for fn in os.listdir(os.path.join(out_dir, SHARD_DIR))
+                   if fn.startswith('messages_') and fn.endswith('.db'))
+    for year in years:
+        # une base attachée à la fois : pas de limite SQLITE_MAX_ATTACHED quel que soit le nombre d'années
+        cur.execute('ATTACH DATABASE ? AS s', (os.path.join(out_dir, shard_filename(year)),))
+        n, lo, hi = cur.execute('SELECT COALESCE(SUM(messages), 0), MIN(first_date_ms), MAX(last_date_ms) FROM s.contacts').fetchone()
+        cur.execute('INSERT INTO shards (year, filename, messages, first_date_ms, last_date_ms) VALUES (?, ?, ?, ?, ?)',
+                    (year, shard_filename(year), n, lo, hi))
+        cur.execute('INSERT INTO contacts (address, contact_name, messages, sent, first_date_ms, last_date_ms, media, media_bytes) '
+                    'SELECT address, contact_name, messages, sent, first_date_ms, last_date_ms, media, media_bytes '
+                    'FROM s.contacts WHERE true' + CONTACTS_MERGE)
+        cur.execute('INSERT INTO contact_years (address, year, messages) SELECT address, year, messages FROM s.contact_years WHERE true '
+                    'ON CONFLICT(address, year) DO UPDATE SET messages = messages + excluded.messages')
+        generations += int(cur.execute("SELECT COALESCE(MAX(value), 0) FROM s.meta WHERE key='generation'").fetchone()[0])
+        cur.execute('COMMIT')
+        cur.execute('DETACH DATABASE s')
+        cur.execute('BEGIN')
+    # le serveur ne lit que la génération du catalogue : elle suit celles des bases annuelles
+    if get_meta(cur, 'shard_generations') != str(generations):
+        set_meta(cur, 'shard_generations', generations)
+        bump_generation(cur)
+    cur.execute('COMMIT')
+    return len(years)
+
+
+def open_catalog(db_path):
+    conn = sqlite3.connect(db_path, isolation_level=None)
+    cur = conn.cursor()
+    cur.execute('PRAGMA journal_mode=WAL')
+    if cur.execute("SELECT 1 FROM sqlite_master WHERE name='messages'").fetchone() is not None:
+        conn.close()
+        raise SystemExit(f'Erreur: {db_path} contient déjà une archive en un seul fichier : pas de --split-by-year')
+    cur.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+    cur.execute('''
+    CREATE TABLE IF NOT EXISTS shards (
+        year INTEGER PRIMARY KEY,
+        filename TEXT NOT NULL,
+        messages INTEGER NOT NULL DEFAULT 0,
+        first_date_ms INTEGER,
+        last_date_ms INTEGER
+    )
+    ''')
+    ensure_contacts(cur)
+    return conn
+
+
+def import_sharded(xml_path, out_dir, limit=0, batch_size=DEFAULT_BATCH_SIZE, defer_fts=False, fts_tokenize=None,
+                   fts_prefix=None, workers=1, chunk_bytes=DEFAULT_CHUNK_BYTES, incremental=False, resume=False,
+                   spool_threshold=DEFAULT_SPOOL_BYTES, thumb_size=DEFAULT_THUMB_PX, store_html=False,
+                   shard_writers=DEFAULT_SHARD_WRITERS):
+    """Import découpé par année : out_dir/years/messages_AAAA.db (même schéma qu'une archive complète,
+    médias partagés dans out_dir/media) + out_dir/messages.db, catalogue lu par le serveur.
+
+    lecteur -> workers de décodage -> ce processus (routage par année) -> shard_writers processus
+    écrivains, chacun propriétaire des années année % shard_writers == son numéro : les bases
+    annuelles sont écrites en parallèle, sans verrou partagé. Les ids sont propres à chaque année
+    (shard_id_base), donc uniques dans toute l'archive.
+    Pas de point de reprise (les bases avancent chacune à leur rythme) : relancer l'import est sûr,
+    la clé naturelle écarte les messages déjà écrits.
+    """
+    media_dir = os.path.join(out_dir, 'media')
+    spool_dir = os.path.join(media_dir, '.spool')
+    db_path = os.path.join(out_dir, 'messages.db')
+    ensure_dir(os.path.join(out_dir, SHARD_DIR))
+    catalog = open_catalog(db_path)
+    ccur = catalog.cursor()
+    if resume:
+        print('--resume ignoré avec --split-by-year : les messages déjà écrits sont écartés par la clé naturelle')
+
+    if store_html:
+        set_meta(ccur, 'store_html', '1')
+    render = get_meta(ccur, 'store_html') == '1'
+    worker = partial(import_worker, render=render)
+    if incremental:
+        hwm = ccur.execute('SELECT MAX(last_date_ms) FROM shards').fetchone()[0]
+        if hwm is not None:
+            worker = partial(import_worker, min_date_ms=int(hwm), render=render)
+            print(f'Import incrémental : messages antérieurs à {ms_to_ts(hwm)} ignorés')
+
+    opts = {'batch_size': batch_size, 'defer_fts': defer_fts, 'fts_tokenize': fts_tokenize, 'fts_prefix': fts_prefix,
+            'store_html': render, 'thumb_size': thumb_size}
+    n = max(1, shard_writers)
+    ctx = multiprocessing.get_context()
+    inboxes = [ctx.Queue(maxsize=SHARD_QUEUE_DEPTH) for _ in range(n)]
+    results = ctx.Queue()
+    procs = [ctx.Process(target=shard_writer, args=(i, inboxes[i], results, out_dir, media_dir, opts), name=f'shard-writer-{i}')
+             for i in range(n)]
+    for p in procs:
+        p.start()
+
+    def send(i, item):
+        while True:
+            try:
+                inboxes[i].put(item, timeout=1)
+                return
+            except queue.Full:
+                if not procs[i].is_alive():
+                    raise RuntimeError(f'écrivain {i} arrêté (code {procs[i].exitcode})')
+
+    total = skipped = 0
+    nbytes = 0
+    per_year = {}
+    pending = [[] for _ in range(n)]
+    t0 = time.perf_counter()
+    ok = False
+    try:
+        with closing(run_pipeline(xml_path, worker, workers=workers, chunk_bytes=chunk_bytes,
+                                  spool_dir=spool_dir, spool_threshold=spool_threshold)) as pipeline:
+            for _, nbytes, records in pipeline:
+                if limit:
+                    records = records[:limit - total]
+                for rec in records:
+                    total += 1
+                    if rec is None:
+                        skipped += 1
+                        continue
+                    year = shard_year(rec[4])
+                    per_year[year] = per_year.get(year, 0) + 1
+                    # années consécutives -> écrivains différents : un XML chronologique les occupe tous
+                    i = year % n
+                    pending[i].append((year, rec))
+                    if len(pending[i]) >= SHARD_SEND_RECORDS:
+                        send(i, pending[i])
+                        pending[i] = []
+                    if total % 10000 == 0:
+                        print(f'[{total}] messages lus... ({throughput_line(total, nbytes, t0)})')
+                if limit and total >= limit:
+                    break
+        for i in range(n):
+            if pending[i]:
+                send(i, pending[i])
+            send(i, None)
+        stats = {}
+        for _ in range(n):
+            while True:
+                try:
+                    index, res, err = results.get(timeout=1)
+                    break
+                except queue.Empty:
+                    if not any(p.is_alive() for p in procs) and results.empty():
+                        raise RuntimeError('écrivains arrêtés sans rendre de résultat')
+            if err:
+                raise RuntimeError(f'écrivain {index} :\n{err}')
+            stats.update(res)
+        ok = True
+    finally:
+        for p in procs:
+            p.join(timeout=None if ok else 1)
+            if p.is_alive():
+                p.terminate()
+        shutil.rmtree(spool_dir, ignore_errors=True)
+
+    n_shards = update_catalog(catalog, out_dir)
+    catalog.close()
+    inserted = sum(s[0] for s in stats.values())
+    duplicates = sum(s[1] for s in stats.values())
+    print(f"Import terminé. {total} messages lus : {inserted} nouveaux, {duplicates} déjà présents, "
+          f"{skipped} sous le high-water mark. Catalogue: {db_path} ({n_shards} bases annuelles) | media dir: {media_dir}")
+    print(f"Débit: {throughput_line(total, nbytes, t0)} ({n} écrivains ; "
+          + ', '.join(f'{y or "sans date"}: {c}' for y, c in sorted(per_year.items())) + ')')
+    print(f"Médias : {sum(s[3] for s in stats.values())} nouveaux fichiers, "
+          f"{sum(s[4] for s in stats.values())} contenus déjà stockés")
     return db_path, media_dir
 
 # -------------------- Minimal Flask server --------------------
 
+# médias d'un message : miniature chargée à l'approche de l'écran, original au clic
+MEDIA_HTML = '''<div class="media">{% for mm in m.media %}{% set ct = mm.content_type or '' %}
+{%- if ct.startswith('video/') %}<video controls preload="none" src="/media/{{mm.filename}}"></video>
+{%- elif ct.startswith('audio/') %}<audio controls preload="none" src="/media/{{mm.filename}}"></audio>
+{%- elif ct.startswith('image/') or not ct %}<a href="/media/{{mm.filename}}" target="_blank"><img src="/media/{{mm.thumb or mm.filename}}" loading="lazy" decoding="async" alt="{{ct}}"></a>
+{%- else %}<a href="/media/{{mm.filename}}" download>{{mm.orig_name or ct}}</a>{% endif %}{% endfor %}</div>'''
+
 FLASK_TEMPLATES = {
     'index': '''<!doctype html>
 <html lang="fr"><head><meta charset="utf-8"><meta name="viewport" content="width=device-width,initial-scale=1">
@@ -231,6 +1004,9 @@ body{font-family:system-ui,Segoe UI,Roboto,Arial;margin:0;background:#f4f7fb;col
 .msg{padding:.6rem;border-bottom:1px solid #eee}
 .small{color:#666;font-size:.9rem}
 .media img{max-width:240px;display:block;margin-top:.5rem}
+.media video,.media audio{max-width:100%;display:block;margin-top:.5rem}
+mark{background:#ffe58a;padding:0 .1em}
+.nav{margin:1rem 0}
 </style>
 </head><body><div class="container">
 <div class="header"><h1>🔎 Rechercher dans l'archive</h1></div>
@@ -239,21 +1015,51 @@ body{font-family:system-ui,Segoe UI,Roboto,Arial;margin:0;background:#f4f7fb;col
 <input name="q" placeholder="Mot-clé, numéro ou contact" style="flex:1;padding:.5rem;border:1px solid #ddd;border-radius:6px" value="{{q|e}}">
 <button style="padding:.5rem .9rem">Rechercher</button>
 </form>
+<form class="form small" method="get" action="/search" style="margin-top:.5rem;flex-wrap:wrap">
+<input type="hidden" name="q" value="{{q|e}}">
+<input name="contact" placeholder="Numéro exact" value="{{f.contact or ''}}">
+<select name="direction"><option value="">reçus et envoyés</option><option value="in" {{'selected' if f.direction=='in'}}>reçus</option><option value="out" {{'selected' if f.direction=='out'}}>envoyés</option></select>
+du <input type="date" name="from" value="{{f['from'] or ''}}"> au <input type="date" name="to" value="{{f.to or ''}}">
+<select name="sort"><option value="rank">pertinence</option><option value="date" {{'selected' if f.sort=='date'}}>date</option></select>
+<button>Filtrer</button>
+</form>
 </div>
 {% if q is defined and q %}
 <div class="result">
-  <h2>Résultats pour «{{q|e}}» — {{total}} messages</h2>
+  <h2>Résultats pour «{{q|e}}»{% if total is not none %} — {{total}} messages{% endif %}</h2>
   <div class="card">
   {% for m in rows %}
     <div class="msg">
-      <div><strong>{{m.contact_name or m.address}}</strong> <span class="small">• {{m.date_iso}}</span></div>
-      <div>{{m.body_html | safe}}</div>
+      <div><a href="/conversation/{{m.address|urlencode}}"><strong>{{m.contact_name or m.address}}</strong></a> <span class="small">• {{m.date_iso}}{% if m.direction == 'out' %} • envoyé{% endif %}</span></div>
+      <div>{{m.snippet | safe}}</div>
       {% if m.media %}
-        <div class="media">{% for mm in m.media %}<a href="/media/{{mm}}" target="_blank"><img src="/media/{{mm}}"></a>{% endfor %}</div>
+        ''' + MEDIA_HTML + '''
       {% endif %}
     </div>
+  {% else %}
+    <div class="small">Aucun résultat.</div>
+  {% endfor %}
+  </div>
+  {% if next %}<div class="nav"><a href="{{next}}">Résultats suivants →</a></div>{% endif %}
+</div>
+{% elif contacts is defined %}
+<div class="result">
+  {% if contacts is none %}
+  <p class="small">Pas encore d'agrégats par contact dans cette base : relancez un import (--import --incremental) pour les construire.</p>
+  {% else %}
+  <h2>Contacts — {{summary.contacts}} correspondants, {{summary.messages}} messages</h2>
+  <div class="card">
+  <div class="small">Trier par : <a href="?sort=messages">volume</a> · <a href="?sort=recent">activité récente</a> · <a href="?sort=name">nom</a></div>
+  {% for c in contacts %}
+    <div class="msg">
+      <div><a href="/conversation/{{c.address|urlencode}}"><strong>{{c.contact_name or c.address}}</strong></a>
+      <span class="small">• {{c.messages}} messages ({{c.sent}} envoyés){% if c.media %}, {{c.media}} médias ({{'%.1f' % (c.media_bytes / 1048576)}} Mo){% endif %} • {{c.first}} → {{c.last}}</span></div>
+      {% if c.years %}<div class="small">{% for y, n in c.years %}{{y}} : {{n}}{% if not loop.last %} · {% endif %}{% endfor %}</div>{% endif %}
+    </div>
   {% endfor %}
+  {% if more %}<div class="small" style="margin-top:.6rem"><a href="/contacts?sort={{sort}}">Tous les contacts →</a></div>{% endif %}
   </div>
+  {% endif %}
 </div>
 {% endif %}
 </div></body></html>''',
@@ -270,6 +1076,8 @@ body{font-family:system-ui,Segoe UI,Roboto,Arial;margin:0;background:#f4f7fb;col
 .out{background:#efe;padding:.6rem;border-radius:6px}
 .small{color:#666;font-size:.9rem}
 .media img{max-width:300px;display:block;margin-top:.5rem}
+.media video,.media audio{max-width:100%;display:block;margin-top:.5rem}
+.nav{margin:1rem 0}
 </style>
 </head><body><div class="container">
 <h1>Conversation: {{who}}</h1>
@@ -279,83 +1087,735 @@ body{font-family:system-ui,Segoe UI,Roboto,Arial;margin:0;background:#f4f7fb;col
     <div class="small">{{m.date_iso}}</div>
     <div>{{m.body_html | safe}}</div>
     {% if m.media %}
-      <div class="media">{% for mm in m.media %}<a href="/media/{{mm}}" target="_blank"><img src="/media/{{mm}}"></a>{% endfor %}</div>
+      ''' + MEDIA_HTML + '''
     {% endif %}
   </div>
 {% endfor %}
 </div>
+{% if page.next %}<div class="nav"><a href="{{page.next}}">Messages suivants →</a></div>{% endif %}
 </div></body></html>'''
 }
 
 
-def run_server(db_path, media_dir, host='127.0.0.1', port=5000):
-    from flask import Flask, request, render_template_string, send_from_directory, abort
+DEFAULT_POOL_SIZE = 8
+DEFAULT_SERVER_THREADS = 8
+DEFAULT_MMAP_MB = 256
+DEFAULT_CACHE_MB = 64
+
+
+class ReadPool:
+    """Pool de connexions SQLite en lecture seule, réutilisées d'une requête à l'autre.
+
+    Chaque requête emprunte une connexion (liée au contexte de la requête, donc à un seul
+    thread à la fois) et la rend à la fin ; les PRAGMA ne sont payés qu'à la création.
+    """
+
+    def __init__(self, db_path, size=DEFAULT_POOL_SIZE, mmap_mb=DEFAULT_MMAP_MB, cache_mb=DEFAULT_CACHE_MB):
+        self.uri = Path(db_path).resolve().as_uri() + '?mode=ro'
+        self.size = size
+        self.mmap_bytes = int(mmap_mb * 2**20)
+        self.cache_kib = int(cache_mb * 1024)
+        self._idle = queue.LifoQueue()
+
+    def _connect(self):
+        conn = sqlite3.connect(self.uri, uri=True, check_same_thread=False)
+        conn.row_factory = sqlite3.Row
+        conn.execute(f'PRAGMA mmap_size={self.mmap_bytes}')
+        conn.execute(f'PRAGMA cache_size=-{self.cache_kib}')
+        conn.execute('PRAGMA query_only=1')
+        return conn
+
+    def acquire(self):
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            return self._connect()
+
+    def release(self, conn):
+        if self._idle.qsize() < self.size:
+            self._idle.put(conn)
+        else:
+            conn.close()
+
+
+def fetch_media(c, message_ids, has_thumb=True):
+    """Médias d'une page entière de messages en une requête groupée :
+    {message_id: [{filename, content_type, orig_name, thumb}, ...]}."""
+    media = {}
+    ids = list(message_ids)
+    thumb = "NULLIF(thumb, '')" if has_thumb else 'NULL'
+    for i in range(0, len(ids), 500):
+        part = ids[i:i + 500]
+        placeholders = ','.join('?' for _ in part)
+        for mid, fname, ct, oname, th in c.execute(
+                f'SELECT message_id, filename, content_type, orig_name, {thumb} FROM media '
+                f'WHERE message_id IN ({placeholders}) ORDER BY id', part):
+            media.setdefault(mid, []).append({'filename': fname, 'content_type': ct, 'orig_name': oname, 'thumb': th})
+    return media
+
+
+DEFAULT_SEARCH_CACHE = 512        # réponses de recherche gardées (0 = pas de cache)
+DEFAULT_SEARCH_CACHE_MB = 32
+DEFAULT_SEARCH_CACHE_TTL = 300    # secondes
+
+
+class SearchCache:
+    """Cache LRU + TTL des réponses de recherche déjà rendues, borné en entrées et en octets.
+
+    Clé : requête normalisée + page (+ format). Tout est vidé quand meta.generation change
+    (import, rebuild FTS, miniatures) ; la base n'est relue pour cela qu'une fois par check_interval.
+    """
+
+    def __init__(self, max_entries=DEFAULT_SEARCH_CACHE, max_mb=DEFAULT_SEARCH_CACHE_MB, ttl=DEFAULT_SEARCH_CACHE_TTL,
+                 check_interval=1.0):
+        self.max_entries = max_entries
+        self.max_bytes = int(max_mb * 2**20)
+        self.ttl = ttl
+        self.check_interval = check_interval
+        self.entries = OrderedDict()  # clé -> (expiration, taille, valeur), du moins au plus récemment lu
+        self.bytes = 0
+        self.generation = None
+        self.checked_at = 0.0
+        self.lock = threading.Lock()
+        self.hits = self.misses = self.evictions = self.expired = self.invalidations = 0
+
+    @staticmethod
+    def normalize(q):
+        # espaces seulement : la casse compte pour les opérateurs FTS5 (AND/OR/NOT)
+        return ' '.join(q.split())
+
+    def validate(self, read_generation):
+        """Vide le cache si la génération de la base a changé ; renvoie True dans ce cas."""
+        now = time.monotonic()
+        if now - self.checked_at < self.check_interval:
+            return False
+        self.checked_at = now
+        gen = read_generation()
+        with self.lock:
+            if gen == self.generation:
+                return False
+            changed = self.generation is not None
+            self.generation = gen
+            if self.entries:
+                self.entries.clear()
+                self.bytes = 0
+                self.invalidations += 1
+        return changed
+
+    def get(self, key):
+        with self.lock:
+            item = self.entries.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            if item[0] < time.monotonic():
+                del self.entries[key]
+                self.bytes -= item[1]
+                self.expired += 1
+                self.misses += 1
+                return None
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return item[2]
+
+    def put(self, key, value, size):
+        if not self.max_entries or size > self.max_bytes:
+            return
+        with self.lock:
+            old = self.entries.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self.entries[key] = (time.monotonic() + self.ttl, size, value)
+            self.bytes += size
+            while len(self.entries) > self.max_entries or self.bytes > self.max_bytes:
+                _, (_, sz, _) = self.entries.popitem(last=False)
+                self.bytes -= sz
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            lookups = self.hits + self.misses
+            return {'entries': len(self.entries), 'bytes': self.bytes, 'hits': self.hits, 'misses': self.misses,
+                    'hit_ratio': round(self.hits / lookups, 3) if lookups else None, 'evictions': self.evictions,
+                    'expired': self.expired, 'invalidations': self.invalidations, 'generation': self.generation}
+
+
+SEARCH_PAGE = 50          # résultats par page de recherche
+SEARCH_PAGE_MAX = 500
+SNIPPET_TOKENS = 24
+# marqueurs de surlignage FTS5, remplacés par <mark> après échappement du texte
+_HL_OPEN, _HL_CLOSE = '\x02', '\x03'
+
+
+def highlight_html(text):
+    """Extrait snippet()/highlight() -> HTML sûr (texte échappé, termes trouvés en <mark>)."""
+    return html.escape(text or '').replace(_HL_OPEN, '<mark>').replace(_HL_CLOSE, '</mark>').replace('\n', '<br>')
+
+
+def parse_day(value, end=False):
+    """'AAAA-MM-JJ' (heure locale) -> date_ms du début du jour (ou du lendemain si end) ; ValueError si invalide."""
+    if not value:
+        return None
+    day = datetime.strptime(value, '%Y-%m-%d')
+    return int(day.timestamp() * 1000) + (86400000 if end else 0)
+
+
+def parse_search_cursor(after, sort):
+    """Curseur de recherche : "score_id" (tri par pertinence) ou "date_ms_id" (tri par date)."""
+    if not after:
+        return None
+    key, _, mid = after.rpartition('_')
+    return (float(key) if sort == 'rank' else int(key)), int(mid)
+
+
+def search_messages(c, q, address=None, direction=None, date_from=None, date_to=None, sort='rank',
+                    cursor=None, limit=SEARCH_PAGE, full=False, count=False):
+    """Recherche paginée par curseur (keyset), sans OFFSET ni corps complets.
+
+    FTS5 : classement bm25 (ou date), extrait snippet() — highlight() du corps entier si full.
+    Sans FTS5 : LIKE, tri par date. Filtres : correspondant exact, direction, intervalle [date_from, date_to[.
+    Renvoie {'rows': [...], 'next': curseur ou None, 'total': int ou None, 'mode': 'fts'|'like'}.
+    """
+    filters, params = [], []
+    if address:
+        filters.append('m.address = ?')
+        params.append(address)
+    if direction in ('in', 'out'):
+        filters.append('m.direction = ?')
+        params.append(direction)
+    if date_from is not None:
+        filters.append('m.date_ms >= ?')
+        params.append(date_from)
+    if date_to is not None:
+        filters.append('m.date_ms < ?')
+        params.append(date_to)
+    cols = 'm.id, m.typ, m.address, m.contact_name, m.date_ms, m.date_iso, m.direction'
+
+    def page(base_sql, base_params, score_sql, text_sql, order_by_rank):
+        where = list(filters)
+        args = list(base_params) + params
+        if order_by_rank:
+            order = f'{score_sql}, m.id'
+            if cursor:
+                where.append(f'({score_sql}, m.id) > (?, ?)')
+                args += cursor
+        else:
+            order = 'COALESCE(m.date_ms, 0) DESC, m.id DESC'
+            if cursor:
+                where.append('(COALESCE(m.date_ms, 0), m.id) < (?, ?)')
+                args += cursor
+        cond = ''.join(' AND ' + w for w in where)
+        sql = f'SELECT {cols}, {score_sql} AS score, {text_sql} AS excerpt {base_sql}{cond} ORDER BY {order} LIMIT ?'
+        rows = [dict(r) for r in c.execute(sql, args + [limit + 1])]
+        total = None
+        if count:
+            total = c.execute(f'SELECT COUNT(*) {base_sql}' + ''.join(' AND ' + w for w in filters),
+                              list(base_params) + params).fetchone()[0]
+        return rows, total
+
+    has_fts = c.execute("SELECT 1 FROM sqlite_master WHERE name='messages_fts'").fetchone() is not None
+    mode = 'fts' if has_fts else 'like'
+    if has_fts:
+        fts_from = 'FROM messages_fts JOIN messages m ON m.id = messages_fts.rowid WHERE messages_fts MATCH ?'
+        text = (f"highlight(messages_fts, 0, '{_HL_OPEN}', '{_HL_CLOSE}')" if full else
+                f"snippet(messages_fts, 0, '{_HL_OPEN}', '{_HL_CLOSE}', '…', {SNIPPET_TOKENS})")
+        try:
+            rows, total = page(fts_from, [q], 'bm25(messages_fts)', text, sort == 'rank')
+        except sqlite3.OperationalError:
+            # syntaxe FTS5 invalide (guillemet isolé, "-", ...) : recherche de la phrase telle quelle
+            rows, total = page(fts_from, ['"' + q.replace('"', '""') + '"'], 'bm25(messages_fts)', text, sort == 'rank')
+    else:
+        likeq = f'%{q}%'
+        text = 'm.body' if full else f'substr(m.body, 1, {SNIPPET_TOKENS * 8})'
+        rows, total = page('FROM messages m WHERE (m.body LIKE ? OR m.address LIKE ? OR m.contact_name LIKE ?)',
+                           [likeq, likeq, likeq], '0', text, False)
+    more = len(rows) > limit
+    rows = rows[:limit]
+    for r in rows:
+        excerpt = r.pop('excerpt')
+        r['snippet'] = highlight_html(excerpt)
+    nxt = search_cursor(rows[-1], sort, mode) if more and rows else None
+    return {'rows': rows, 'next': nxt, 'total': total, 'mode': mode}
+
+
+def search_cursor(row, sort, mode):
+    """Curseur de la page suivante, après la ligne row (voir parse_search_cursor)."""
+    if sort == 'rank' and mode == 'fts':
+        return f"{row['score']!r}_{row['id']}"
+    return f"{row['date_ms'] or 0}_{row['id']}"
+
+
+def prune_shards(shards, date_from=None, date_to=None):
+    """Bases annuelles pouvant contenir des messages de [date_from, date_to[, d'après les bornes du catalogue."""
+    keep = []
+    for sh in shards:
+        lo, hi = sh['first_date_ms'], sh['last_date_ms']
+        if not sh['messages']:
+            continue
+        if lo is None:
+            # base des messages sans date : exclue par tout filtre de date
+            if date_from is None and date_to is None:
+                keep.append(sh)
+            continue
+        if (date_from is not None and hi < date_from) or (date_to is not None and lo >= date_to):
+            continue
+        keep.append(sh)
+    return keep
+
+
+def search_shards(conns, q, sort='rank', cursor=None, limit=SEARCH_PAGE, count=False, executor=None, **kw):
+    """search_messages sur plusieurs bases annuelles, fusionnées dans l'ordre global d'une base unique.
+
+    conns : [(base, connexion)] par année croissante, déjà élagués par prune_shards ; les ids étant
+    uniques dans l'archive, le curseur keyset est le même. Tri par date sans total : de la base la plus
+    récente à la plus ancienne, arrêt dès la page pleine. Sinon toutes les bases sont interrogées
+    (en parallèle via executor) et les pages fusionnées ; les scores bm25 sont ceux de chaque index annuel.
+    """
+    if sort == 'date' and not count:
+        rows, mode = [], 'fts'
+        for sh, c in reversed(conns):
+            if cursor and sh['first_date_ms'] is not None and sh['first_date_ms'] > cursor[0]:
+                continue
+            res = search_messages(c.cursor(), q, sort=sort, cursor=cursor, limit=limit + 1 - len(rows), **kw)
+            rows += res['rows']
+            mode = res['mode']
+            if len(rows) > limit:
+                break
+        results = [{'rows': rows, 'next': None, 'total': None, 'mode': mode}]
+    else:
+        def one(c):
+            return search_messages(c.cursor(), q, sort=sort, cursor=cursor, limit=limit, count=count, **kw)
+        if executor is not None and len(conns) > 1:
+            results = list(executor.map(one, [c for _, c in conns]))
+        else:
+            results = [one(c) for _, c in conns]
+    mode = results[0]['mode'] if results else 'fts'
+    rows = [r for res in results for r in res['rows']]
+    if sort == 'rank' and mode == 'fts':
+        rows.sort(key=lambda r: (r['score'], r['id']))
+    else:
+        rows.sort(key=lambda r: (r['date_ms'] or 0, r['id']), reverse=True)
+    more = len(rows) > limit or any(res['next'] for res in results)
+    rows = rows[:limit]
+    total = sum(res['total'] or 0 for res in results) if count else None
+    return {'rows': rows, 'next': search_cursor(rows[-1], sort, mode) if more and rows else None,
+            'total': total, 'mode': mode}
+
+
+CONTACT_SORTS = {
+    'messages': 'messages DESC, address',
+    'recent': 'last_date_ms DESC, address',
+    'name': "COALESCE(contact_name, address) COLLATE NOCASE, address",
+}
+LANDING_CONTACTS = 50   # contacts affichés sur la page d'accueil (tous sur /contacts)
+
+
+def load_contacts(c, sort='messages', limit=None):
+    """Liste des correspondants lue dans la seule table d'agrégats contacts (jamais dans messages).
+
+    Renvoie (contacts, résumé, il_en_reste) ; contacts vaut None si la base n'a pas encore ces agrégats.
+    """
+    try:
+        n_contacts, n_messages = c.execute('SELECT COUNT(*), COALESCE(SUM(messages), 0) FROM contacts').fetchone()
+    except sqlite3.OperationalError:
+        return None, None, False
+    sql = f'SELECT * FROM contacts ORDER BY {CONTACT_SORTS.get(sort, CONTACT_SORTS["messages"])}'
+    if limit:
+        sql += f' LIMIT {int(limit)}'
+    contacts = [dict(r) for r in c.execute(sql)]
+    by_address = {ct['address']: ct for ct in contacts}
+    for ct in contacts:
+        ct['years'] = []
+        ct['first'] = ms_to_ts(ct['first_date_ms']).strftime('%Y-%m-%d') if ct['first_date_ms'] is not None else '?'
+        ct['last'] = ms_to_ts(ct['last_date_ms']).strftime('%Y-%m-%d') if ct['last_date_ms'] is not None else '?'
+    addresses = list(by_address)
+    for i in range(0, len(addresses), 500):
+        part = addresses[i:i + 500]
+        placeholders = ','.join('?' for _ in part)
+        for address, year, n in c.execute(f'SELECT address, year, messages FROM contact_years WHERE address IN ({placeholders}) ORDER BY address, year', part):
+            by_address[address]['years'].append((year, n))
+    return contacts, {'contacts': n_contacts, 'messages': n_messages}, bool(limit) and n_contacts > len(contacts)
+
+
+CONVERSATION_PAGE = 2000   # messages par page HTTP de conversation
+CONVERSATION_BATCH = 200   # messages lus par requête SQL pendant le streaming
+CONVERSATION_FIRST_SQL = 'SELECT * FROM messages WHERE address=? ORDER BY COALESCE(date_ms, 0), id LIMIT ?'
+# SQLite ne tire pas de borne d'index d'une comparaison de n-uplets sur une expression : la borne
+# COALESCE(date_ms, 0) >= ? (répétée) fait démarrer la recherche au curseur au lieu du début du fil
+CONVERSATION_NEXT_SQL = ('SELECT * FROM messages WHERE address=? AND COALESCE(date_ms, 0) >= ? '
+                         'AND (COALESCE(date_ms, 0), id) > (?, ?) ORDER BY COALESCE(date_ms, 0), id LIMIT ?')
+
+
+def parse_cursor(after):
+    """Curseur keyset "date_ms.id" -> (date_ms, id) ; None si absent, ValueError si invalide."""
+    if not after:
+        return None
+    date_ms, _, mid = after.partition('.')
+    return int(date_ms), int(mid)
+
+
+def conversation_cursor(row):
+    """Position keyset d'un message : (date_ms, id), message sans date rangé à 0 comme dans le tri."""
+    return row['date_ms'] or 0, row['id']
+
+
+def iter_conversation(c, address, cursor=None, limit=CONVERSATION_PAGE, batch=CONVERSATION_BATCH):
+    """Messages d'une conversation par ordre (date_ms, id), lus par lots via pagination keyset
+    sur l'index (address, COALESCE(date_ms, 0)) : chaque lot reprend après le dernier (date_ms, id) vu.
+    Les messages sans date viennent en tête (0) : comparé à un date_ms NULL, le curseur serait NULL
+    et la suite de la conversation perdue."""
+    sent = 0
+    while sent < limit:
+        n = min(batch, limit - sent)
+        if cursor is None:
+            c.execute(CONVERSATION_FIRST_SQL, (address, n))
+        else:
+            c.execute(CONVERSATION_NEXT_SQL, (address, cursor[0], cursor[0], cursor[1], n))
+        rows = c.fetchall()
+        if not rows:
+            return
+        yield rows
+        sent += len(rows)
+        cursor = conversation_cursor(rows[-1])
+        if len(rows) < n:
+            return
+
+
+def iter_conversation_shards(conns, address, cursor=None, limit=CONVERSATION_PAGE, batch=CONVERSATION_BATCH):
+    """iter_conversation enchaîné sur des bases annuelles par année croissante (donc dans l'ordre
+    (date_ms, id)) ; produit (connexion, lot) pour charger les médias dans la bonne base."""
+    sent = 0
+    for c in conns:
+        for rows in iter_conversation(c.cursor(), address, cursor, limit=limit - sent, batch=batch):
+            yield c, rows
+            sent += len(rows)
+        if sent >= limit:
+            return
+
+
+# requêtes fréquentes et plan attendu : --check-plans échoue si l'une d'elles n'utilise plus son index
+QUERY_PLAN_CHECKS = [
+    ('conversation, lot suivant', CONVERSATION_NEXT_SQL, ('', 0, 0, 0, 1),
+     'SEARCH messages USING INDEX idx_messages_address_day (address=? AND <expr>>?)'),
+    ('dédoublonnage (is_known)', BatchWriter.KNOWN_SQL, ('', None, 'sms', 'in', ''),
+     'SEARCH messages USING INDEX idx_messages_natural (address=? AND <expr>=?'),
+]
+
+
+def check_query_plans(db_path):
+    """EXPLAIN QUERY PLAN des requêtes de QUERY_PLAN_CHECKS sur la base (sur chaque base annuelle
+    pour un catalogue) ; affiche les plans et renvoie le nombre de requêtes sans leur index."""
+    shards = read_shards(db_path)
+    failures = 0
+    for path in ([s['path'] for s in shards] if shards is not None else [db_path]):
+        conn = sqlite3.connect(path)
+        for name, sql, params, expected in QUERY_PLAN_CHECKS:
+            plan = ' | '.join(r[3] for r in conn.execute('EXPLAIN QUERY PLAN ' + sql, params))
+            ok = expected in plan
+            failures += not ok
+            print(f"{'OK   ' if ok else 'ÉCHEC'} {os.path.basename(path)} — {name} : {plan}")
+        conn.close()
+    if failures:
+        print(f"{failures} requête(s) sans leur index : une base antérieure est migrée par un nouvel --import "
+              f"(index recréés à l'ouverture)")
+    return failures
+
+
+GZIP_MIN_BYTES = 1024   # réponses plus petites envoyées telles quelles
+GZIP_LEVEL = 6
+COMPRESSIBLE_TYPES = ('text/html', 'application/json')
+# pages dont le contenu ne dépend que des données (compteur 'generation') et du code de rendu :
+# ETag faible, revalidé à chaque visite (304 sans toucher aux messages tant qu'aucun import n'a eu lieu)
+VALIDATED_ENDPOINTS = {'index', 'contacts_index', 'search', 'api_search', 'contact', 'conversation'}
+PAGE_ETAG_SALT = hashlib.sha1(json.dumps([RENDER_VERSION, FLASK_TEMPLATES], sort_keys=True).encode()).hexdigest()[:12]
+
+
+def gzip_stream(chunks, level=GZIP_LEVEL):
+    """Compresse une réponse en flux (gzip) sans la tenir en mémoire."""
+    z = zlib.compressobj(level, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        out = z.compress(chunk)
+        if out:
+            yield out
+    yield z.flush()
+
+
+def create_app(db_path, media_dir, pool_size=DEFAULT_POOL_SIZE, search_cache=DEFAULT_SEARCH_CACHE,
+               search_cache_mb=DEFAULT_SEARCH_CACHE_MB, search_cache_ttl=DEFAULT_SEARCH_CACHE_TTL):
+    from flask import (Flask, Response, request, render_template_string, send_from_directory, abort, g,
+                       redirect, url_for, stream_with_context, jsonify)
     app = Flask(__name__)
+    pool = ReadPool(db_path, size=pool_size)
+    cache = SearchCache(search_cache, search_cache_mb, search_cache_ttl)
+    has_thumb = stored_html = False
+    # archive découpée par année : db_path est le catalogue, une pool par base annuelle
+    shards, shard_pools = None, {}
+    fanout = ThreadPoolExecutor(max_workers=pool_size, thread_name_prefix='shards')
+    # requêtes concurrentes qui voient la même nouvelle génération : une seule relit le schéma
+    schema_lock = threading.Lock()
+
+    def read_schema():
+        nonlocal has_thumb, stored_html, shards, shard_pools
+        with schema_lock:
+            found = read_shards(db_path)
+            pools = shard_pools
+            if found is not None:
+                # nouvelles années ajoutées par un import : pools créées à la demande, les autres gardées
+                # (y compris celles d'années disparues, qu'une requête en cours peut encore utiliser)
+                pools = dict(shard_pools)
+                for sh in found:
+                    if sh['year'] not in pools:
+                        pools[sh['year']] = ReadPool(sh['path'], size=pool_size)
+            # publiées ensemble, les pools d'abord : qui voit la nouvelle liste trouve ses pools
+            shard_pools, shards = pools, found
+            if found is not None and not found:
+                return
+            with closing(pools[found[0]['year']].acquire() if found else pool.acquire()) as c:
+                # base importée avant les miniatures : images originales
+                has_thumb = 'thumb' in [r[1] for r in c.execute('PRAGMA table_info(media)')]
+                # HTML stocké à l'import utilisable seulement s'il vient du moteur de rendu actuel
+                try:
+                    stored_html = get_meta(c, 'render_version') == str(RENDER_VERSION)
+                except sqlite3.OperationalError:
+                    stored_html = False
+
+    def read_generation():
+        try:
+            return get_meta(get_db(), 'generation')
+        except sqlite3.OperationalError:
+            return None
+
+    read_schema()
+
+    def get_db():
+        if 'db' not in g:
+            g.db = pool.acquire()
+        return g.db
+
+    def shard_db(year):
+        """Connexion (empruntée pour la requête) à la base annuelle year."""
+        held = g.setdefault('shard_dbs', {})
+        if year not in held:
+            p = shard_pools[year]
+            held[year] = (p, p.acquire())
+        return held[year][1]
+
+    def run_search(**p):
+        if shards is None:
+            return search_messages(get_db().cursor(), **p)
+        selected = prune_shards(shards, p.get('date_from'), p.get('date_to'))
+        return search_shards([(sh, shard_db(sh['year'])) for sh in selected], executor=fanout, **p)
 
-    def make_body_html(b):
-        if not b:
-            return ''
-        # escape then convert urls
-        t = html.escape(b)
-        t = re.sub(r'(https?://[^\s<]+)', r'<a href="\1" target="_blank">\1</a>', t)
-        return t.replace('\n', '<br>')
+    def message_db(mid):
+        """Base qui contient le message mid (None si l'année n'existe pas)."""
+        if shards is None:
+            return get_db()
+        return shard_db(shard_of(mid)) if shard_of(mid) in shard_pools else None
+
+    @app.before_request
+    def page_validators():
+        if request.endpoint not in VALIDATED_ENDPOINTS:
+            return None
+        generation = read_generation()
+        if generation is None:
+            # base antérieure au compteur : pas de validateur fiable
+            return None
+        g.etag = f'W/"{generation}-{PAGE_ETAG_SALT}"'
+        if etag_matches(request.headers.get('If-None-Match'), g.etag):
+            return Response(status=304, headers={'ETag': g.etag, 'Cache-Control': 'no-cache', 'Vary': 'Accept-Encoding'})
+        return None
+
+    @app.after_request
+    def http_cache(resp):
+        etag = g.pop('etag', None)
+        if etag and resp.status_code in (200, 302):
+            resp.headers['ETag'] = etag
+            resp.headers['Cache-Control'] = 'no-cache'
+        if (resp.status_code == 200 and resp.mimetype in COMPRESSIBLE_TYPES and not resp.direct_passthrough
+                and 'Content-Encoding' not in resp.headers):
+            resp.vary.add('Accept-Encoding')
+            if request.accept_encodings['gzip'] <= 0:
+                return resp
+            if resp.is_streamed:
+                resp.response = gzip_stream(resp.iter_encoded())
+                resp.headers.pop('Content-Length', None)
+            else:
+                data = resp.get_data()
+                if len(data) < GZIP_MIN_BYTES:
+                    return resp
+                resp.set_data(gzip.compress(data, GZIP_LEVEL, mtime=0))
+            resp.headers['Content-Encoding'] = 'gzip'
+        return resp
+
+    @app.teardown_appcontext
+    def release_db(exc):
+        conn = g.pop('db', None)
+        if conn is not None:
+            pool.release(conn)
+        for p, conn in g.pop('shard_dbs', {}).values():
+            p.release(conn)
+
+    def hydrate(c, rows):
+        """Lignes messages -> dicts pour les templates (médias chargés en une seule requête)."""
+        rows = [dict(r) for r in rows]
+        media = fetch_media(c, (r['id'] for r in rows), has_thumb=has_thumb)
+        for rr in rows:
+            rr['media'] = media.get(rr['id'], [])
+            if not stored_html or rr.get('body_html') is None:
+                rr['body_html'] = render_text(rr.get('body') or '')
+        return rows
 
     @app.route('/')
     def index():
-        return render_template_string(FLASK_TEMPLATES['index'], q='')
+        sort = request.args.get('sort', 'messages')
+        contacts, summary, more = load_contacts(get_db().cursor(), sort, limit=LANDING_CONTACTS)
+        return render_template_string(FLASK_TEMPLATES['index'], q='', contacts=contacts, summary=summary, more=more, sort=sort, f={})
+
+    @app.route('/contacts')
+    def contacts_index():
+        sort = request.args.get('sort', 'messages')
+        contacts, summary, _ = load_contacts(get_db().cursor(), sort)
+        return render_template_string(FLASK_TEMPLATES['index'], q='', contacts=contacts, summary=summary, more=False, sort=sort, f={})
+
+    def search_args():
+        """Paramètres communs à /search et /api/search ; abort(400) si invalides."""
+        a = request.args
+        sort = a.get('sort') if a.get('sort') in ('rank', 'date') else 'rank'
+        try:
+            p = {
+                'q': SearchCache.normalize(a.get('q', '')),
+                'address': a.get('contact') or None,
+                'direction': a.get('direction') if a.get('direction') in ('in', 'out') else None,
+                'date_from': parse_day(a.get('from')),
+                'date_to': parse_day(a.get('to'), end=True),
+                'sort': sort,
+                'cursor': parse_search_cursor(a.get('after'), sort),
+                'limit': max(1, min(int(a.get('limit') or SEARCH_PAGE), SEARCH_PAGE_MAX)),
+            }
+        except ValueError:
+            abort(400)
+        if cache.validate(read_generation):
+            # un import a pu ajouter miniatures / HTML stocké
+            read_schema()
+        return p
+
+    def cached(key, produce):
+        body = cache.get(key)
+        if body is None:
+            body = produce()
+            cache.put(key, body, len(body))
+        return body
+
+    def search_filters(p):
+        """Filtres du formulaire reconstruits depuis les paramètres normalisés (clé du cache) : le HTML
+        mis en cache ne reprend rien de la requête brute (paramètres inconnus, ordre, valeurs invalides)."""
+        def day(ms):
+            return datetime.fromtimestamp(ms / 1000).strftime('%Y-%m-%d') if ms is not None else None
+        f = {'q': p['q'], 'contact': p['address'], 'direction': p['direction'], 'from': day(p['date_from']),
+             'to': day(p['date_to'] - 86400000 if p['date_to'] is not None else None), 'sort': p['sort']}
+        if p['limit'] != SEARCH_PAGE:
+            f['limit'] = p['limit']
+        return {k: v for k, v in f.items() if v is not None}
+
+    def next_url(path, p, after):
+        return url_for(path, after=after, **search_filters(p))
 
     @app.route('/search')
     def search():
-        q = request.args.get('q', '').strip()
-        rows = []
-        total = 0
-        if q:
-            conn = sqlite3.connect(db_path)
-            conn.row_factory = sqlite3.Row
-            c = conn.cursor()
-            # si FTS dispo, utiliser MATCH
-            try:
-                c.execute("SELECT rowid, * FROM messages_fts WHERE messages_fts MATCH ? LIMIT 200", (q,))
-                ids = [r[0] for r in c.fetchall()]
-            except Exception:
-                # fallback LIKE
-                likeq = f'%{q}%'
-                c.execute("SELECT id FROM messages WHERE body LIKE ? OR address LIKE ? OR contact_name LIKE ? LIMIT 200", (likeq, likeq, likeq))
-                ids = [r[0] for r in c.fetchall()]
-            if ids:
-                placeholders = ','.join('?' for _ in ids)
-                c.execute(f"SELECT * FROM messages WHERE id IN ({placeholders}) ORDER BY date_ms DESC", ids)
-                for r in c.fetchall():
-                    rr = dict(r)
-                    # fetch media
-                    c.execute('SELECT filename FROM media WHERE message_id=?', (rr['id'],))
-                    media = [m[0] for m in c.fetchall()]
-                    rr['media'] = media
-                    rr['body_html'] = make_body_html(rr.get('body') or '')
-                    rows.append(rr)
-            total = len(rows)
-            conn.close()
-        return render_template_string(FLASK_TEMPLATES['index'], q=q, rows=rows, total=total)
+        p = search_args()
+        key = ('search',) + tuple(sorted((k, str(v)) for k, v in p.items()))
+        return cached(key, lambda: render_search(p))
+
+    @app.route('/api/search')
+    def api_search():
+        """JSON : {query, mode, total?, next, results: [{id, address, contact_name, date_ms, date_iso, direction, typ, score, snippet}]}.
+        full=1 : corps entier surligné (highlight) au lieu de l'extrait ; count=1 : nombre total de résultats."""
+        p = search_args()
+        if not p['q']:
+            return jsonify({'error': 'paramètre q requis'}), 400
+        full = request.args.get('full') == '1'
+        count = request.args.get('count') == '1'
+        key = ('api', full, count) + tuple(sorted((k, str(v)) for k, v in p.items()))
+
+        def produce():
+            res = run_search(full=full, count=count, **p)
+            out = {'query': p['q'], 'mode': res['mode'], 'next': res['next'], 'results': res['rows']}
+            if count:
+                out['total'] = res['total']
+            return json.dumps(out, ensure_ascii=False)
+        return Response(cached(key, produce), mimetype='application/json')
+
+    @app.route('/stats/cache')
+    def cache_stats():
+        return jsonify(cache.stats())
+
+    def render_search(p):
+        rows, total, nxt = [], None, None
+        if p['q']:
+            # total seulement sur la première page (les suivantes ne paient que leur LIMIT)
+            res = run_search(count=p['cursor'] is None, **p)
+            rows, total = res['rows'], res['total']
+            media = {}
+            by_db = {}
+            for r in rows:
+                by_db.setdefault(shard_of(r['id']) if shards is not None else None, []).append(r['id'])
+            for ids in by_db.values():
+                media.update(fetch_media(message_db(ids[0]), ids, has_thumb=has_thumb))
+            for r in rows:
+                r['media'] = media.get(r['id'], [])
+            if res['next']:
+                nxt = next_url('search', p, res['next'])
+        f = search_filters(p)
+        return render_template_string(FLASK_TEMPLATES['index'], q=p['q'], rows=rows, total=total, next=nxt, f=f)
 
     @app.route('/contact/<int:cid>')
     def contact(cid):
-        conn = sqlite3.connect(db_path)
-        conn.row_factory = sqlite3.Row
-        c = conn.cursor()
-        c.execute('SELECT * FROM messages WHERE id=? ORDER BY date_ms', (cid,))
-        rows = []
-        for r in c.fetchall():
-            rr = dict(r)
-            c.execute('SELECT filename FROM media WHERE message_id=?', (rr['id'],))
-            rr['media'] = [m[0] for m in c.fetchall()]
-            rr['body_html'] = make_body_html(rr.get('body') or '')
-            rows.append(rr)
-        conn.close()
-        if not rows:
+        # cid = id d'un message : ouvre la conversation de son correspondant
+        c = message_db(cid)
+        row = c.execute('SELECT address FROM messages WHERE id=?', (cid,)).fetchone() if c is not None else None
+        if row is None:
             abort(404)
-        # who = contact_name or address
-        who = rows[0].get('contact_name') or rows[0].get('address')
-        return render_template_string(FLASK_TEMPLATES['contact'], rows=rows, who=who)
+        return redirect(url_for('conversation', address=row['address']))
+
+    @app.route('/conversation/<path:address>')
+    def conversation(address):
+        try:
+            cursor = parse_cursor(request.args.get('after'))
+        except ValueError:
+            abort(400)
+        c = get_db().cursor()
+        if shards is None:
+            if c.execute('SELECT 1 FROM messages WHERE address=? LIMIT 1', (address,)).fetchone() is None:
+                abort(404)
+            named = c.execute("SELECT contact_name FROM messages WHERE address=? AND contact_name != '' LIMIT 1", (address,)).fetchone()
+            who = named['contact_name'] if named else address
+            conns = [get_db()]
+        else:
+            # catalogue : agrégats du contact et années où il a écrit (les autres bases ne sont pas ouvertes)
+            named = c.execute('SELECT contact_name FROM contacts WHERE address=?', (address,)).fetchone()
+            if named is None:
+                abort(404)
+            who = named['contact_name'] or address
+            years = {int(r[0]) for r in c.execute('SELECT year FROM contact_years WHERE address=?', (address,))}
+            conns = [shard_db(sh['year']) for sh in shards
+                     if (sh['year'] in years or sh['year'] == 0) and sh['year'] in shard_pools
+                     and not (cursor and sh['last_date_ms'] is not None and sh['last_date_ms'] < cursor[0])]
+        page = {'next': None}
+
+        def rows():
+            # rendu au fil de l'eau : au plus CONVERSATION_BATCH lignes en mémoire
+            n = 0
+            last = None
+            for conn, batch in iter_conversation_shards(conns, address, cursor):
+                for rr in hydrate(conn, batch):
+                    yield rr
+                n += len(batch)
+                last = batch[-1]
+            if n >= CONVERSATION_PAGE and last is not None:
+                page['next'] = url_for('conversation', address=address, after='%d.%d' % conversation_cursor(last))
+
+        tmpl = app.jinja_env.from_string(FLASK_TEMPLATES['contact'])
+        return Response(stream_with_context(tmpl.generate(rows=rows(), who=who, page=page)), mimetype='text/html')
 
     @app.route('/media/<path:filename>')
     def media(filename):
@@ -363,10 +1823,31 @@ def run_server(db_path, media_dir, host='127.0.0.1', port=5000):
         safe = os.path.normpath(filename)
         if '..' in safe or safe.startswith('/'):
             abort(404)
-        return send_from_directory(media_dir, filename)
+        try:
+            st = os.stat(os.path.join(media_dir, safe))
+        except OSError:
+            abort(404)
+        etag, cache_control = media_validators(safe, st)
+        resp = send_from_directory(media_dir, filename, etag=etag, conditional=True)
+        resp.headers['Cache-Control'] = cache_control
+        return resp
+
+    return app
+
 
+def run_server(db_path, media_dir, host='127.0.0.1', port=5000, pool_size=DEFAULT_POOL_SIZE,
+               search_cache=DEFAULT_SEARCH_CACHE, search_cache_mb=DEFAULT_SEARCH_CACHE_MB,
+               search_cache_ttl=DEFAULT_SEARCH_CACHE_TTL, server='flask', workers=1, threads=DEFAULT_SERVER_THREADS):
+    make_app = partial(create_app, db_path, media_dir, pool_size=pool_size, search_cache=search_cache,
+                       search_cache_mb=search_cache_mb, search_cache_ttl=search_cache_ttl)
+    if server == 'async':
+        # boucle asyncio + pool de threads SQLite borné, médias en sendfile ; une application par processus
+        from serveur_async import serve
+        print(f"DB: {db_path}, media: {media_dir}")
+        serve(make_app, media_dir, host=host, port=port, workers=workers, threads=threads)
+        return
     print(f"Serving on http://{host}:{port} (DB: {db_path}, media: {media_dir})")
-    app.run(host=host, port=port)
+    make_app().run(host=host, port=port)
 
 # -------------------- CLI --------------------
 
@@ -374,24 +1855,78 @@ def main():
     ap = argparse.ArgumentParser()
     ap.add_argument('--xml')
     ap.add_argument('--out', default='./export')
-    ap.add_argument('--split-by-year', action='store_true')
+    ap.add_argument('--split-by-year', action='store_true', help='Une base SQLite par année (years/), catalogue dans messages.db')
+    ap.add_argument('--shard-writers', type=int, default=DEFAULT_SHARD_WRITERS, help='Processus écrivains des bases annuelles (--split-by-year)')
     ap.add_argument('--limit', type=int, default=0)
+    ap.add_argument('--batch-size', type=int, default=DEFAULT_BATCH_SIZE, help='Messages par transaction (executemany) lors de --import')
+    ap.add_argument('--defer-fts', action='store_true', help="Pas d'écriture FTS ligne à ligne : rebuild + optimize en fin d'import")
+    ap.add_argument('--fts-tokenize', default=None, help="Tokenizer FTS5, ex: 'unicode61 remove_diacritics 2' ou 'porter unicode61'")
+    ap.add_argument('--fts-prefix', default=None, help="Index de préfixes FTS5, ex: '2 3'")
+    ap.add_argument('--incremental', action='store_true', help='Ignore les messages antérieurs au plus récent déjà importé')
+    ap.add_argument('--resume', action='store_true', help="Reprend un import interrompu du même XML au dernier point de reprise")
+    ap.add_argument('--workers', type=int, default=1, help='Processus de décodage XML/base64 (1 = tout dans le processus principal) ; avec --serve --server async : processus de service')
+    ap.add_argument('--spool-mb', type=float, default=DEFAULT_SPOOL_BYTES / 2**20, help='Pièces jointes plus grosses décodées en flux sur disque (Mo)')
+    ap.add_argument('--chunk-mb', type=float, default=DEFAULT_CHUNK_BYTES / 2**20, help='Taille des paquets XML envoyés aux workers (Mo)')
+    ap.add_argument('--store-html', action='store_true', help="Stocke le HTML rendu de chaque message (body_html) : plus de rendu par requête")
+    ap.add_argument('--thumb-size', type=int, default=DEFAULT_THUMB_PX, help="Côté max des miniatures d'images (px, nécessite Pillow) ; 0 = aucune")
     ap.add_argument('--import', dest='do_import', action='store_true')
     ap.add_argument('--serve', dest='do_serve', action='store_true')
+    ap.add_argument('--gc-media', dest='do_gc_media', action='store_true', help='Supprime les médias non référencés (après dédoublonnage / import interrompu)')
+    ap.add_argument('--make-thumbs', dest='do_make_thumbs', action='store_true', help="Génère les miniatures manquantes d'une base existante")
+    ap.add_argument('--check-plans', dest='do_check_plans', action='store_true',
+                    help="Vérifie (EXPLAIN QUERY PLAN) que les requêtes de conversation / dédoublonnage utilisent leurs index")
     ap.add_argument('--db', default=None)
     ap.add_argument('--media', default=None)
     ap.add_argument('--host', default='127.0.0.1')
     ap.add_argument('--port', type=int, default=5000)
+    ap.add_argument('--server', choices=('flask', 'async'), default='flask',
+                    help="flask : serveur de développement ; async : boucle asyncio, médias en sendfile + Range, --workers processus")
+    ap.add_argument('--threads', type=int, default=DEFAULT_SERVER_THREADS, help='Threads SQLite par processus (--server async)')
+    ap.add_argument('--pool-size', type=int, default=DEFAULT_POOL_SIZE, help='Connexions SQLite lecture seule gardées ouvertes par le serveur')
+    ap.add_argument('--search-cache', type=int, default=DEFAULT_SEARCH_CACHE, help='Réponses de recherche gardées en cache (0 = désactivé)')
+    ap.add_argument('--search-cache-mb', type=float, default=DEFAULT_SEARCH_CACHE_MB, help='Taille max du cache de recherche (Mo)')
+    ap.add_argument('--search-cache-ttl', type=float, default=DEFAULT_SEARCH_CACHE_TTL, help='Durée de vie d\'une réponse en cache (s)')
     args = ap.parse_args()
 
     if args.do_import:
         if not args.xml:
             print('Erreur: --xml requis pour --import')
             sys.exit(1)
-        db_path, media_dir = import_xml_to_sqlite(args.xml, args.out, split_by_year=args.split_by_year, limit=args.limit)
+        db_path, media_dir = import_xml_to_sqlite(args.xml, args.out, split_by_year=args.split_by_year, limit=args.limit,
+                                                 batch_size=args.batch_size, defer_fts=args.defer_fts,
+                                                 fts_tokenize=args.fts_tokenize, fts_prefix=args.fts_prefix,
+                                                 workers=args.workers, chunk_bytes=int(args.chunk_mb * 2**20),
+                                                 incremental=args.incremental, resume=args.resume,
+                                                 spool_threshold=int(args.spool_mb * 2**20),
+                                                 thumb_size=args.thumb_size, store_html=args.store_html,
+                                                 shard_writers=args.shard_writers)
         print('Import OK. DB at', db_path)
         sys.exit(0)
 
+    if args.do_gc_media:
+        gc_media(args.db or os.path.join(args.out, 'messages.db'), args.media or os.path.join(args.out, 'media'))
+        sys.exit(0)
+
+    if args.do_check_plans:
+        sys.exit(1 if check_query_plans(args.db or os.path.join(args.out, 'messages.db')) else 0)
+
+    if args.do_make_thumbs:
+        dbp = args.db or os.path.join(args.out, 'messages.db')
+        shards = read_shards(dbp)
+        for path in ([s['path'] for s in shards] if shards is not None else [dbp]):
+            conn = sqlite3.connect(path, isolation_level=None)
+            ensure_blob_store(conn.cursor())
+            ensure_thumb_column(conn.cursor())
+            make_thumbnails(conn, args.media or os.path.join(args.out, 'media'), size=args.thumb_size or DEFAULT_THUMB_PX,
+                            workers=args.workers)
+            conn.close()
+        if shards is not None:
+            # génération du catalogue : invalide les caches du serveur
+            catalog = open_catalog(dbp)
+            update_catalog(catalog, os.path.dirname(os.path.abspath(dbp)))
+            catalog.close()
+        sys.exit(0)
+
     if args.do_serve:
         dbp = args.db or os.path.join(args.out, 'messages.db')
         med = args.media or os.path.join(args.out, 'media')
@@ -399,7 +1934,9 @@ def main():
             print('DB introuvable:', dbp); sys.exit(1)
         if not os.path.exists(med):
             print('Media dir introuvable:', med); sys.exit(1)
-        run_server(dbp, med, host=args.host, port=args.port)
+        run_server(dbp, med, host=args.host, port=args.port, pool_size=args.pool_size, search_cache=args.search_cache,
+                   search_cache_mb=args.search_cache_mb, search_cache_ttl=args.search_cache_ttl,
+                   server=args.server, workers=args.workers, threads=args.threads)
         sys.exit(0)
 
     ap.print_help()
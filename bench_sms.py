@@ -0,0 +1,248 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+bench_sms.py
+
+Banc d'essai des chaînes SMS : import SQLite, export HTML, sms_xml_vers_db.py et serveur web.
+
+Usage:
+  # sauvegarde synthétique générée à la volée (voir generer_sms_xml.py pour les options)
+  python3 bench_sms.py --count 200000 --mms-ratio 0.1 --attachment-kb 100
+
+  # sur une vraie sauvegarde, avec 8 workers, résultats en JSON
+  python3 bench_sms.py --xml backup.xml --workers 8 --json resultats.json
+
+Chaque chaîne est lancée dans un sous-processus ; on mesure le temps, le débit (messages/s,
+Mo/s de XML), le pic de mémoire (RSS) et la taille produite. Le serveur (--serve, nécessite
+Flask) est ensuite interrogé sur /search, /conversation et /media : latences p50/p95/p99 et
+débit, avec --concurrency clients simultanés ; --servers flask,async compare les deux modes.
+"""
+
+import os
+import sys
+import json
+import time
+import random
+import socket
+import sqlite3
+import argparse
+import tempfile
+import subprocess
+import urllib.parse
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import closing
+
+from sms_commun import RECORD_START, iter_record_chunks
+from generer_sms_xml import WORDS, generate
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+EXPORTER = os.path.join(HERE, 'Sms Sqlite Flask Exporter.py')
+HTML_EXPORT = os.path.join(HERE, 'export_sms_html.py')
+VERS_DB = os.path.join(HERE, 'sms_xml_vers_db.py')
+
+
+def count_records(xml_path):
+    return sum(len(RECORD_START.findall(chunk)) for _, _, chunk in iter_record_chunks(xml_path))
+
+
+def dir_size(path):
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for dirpath, _, files in os.walk(path):
+        for fn in files:
+            total += os.path.getsize(os.path.join(dirpath, fn))
+    return total
+
+
+def run_measured(cmd, cwd=None):
+    """Lance cmd, renvoie (secondes, pic RSS en octets, code retour, fin de sortie)."""
+    t0 = time.perf_counter()
+    p = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    out = p.stdout.read().decode('utf-8', 'replace')
+    # wait4 : ressources de ce seul enfant (ru_maxrss en Ko sous Linux)
+    _, status, ru = os.wait4(p.pid, 0)
+    p.returncode = os.waitstatus_to_exitcode(status)  # déjà récolté : Popen ne doit plus attendre
+    return time.perf_counter() - t0, ru.ru_maxrss * 1024, p.returncode, out.strip().splitlines()[-3:]
+
+
+def bench_pipeline(name, cmd, out_path, xml_path, n_msgs, results, cwd=None):
+    secs, rss, rc, tail = run_measured(cmd, cwd=cwd)
+    xml_mb = os.path.getsize(xml_path) / 1e6
+    res = {
+        'pipeline': name, 'secondes': round(secs, 3), 'messages_s': round(n_msgs / secs, 1),
+        'mo_s_xml': round(xml_mb / secs, 2), 'rss_max_mo': round(rss / 2**20, 1),
+        'sortie_mo': round(dir_size(out_path) / 1e6, 2) if os.path.exists(out_path) else None, 'code': rc,
+    }
+    results.append(res)
+    print(f"{name:<18} {secs:8.2f}s {res['messages_s']:>11,.0f} msg/s {res['mo_s_xml']:>8.2f} Mo/s "
+          f"RSS {res['rss_max_mo']:>7.1f} Mo  sortie {res['sortie_mo']} Mo" + ('' if rc == 0 else f'  ÉCHEC rc={rc}'))
+    if rc != 0:
+        print('   ' + '\n   '.join(tail))
+    return res
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def percentiles(samples):
+    samples = sorted(samples)
+    if not samples:
+        return {}
+
+    def pct(p):
+        return round(samples[min(len(samples) - 1, int(p / 100 * len(samples)))] * 1000, 2)
+    return {'n': len(samples), 'p50_ms': pct(50), 'p95_ms': pct(95), 'p99_ms': pct(99), 'max_ms': round(samples[-1] * 1000, 2)}
+
+
+def check_plans(python, out_dir, results):
+    """--check-plans de l'exportateur sur la base importée : les requêtes chaudes gardent leurs index."""
+    secs, _, rc, tail = run_measured([python, EXPORTER, '--check-plans', '--out', out_dir])
+    results.append({'pipeline': 'plans', 'secondes': round(secs, 3), 'code': rc})
+    print(f"{'plans SQL':<18} {'OK' if rc == 0 else f'ÉCHEC rc={rc}'}")
+    if rc != 0:
+        print('   ' + '\n   '.join(tail))
+
+
+def sample_archive(db_path):
+    """(20 correspondants les plus actifs, 200 fichiers média) d'une archive, en un seul fichier ou
+    découpée par année : le catalogue n'a pas de table messages, on lit ses agrégats et ses bases
+    annuelles (table shards, cf. read_shards de l'exportateur)."""
+    with closing(sqlite3.connect(db_path)) as conn:
+        if conn.execute("SELECT 1 FROM sqlite_master WHERE name='shards'").fetchone() is None:
+            addresses = [r[0] for r in conn.execute('SELECT address FROM messages GROUP BY address '
+                                                    'ORDER BY COUNT(*) DESC LIMIT 20')]
+            return addresses, [r[0] for r in conn.execute('SELECT filename FROM media ORDER BY id LIMIT 200')]
+        addresses = [r[0] for r in conn.execute('SELECT address FROM contacts ORDER BY messages DESC LIMIT 20')]
+        paths = [os.path.join(os.path.dirname(db_path), r[0]) for r in conn.execute('SELECT filename FROM shards ORDER BY year')]
+    media = []
+    for path in paths:
+        if len(media) >= 200:
+            break
+        with closing(sqlite3.connect(path)) as conn:
+            media += [r[0] for r in conn.execute('SELECT filename FROM media ORDER BY id LIMIT ?', (200 - len(media),))]
+    return addresses, media
+
+
+def bench_server(python, out_dir, n_requests, results, extra_args=(), server='flask', concurrency=1):
+    addresses, media = sample_archive(os.path.join(out_dir, 'messages.db'))
+    port = free_port()
+    proc = subprocess.Popen([python, EXPORTER, '--serve', '--out', out_dir, '--port', str(port), '--server', server, *extra_args],
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base = f'http://127.0.0.1:{port}'
+    try:
+        deadline = time.time() + 30
+        while True:
+            try:
+                urllib.request.urlopen(base + '/', timeout=2).read()
+                break
+            except OSError:
+                if proc.poll() is not None or time.time() > deadline:
+                    print('serveur            non démarré (Flask installé ?) — ignoré')
+                    return
+                time.sleep(0.2)
+        rnd = random.Random(1)
+        routes = {
+            '/search': lambda: '/search?' + urllib.parse.urlencode({'q': rnd.choice(WORDS)}),
+            '/conversation': lambda: '/conversation/' + urllib.parse.quote(rnd.choice(addresses), safe=''),
+            '/media': lambda: '/media/' + urllib.parse.quote(rnd.choice(media)),
+        }
+
+        def fetch(url):
+            t0 = time.perf_counter()
+            with urllib.request.urlopen(url, timeout=60) as r:
+                r.read()
+            return time.perf_counter() - t0
+
+        for route, make_url in routes.items():
+            if (route == '/conversation' and not addresses) or (route == '/media' and not media):
+                continue
+            urls = [base + make_url() for _ in range(n_requests)]
+            t0 = time.perf_counter()
+            with ThreadPoolExecutor(max_workers=concurrency) as ex:
+                samples = list(ex.map(fetch, urls))
+            rps = round(len(samples) / (time.perf_counter() - t0), 1)
+            res = {'pipeline': f'serveur {server} {route}', 'concurrence': concurrency, **percentiles(samples), 'req_s': rps}
+            results.append(res)
+            print(f"{server + ' ' + route:<18} n={res['n']} p50 {res['p50_ms']} ms  p95 {res['p95_ms']} ms  "
+                  f"p99 {res['p99_ms']} ms  max {res['max_ms']} ms  {rps} req/s")
+    finally:
+        proc.terminate()
+        proc.wait()
+
+
+def main():
+    ap = argparse.ArgumentParser(description='Benchmark import / export / serveur sur une sauvegarde SMS.')
+    ap.add_argument('--xml', help='Sauvegarde existante ; sinon une sauvegarde synthétique est générée')
+    ap.add_argument('--count', type=int, default=50000, help='Messages synthétiques')
+    ap.add_argument('--contacts', type=int, default=200)
+    ap.add_argument('--skew', type=float, default=1.0)
+    ap.add_argument('--mms-ratio', type=float, default=0.1)
+    ap.add_argument('--attachment-kb', type=float, default=50)
+    ap.add_argument('--repeat-ratio', type=float, default=0.2)
+    ap.add_argument('--workers', type=int, default=1, help="--workers passé à l'import et à l'export HTML")
+    ap.add_argument('--pipelines', default='import,plans,export,vers_db,serveur',
+                    help='Chaînes à mesurer, parmi import,plans,export,vers_db,serveur (plans : index des requêtes chaudes)')
+    ap.add_argument('--requests', type=int, default=200, help='Requêtes HTTP par route')
+    ap.add_argument('--servers', default='flask', help='Modes de serveur à comparer, parmi flask,async')
+    ap.add_argument('--concurrency', type=int, default=1, help='Clients HTTP simultanés')
+    ap.add_argument('--server-workers', type=int, default=1, help='Processus du serveur async')
+    ap.add_argument('--python', default=sys.executable, help='Interpréteur des sous-processus (ex: un venv avec Flask)')
+    ap.add_argument('--workdir', help='Dossier de travail (temporaire par défaut)')
+    ap.add_argument('--json', help='Écrit les résultats dans ce fichier JSON')
+    args = ap.parse_args()
+
+    pipelines = set(args.pipelines.split(','))
+    workdir = args.workdir or tempfile.mkdtemp(prefix='bench_sms_')
+    os.makedirs(workdir, exist_ok=True)
+    xml_path = args.xml
+    if not xml_path:
+        xml_path = os.path.join(workdir, 'bench.xml')
+        t0 = time.perf_counter()
+        generate(xml_path, args.count, contacts=args.contacts, skew=args.skew, mms_ratio=args.mms_ratio,
+                 attachment_kb=args.attachment_kb, repeat_ratio=args.repeat_ratio)
+        print(f'Sauvegarde synthétique : {xml_path} ({time.perf_counter() - t0:.1f}s)')
+    xml_path = os.path.abspath(xml_path)
+    n_msgs = count_records(xml_path)
+    print(f'{n_msgs} messages, {os.path.getsize(xml_path) / 1e6:.1f} Mo de XML, dossier de travail {workdir}\n')
+
+    results = []
+    import_out = os.path.join(workdir, 'import')
+    if pipelines & {'import', 'plans', 'serveur'}:
+        bench_pipeline('import', [args.python, EXPORTER, '--import', '--xml', xml_path, '--out', import_out,
+                                  '--workers', str(args.workers)], import_out, xml_path, n_msgs, results)
+    if 'plans' in pipelines:
+        check_plans(args.python, import_out, results)
+    if 'export' in pipelines:
+        out = os.path.join(workdir, 'html')
+        bench_pipeline('export_html', [args.python, HTML_EXPORT, '--xml', xml_path, '--out', out,
+                                       '--workers', str(args.workers)], out, xml_path, n_msgs, results)
+    if 'vers_db' in pipelines:
+        # script à chemins fixes : sms.xml -> messages.db dans le dossier courant
+        cwd = os.path.join(workdir, 'vers_db')
+        os.makedirs(cwd, exist_ok=True)
+        link = os.path.join(cwd, 'sms.xml')
+        if not os.path.exists(link):
+            os.symlink(xml_path, link)
+        db = os.path.join(cwd, 'messages.db')
+        if os.path.exists(db):
+            os.remove(db)
+        bench_pipeline('vers_db', [args.python, VERS_DB], db, xml_path, n_msgs, results, cwd=cwd)
+    if 'serveur' in pipelines and os.path.exists(os.path.join(import_out, 'messages.db')):
+        for server in args.servers.split(','):
+            extra = ('--workers', str(args.server_workers)) if server == 'async' else ()
+            bench_server(args.python, import_out, args.requests, results, extra_args=extra, server=server,
+                         concurrency=args.concurrency)
+
+    if args.json:
+        with open(args.json, 'w', encoding='utf-8') as f:
+            json.dump({'xml': xml_path, 'messages': n_msgs, 'resultats': results}, f, ensure_ascii=False, indent=2)
+        print(f'\nRésultats -> {args.json}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,184 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+camera_protocol.py
+
+Protocole binaire partagé par "Camera test client.py" et "Camera test serveur.py" :
+chaque image part telle qu'encodée (JPEG brut), précédée d'un en-tête fixe de 20 octets.
+Pas de pickle : rien n'est désérialisé côté serveur, seul l'en-tête est interprété.
+
+En-tête (big-endian) :
+  magic      2 octets  b'CF'
+  version    1 octet   PROTOCOL_VERSION
+  codec      1 octet   CODEC_JPEG, CODEC_PNG...
+  seq        4 octets  numéro d'image (croissant, modulo 2**32)
+  timestamp  8 octets  instant de capture, ns depuis l'epoch (time.time_ns() du client)
+  length     4 octets  taille de l'image encodée qui suit
+
+L'en-tête et l'image sont envoyés ensemble par sendmsg (écriture groupée) : pas de
+concaténation, l'image encodée (tableau numpy, bytes...) est lue en place. À la réception,
+FrameReader remplit un tampon préalloué par recv_into et rend l'image sans la recopier.
+"""
+
+import time
+import struct
+import socket
+from collections import namedtuple
+
+MAGIC = b'CF'
+PROTOCOL_VERSION = 1
+HEADER = struct.Struct('>2sBBIQI')
+HEADER_SIZE = HEADER.size
+MAX_FRAME_BYTES = 64 * 1024 * 1024   # au-delà : flux corrompu ou pair hostile
+
+CODEC_HELLO = 0   # annonce du nom de la caméra (UTF-8), pour camera_relay.py ; ignorée sinon
+CODEC_JPEG = 1
+CODEC_PNG = 2
+CODEC_WEBP = 3
+# extension à passer à cv2.imencode pour chaque codec
+CODEC_EXT = {CODEC_JPEG: '.jpg', CODEC_PNG: '.png', CODEC_WEBP: '.webp'}
+
+FrameHeader = namedtuple('FrameHeader', 'seq timestamp_ns codec length')
+
+
+class ProtocolError(ValueError):
+    """En-tête invalide (mauvais magic, version inconnue, taille aberrante)."""
+
+
+def pack_header(seq, length, timestamp_ns=None, codec=CODEC_JPEG):
+    if timestamp_ns is None:
+        timestamp_ns = time.time_ns()
+    return HEADER.pack(MAGIC, PROTOCOL_VERSION, codec, seq & 0xFFFFFFFF, timestamp_ns, length)
+
+
+def unpack_header(data):
+    """En-tête brut (HEADER_SIZE octets) -> FrameHeader ; ProtocolError si invalide."""
+    magic, version, codec, seq, timestamp_ns, length = HEADER.unpack(data)
+    if magic != MAGIC:
+        raise ProtocolError(f'magic inattendu {magic!r} (ancien client pickle ?)')
+    if version != PROTOCOL_VERSION:
+        raise ProtocolError(f'version de protocole {version} non gérée')
+    if length > MAX_FRAME_BYTES:
+        raise ProtocolError(f'image de {length} octets annoncée (max {MAX_FRAME_BYTES})')
+    return FrameHeader(seq, timestamp_ns, codec, length)
+
+
+def send_frame(sock, payload, seq, timestamp_ns=None, codec=CODEC_JPEG):
+    """Envoie une image encodée (tout objet buffer : bytes, tableau numpy de cv2.imencode...).
+
+    Renvoie le nombre d'octets envoyés (en-tête compris).
+    """
+    body = memoryview(payload).cast('B')
+    header = pack_header(seq, len(body), timestamp_ns, codec)
+    total = HEADER_SIZE + len(body)
+    if not hasattr(sock, 'sendmsg'):
+        # Windows : pas d'écriture groupée
+        sock.sendall(header)
+        sock.sendall(body)
+        return total
+    sent = sock.sendmsg([header, body])
+    if sent < total:
+        # envoi partiel (signal, tampon plein sur socket non bloquante) : on termine à partir du reste
+        if sent < HEADER_SIZE:
+            sock.sendall(header[sent:])
+            sent = HEADER_SIZE
+        sock.sendall(body[sent - HEADER_SIZE:])
+    return total
+
+
+def send_hello(sock, name):
+    """Annonce le nom de la caméra au relais (camera_relay.py) avant la première image."""
+    return send_frame(sock, name.encode('utf-8'), 0, codec=CODEC_HELLO)
+
+
+def recv_exact(sock, n):
+    """Lit exactement n octets ; None si la connexion se ferme avant le premier octet."""
+    chunks = []
+    got = 0
+    while got < n:
+        chunk = sock.recv(min(n - got, 1024 * 1024))
+        if not chunk:
+            if got == 0:
+                return None
+            raise ConnectionError(f'connexion fermée au milieu d\'une image ({got}/{n} octets)')
+        chunks.append(chunk)
+        got += len(chunk)
+    return chunks[0] if len(chunks) == 1 else b''.join(chunks)
+
+
+def recv_frame(sock):
+    """Lit une image : (FrameHeader, octets encodés), ou None en fin de flux.
+    Pour un flux continu, préférer FrameReader (pas d'allocation par image)."""
+    raw = recv_exact(sock, HEADER_SIZE)
+    if raw is None:
+        return None
+    header = unpack_header(raw)
+    payload = recv_exact(sock, header.length) if header.length else b''
+    if payload is None:
+        raise ConnectionError('connexion fermée après un en-tête')
+    return header, payload
+
+
+class FrameReader:
+    """Réception sans recopie : un seul bytearray préalloué, rempli par recv_into.
+
+    Chaque recv_into lit tout ce que le tampon peut recevoir (plusieurs images par appel à haut
+    débit) ; le tampon grandit jusqu'à la plus grande image vue et ne rétrécit jamais. read_frame()
+    rend l'image sous forme de memoryview sur ce tampon, valable jusqu'à l'appel suivant : à
+    décoder (np.frombuffer + cv2.imdecode) ou copier avant de relire.
+    """
+
+    def __init__(self, sock, initial_bytes=256 * 1024):
+        self.sock = sock
+        self.buf = bytearray(initial_bytes)
+        self.view = memoryview(self.buf)
+        self.start = 0   # début des octets reçus non consommés
+        self.end = 0     # fin des octets reçus
+        self.largest = 0
+
+    def _fill(self, need):
+        """Au moins need octets disponibles à partir de start ; False si fin de flux avant le premier."""
+        if self.end - self.start >= need:
+            return True
+        if self.start + need > len(self.buf):
+            pending = self.end - self.start
+            if need > len(self.buf):
+                # image plus grande que toutes les précédentes : nouveau tampon (rare)
+                buf = bytearray(max(need, 2 * len(self.buf)))
+                buf[:pending] = self.view[self.start:self.end]
+                self.buf, self.view = buf, memoryview(buf)
+            else:
+                # seuls les octets déjà reçus de l'image suivante sont ramenés au début
+                self.view[:pending] = self.view[self.start:self.end]
+            self.start, self.end = 0, pending
+        while self.end - self.start < need:
+            n = self.sock.recv_into(self.view[self.end:])
+            if n == 0:
+                if self.end == self.start:
+                    return False
+                raise ConnectionError(f'connexion fermée au milieu d\'une image ({self.end - self.start}/{need} octets)')
+            self.end += n
+        return True
+
+    def read_frame(self):
+        """(FrameHeader, memoryview de l'image encodée), ou None en fin de flux."""
+        if not self._fill(HEADER_SIZE):
+            return None
+        header = unpack_header(self.view[self.start:self.start + HEADER_SIZE])
+        self.start += HEADER_SIZE
+        if header.length and not self._fill(header.length):
+            raise ConnectionError('connexion fermée après un en-tête')
+        payload = self.view[self.start:self.start + header.length]
+        self.start += header.length
+        self.largest = max(self.largest, header.length)
+        if self.start == self.end:
+            self.start = self.end = 0
+        return header, payload
+
+
+def tune_socket(sock):
+    """Envoi immédiat des petites images (pas d'attente de Nagle)."""
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError:
+        pass
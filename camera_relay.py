@@ -0,0 +1,518 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+camera_relay.py
+
+Relais asyncio pour les flux de "Camera test client.py" (protocole camera_protocol.py) :
+plusieurs caméras publient, plusieurs spectateurs regardent chacune, dans un seul processus.
+
+Usage:
+  # relais : caméras sur 8485 (comme "Camera test serveur.py"), spectateurs sur 8486
+  python3 camera_relay.py relay --camera-port 8485 --viewer-port 8486
+
+  # caméra synthétique : images d'un dossier / d'une vidéo (cv2), ou octets aléatoires
+  python3 camera_relay.py camera --name salon --source ./images --fps 30
+  python3 camera_relay.py camera --name test --frame-kb 60 --fps 60
+
+  # spectateur : affiche (--show, cv2) ou compte les images d'une caméra ; "?" liste les caméras
+  python3 camera_relay.py viewer --name salon --show
+
+  # banc d'essai sur la boucle locale : relais + caméras + spectateurs (dont des lents) dans ce processus
+  python3 camera_relay.py loopback --cameras 4 --viewers 3 --slow-viewers 1 --seconds 10
+
+Principes :
+- réception des caméras par asyncio.BufferedProtocol : chaque image est reçue directement dans
+  son propre bytearray (aucune recopie), puis partagée telle quelle par tous les spectateurs
+- une case "dernière image" par spectateur : une image pas encore envoyée est remplacée par la
+  suivante (comptée comme perdue) ; au plus une image en attente dans le relais et VIEWER_WINDOW
+  en transit par spectateur, donc une latence bornée quel que soit le nombre de caméras ou la lenteur d'un spectateur
+- en-têtes transmis sans modification : numéro et horodatage de capture d'origine (latence de
+  bout en bout mesurable chez le spectateur)
+
+Protocole spectateur : une ligne UTF-8 avec le nom de la caméra ; le relais répond par une ligne
+JSON puis, si la caméra est connectée ({"camera": nom}), envoie ses images camera_protocol ; le
+spectateur renvoie un octet par image traitée, le relais n'en laisse jamais plus de VIEWER_WINDOW
+non acquittées. Nom inconnu : {"error": ..., "cameras": [liste]} et fermeture. Avec "?", le relais
+répond par la liste JSON des caméras et ferme. Un spectateur reste abonné si sa caméra se
+déconnecte et reprend quand elle revient sous le même nom.
+Une caméra peut s'annoncer par une image CODEC_HELLO (voir camera_protocol.send_hello) ; sinon
+elle est nommée cam1, cam2... dans l'ordre de connexion.
+"""
+
+import os
+import sys
+import glob
+import json
+import time
+import random
+import socket
+import asyncio
+import argparse
+
+from camera_protocol import (HEADER_SIZE, CODEC_HELLO, CODEC_JPEG, CODEC_EXT, ProtocolError, pack_header,
+                             unpack_header)
+from camera_stats import percentile
+
+DEFAULT_CAMERA_PORT = 8485
+DEFAULT_VIEWER_PORT = 8486
+HELLO_TIMEOUT = 10   # secondes pour qu'un spectateur donne le nom de la caméra
+# images envoyées à un spectateur et pas encore acquittées : au-delà, le relais attend et ne garde que
+# la plus récente. Sans ce crédit, les tampons TCP (plusieurs centaines de Ko sur la boucle locale)
+# empileraient des dizaines d'images périmées devant un spectateur lent.
+VIEWER_WINDOW = 2
+
+
+# -------------------- Relais --------------------
+
+class UnknownCamera(LookupError):
+    """Le relais ne connaît pas la caméra demandée par un spectateur."""
+
+
+def set_nodelay(writer):
+    sock = writer.get_extra_info('socket')
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except (OSError, AttributeError):
+        pass
+
+
+class LatestFrame:
+    """Case à une place : put() remplace l'image non encore prise (latest-frame-wins)."""
+
+    __slots__ = ('frame', 'event', 'dropped')
+
+    def __init__(self):
+        self.frame = None
+        self.event = asyncio.Event()
+        self.dropped = 0
+
+    def put(self, frame):
+        if self.frame is not None:
+            self.dropped += 1
+        self.frame = frame
+        self.event.set()
+
+    async def get(self):
+        await self.event.wait()
+        self.event.clear()
+        frame, self.frame = self.frame, None
+        return frame
+
+
+class CameraIngest(asyncio.BufferedProtocol):
+    """Connexion d'une caméra : en-tête lu dans un petit tampon, image reçue dans son propre bytearray."""
+
+    def __init__(self, relay):
+        self.relay = relay
+        self.name = None
+        self.transport = None
+        self.header = bytearray(HEADER_SIZE)
+        self.current = None
+        self._expect_header()
+
+    def _expect_header(self):
+        self.current = None
+        self.target = memoryview(self.header)
+        self.pos = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+        self.peer = transport.get_extra_info('peername')
+
+    def get_buffer(self, sizehint):
+        return self.target[self.pos:]
+
+    def buffer_updated(self, nbytes):
+        self.pos += nbytes
+        if self.pos < len(self.target):
+            return
+        if self.current is None:
+            try:
+                header = unpack_header(self.header)
+            except ProtocolError as e:
+                print(f'caméra {self.peer} : {e} — déconnectée')
+                self.transport.close()
+                return
+            # en-tête d'origine gardé tel quel pour les spectateurs
+            self.current = (header, bytes(self.header))
+            if header.length:
+                self.target = memoryview(bytearray(header.length))
+                self.pos = 0
+                return
+            payload = b''
+        else:
+            payload = self.target.obj
+        header, raw = self.current
+        self._expect_header()
+        if header.codec == CODEC_HELLO:
+            if self.name is None:
+                self.name = self.relay.add_camera(bytes(payload).decode('utf-8', 'replace').strip() or None, self)
+            return
+        if self.name is None:
+            self.name = self.relay.add_camera(None, self)
+        self.relay.publish(self.name, raw, payload)
+
+    def connection_lost(self, exc):
+        if self.name is not None:
+            self.relay.remove_camera(self.name, self)
+
+
+class Relay:
+    def __init__(self, stats_interval=0):
+        self.cameras = {}    # nom -> {'frames', 'bytes', 'since', 'peer'}
+        self.viewers = {}    # nom de caméra -> set(LatestFrame)
+        self.counter = 0
+        self.stats_interval = stats_interval
+
+    # ---------- caméras ----------
+
+    def add_camera(self, name, ingest):
+        if not name:
+            self.counter += 1
+            name = f'cam{self.counter}'
+        base, n = name, 1
+        while name in self.cameras:
+            n += 1
+            name = f'{base}-{n}'
+        self.cameras[name] = {'frames': 0, 'bytes': 0, 'since': time.monotonic(), 'peer': str(ingest.peer)}
+        print(f'caméra {name} connectée ({ingest.peer})')
+        return name
+
+    def remove_camera(self, name, ingest):
+        cam = self.cameras.pop(name, None)
+        if cam:
+            print(f"caméra {name} déconnectée après {cam['frames']} images")
+
+    def publish(self, name, raw_header, payload):
+        cam = self.cameras[name]
+        cam['frames'] += 1
+        cam['bytes'] += len(payload)
+        for slot in self.viewers.get(name, ()):
+            slot.put((raw_header, payload))
+
+    # ---------- spectateurs ----------
+
+    async def serve_viewer(self, reader, writer):
+        peer = writer.get_extra_info('peername')
+        try:
+            line = await asyncio.wait_for(reader.readline(), HELLO_TIMEOUT)
+        except (asyncio.TimeoutError, ConnectionError):
+            writer.close()
+            return
+        name = line.decode('utf-8', 'replace').strip()
+        if name == '?':
+            writer.write(json.dumps(self.camera_list()).encode() + b'\n')
+            await writer.drain()
+            writer.close()
+            return
+        if name not in self.cameras:
+            # nom mal saisi ou caméra pas encore connectée : erreur explicite plutôt qu'une attente sans fin
+            reply = {'error': f'caméra inconnue : {name}', 'cameras': self.camera_list()}
+            writer.write(json.dumps(reply, ensure_ascii=False).encode() + b'\n')
+            await writer.drain()
+            writer.close()
+            print(f'spectateur {peer} refusé : caméra inconnue {name!r}')
+            return
+        writer.write(json.dumps({'camera': name}, ensure_ascii=False).encode() + b'\n')
+        set_nodelay(writer)
+        slot = LatestFrame()
+        credits = asyncio.Semaphore(VIEWER_WINDOW)
+        self.viewers.setdefault(name, set()).add(slot)
+        sent = 0
+        print(f'spectateur {peer} -> {name}')
+
+        async def send():
+            nonlocal sent
+            while True:
+                # crédit d'abord : l'image prise ensuite est la plus récente au moment de l'envoi
+                await credits.acquire()
+                raw_header, payload = await slot.get()
+                writer.write(raw_header)
+                writer.write(payload)
+                await writer.drain()
+                sent += 1
+
+        sender = asyncio.create_task(send())
+        try:
+            # un octet d'acquittement par image traitée par le spectateur ; fin de flux = départ
+            while not sender.done():
+                acks = await reader.read(256)
+                if not acks:
+                    break
+                for _ in acks:
+                    credits.release()
+        except ConnectionError:
+            pass
+        finally:
+            sender.cancel()
+            try:
+                await sender
+            except (ConnectionError, asyncio.CancelledError):
+                pass
+            self.viewers[name].discard(slot)
+            writer.close()
+            print(f'spectateur {peer} parti : {sent} images envoyées, {slot.dropped} remplacées')
+
+    def camera_list(self):
+        now = time.monotonic()
+        return [{'name': n, 'frames': c['frames'], 'fps': round(c['frames'] / max(now - c['since'], 1e-9), 1),
+                 'viewers': len(self.viewers.get(n, ()))} for n, c in self.cameras.items()]
+
+    async def report(self):
+        while self.stats_interval:
+            await asyncio.sleep(self.stats_interval)
+            for cam in self.camera_list():
+                drops = sum(s.dropped for s in self.viewers.get(cam['name'], ()))
+                print(f"[relais] {cam['name']}: {cam['frames']} images, {cam['fps']} i/s, "
+                      f"{cam['viewers']} spectateurs, {drops} images remplacées")
+
+    async def start(self, host, camera_port, viewer_port):
+        loop = asyncio.get_running_loop()
+        cam_server = await loop.create_server(lambda: CameraIngest(self), host, camera_port)
+        view_server = await asyncio.start_server(self.serve_viewer, host, viewer_port)
+        if self.stats_interval:
+            self.reporter = asyncio.create_task(self.report())
+        return cam_server, view_server
+
+
+async def run_relay(host, camera_port, viewer_port, stats_interval):
+    relay = Relay(stats_interval)
+    cam_server, view_server = await relay.start(host, camera_port, viewer_port)
+    print(f'Relais : caméras sur {host}:{camera_port}, spectateurs sur {host}:{viewer_port}')
+    async with cam_server, view_server:
+        await asyncio.gather(cam_server.serve_forever(), view_server.serve_forever())
+
+
+# -------------------- Caméras synthétiques --------------------
+
+def frame_source(source=None, frame_kb=50, seed=0):
+    """Générateur infini de (codec, octets encodés) : fichiers image d'un dossier / motif glob
+    (envoyés tels quels), vidéo (cv2, réencodée en JPEG), ou octets aléatoires de frame_kb Ko."""
+    if source and (os.path.isdir(source) or any(c in source for c in '*?[')):
+        pattern = os.path.join(source, '*') if os.path.isdir(source) else source
+        ext_codec = {ext: codec for codec, ext in CODEC_EXT.items()}
+        ext_codec['.jpeg'] = CODEC_JPEG
+        files = sorted(f for f in glob.glob(pattern) if os.path.splitext(f)[1].lower() in ext_codec)
+        if not files:
+            raise SystemExit(f'Aucune image dans {source}')
+        frames = []
+        for f in files:
+            with open(f, 'rb') as fh:
+                frames.append((ext_codec[os.path.splitext(f)[1].lower()], fh.read()))
+        while True:
+            yield from frames
+    elif source:
+        import cv2
+        while True:
+            vid = cv2.VideoCapture(source)
+            if not vid.isOpened():
+                raise SystemExit(f'Vidéo illisible : {source}')
+            while True:
+                ret, frame = vid.read()
+                if not ret:
+                    break
+                ok, jpeg = cv2.imencode('.jpg', frame)
+                if ok:
+                    yield CODEC_JPEG, jpeg
+            vid.release()
+    else:
+        rnd = random.Random(seed)
+        pool = [rnd.randbytes(int(frame_kb * 1024)) for _ in range(8)]
+        while True:
+            yield from ((CODEC_JPEG, f) for f in pool)
+
+
+async def synthetic_camera(host, port, name, fps=30, source=None, frame_kb=50, seconds=0, seed=0):
+    """Caméra asyncio : publie les images de frame_source au rythme fps. Renvoie le nombre d'images envoyées."""
+    reader, writer = await asyncio.open_connection(host, port)
+    hello = name.encode()
+    writer.write(pack_header(0, len(hello), codec=CODEC_HELLO) + hello)
+    period = 1.0 / fps if fps else 0
+    start = time.monotonic()
+    deadline = start + seconds if seconds else None
+    seq = 0
+    try:
+        for codec, payload in frame_source(source, frame_kb, seed):
+            now = time.monotonic()
+            if deadline and now >= deadline:
+                break
+            body = memoryview(payload).cast('B')
+            writer.write(pack_header(seq, len(body), codec=codec))
+            writer.write(body)
+            await writer.drain()
+            seq += 1
+            if period:
+                # cadence absolue : pas de dérive si un envoi a pris du retard
+                await asyncio.sleep(max(0.0, start + seq * period - time.monotonic()))
+    except ConnectionError:
+        pass
+    finally:
+        writer.close()
+    return seq
+
+
+# -------------------- Spectateurs --------------------
+
+async def read_frames(reader):
+    """Images camera_protocol d'un flux asyncio : (FrameHeader, octets)."""
+    while True:
+        try:
+            raw = await reader.readexactly(HEADER_SIZE)
+        except asyncio.IncompleteReadError:
+            return
+        header = unpack_header(raw)
+        yield header, await reader.readexactly(header.length)
+
+
+async def viewer(host, port, name, seconds=0, delay=0.0, show=False):
+    """Spectateur : reçoit les images de la caméra name ; delay simule un affichage lent.
+    Renvoie {'frames', 'latency_ms_p50', 'latency_ms_p95', 'latency_ms_max', 'seq_gaps'} ;
+    UnknownCamera (message avec la liste des caméras) si le relais ne connaît pas name."""
+    reader, writer = await asyncio.open_connection(host, port)
+    set_nodelay(writer)
+    writer.write(name.encode() + b'\n')
+    await writer.drain()
+    line = await reader.readline()
+    status = json.loads(line) if line else {'error': 'connexion fermée par le relais'}
+    if 'error' in status:
+        writer.close()
+        cams = ', '.join(c['name'] for c in status.get('cameras', [])) or 'aucune'
+        raise UnknownCamera(f"{status['error']} (caméras connectées : {cams})")
+    latencies = []
+    gaps = 0
+    last_seq = None
+    cv2 = np = None
+    if show:
+        import cv2
+        import numpy as np
+
+    async def consume():
+        nonlocal gaps, last_seq
+        async for header, payload in read_frames(reader):
+            # même horloge que la caméra sur la boucle locale ; entre machines, synchroniser (NTP)
+            latencies.append((time.time_ns() - header.timestamp_ns) / 1e6)
+            if last_seq is not None and header.seq != last_seq + 1:
+                gaps += 1
+            last_seq = header.seq
+            if show:
+                frame = cv2.imdecode(np.frombuffer(payload, dtype=np.uint8), cv2.IMREAD_COLOR)
+                if frame is not None:
+                    cv2.imshow(f'Relais : {name}', frame)
+                    if cv2.waitKey(1) & 0xFF == ord('q'):
+                        return
+            if delay:
+                await asyncio.sleep(delay)
+            # acquittement : le relais peut envoyer l'image suivante (la plus récente)
+            writer.write(b'\x01')
+
+    try:
+        if seconds:
+            await asyncio.wait_for(consume(), seconds)
+        else:
+            await consume()
+    except asyncio.TimeoutError:
+        pass
+    finally:
+        writer.close()
+    return {'frames': len(latencies), 'latency_ms_p50': percentile(latencies, 50),
+            'latency_ms_p95': percentile(latencies, 95), 'latency_ms_max': max(latencies) if latencies else None,
+            'seq_gaps': gaps}
+
+
+async def list_cameras(host, port):
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(b'?\n')
+    await writer.drain()
+    cams = json.loads(await reader.readline())
+    writer.close()
+    return cams
+
+
+# -------------------- Banc d'essai local --------------------
+
+async def loopback(cameras=2, viewers=2, slow_viewers=1, slow_delay=0.2, fps=30, frame_kb=50, source=None,
+                   seconds=5, host='127.0.0.1'):
+    """Relais + caméras synthétiques + spectateurs (par caméra : viewers rapides, slow_viewers lents)
+    sur des ports libres de la boucle locale. Renvoie les résultats par spectateur."""
+    relay = Relay()
+    cam_server, view_server = await relay.start(host, 0, 0)
+    cam_port = cam_server.sockets[0].getsockname()[1]
+    view_port = view_server.sockets[0].getsockname()[1]
+    names = [f'cam{i + 1}' for i in range(cameras)]
+    cams = [asyncio.create_task(synthetic_camera(host, cam_port, n, fps, source, frame_kb, seconds + 0.5, seed=i))
+            for i, n in enumerate(names)]
+    await asyncio.sleep(0.2)
+    specs = [(n, 0.0) for n in names for _ in range(viewers)] + [(n, slow_delay) for n in names for _ in range(slow_viewers)]
+    results = await asyncio.gather(*(viewer(host, view_port, n, seconds, delay) for n, delay in specs))
+    sent = await asyncio.gather(*cams)
+    cam_server.close()
+    view_server.close()
+    out = []
+    for (n, delay), res in zip(specs, results):
+        res.update({'camera': n, 'slow': bool(delay), 'published': sent[names.index(n)]})
+        out.append(res)
+    return out
+
+
+def fmt_ms(v):
+    return '-' if v is None else f'{v:.1f}'
+
+
+# -------------------- CLI --------------------
+
+def main():
+    ap = argparse.ArgumentParser(description='Relais multi-caméras asyncio (camera_protocol), caméras et spectateurs de test.')
+    ap.add_argument('mode', choices=('relay', 'camera', 'viewer', 'loopback'))
+    ap.add_argument('--host', default='127.0.0.1')
+    ap.add_argument('--camera-port', type=int, default=DEFAULT_CAMERA_PORT)
+    ap.add_argument('--viewer-port', type=int, default=DEFAULT_VIEWER_PORT)
+    ap.add_argument('--name', default='cam1',
+                    help="Nom de la caméra publiée / regardée, qui doit être connectée au relais ('?' : liste)")
+    ap.add_argument('--source', help='Dossier ou motif glob d\'images, ou fichier vidéo (cv2) ; sinon octets aléatoires')
+    ap.add_argument('--frame-kb', type=float, default=50, help='Taille des images aléatoires (sans --source)')
+    ap.add_argument('--fps', type=float, default=30)
+    ap.add_argument('--seconds', type=float, default=0, help='Durée (0 = sans fin ; loopback : 5 s par défaut)')
+    ap.add_argument('--show', action='store_true', help='Spectateur : affiche les images (cv2)')
+    ap.add_argument('--delay', type=float, default=0.0, help='Spectateur : pause après chaque image (simule un client lent)')
+    ap.add_argument('--cameras', type=int, default=2, help='loopback : nombre de caméras')
+    ap.add_argument('--viewers', type=int, default=2, help='loopback : spectateurs rapides par caméra')
+    ap.add_argument('--slow-viewers', type=int, default=1, help='loopback : spectateurs lents par caméra')
+    ap.add_argument('--slow-delay', type=float, default=0.2, help='loopback : pause par image des spectateurs lents (s)')
+    ap.add_argument('--stats-interval', type=float, default=10, help='relay : bilan périodique (s, 0 = aucun)')
+    ap.add_argument('--json', help='loopback : écrit les résultats dans ce fichier JSON')
+    args = ap.parse_args()
+
+    try:
+        if args.mode == 'relay':
+            asyncio.run(run_relay(args.host, args.camera_port, args.viewer_port, args.stats_interval))
+        elif args.mode == 'camera':
+            n = asyncio.run(synthetic_camera(args.host, args.camera_port, args.name, args.fps, args.source,
+                                             args.frame_kb, args.seconds))
+            print(f'{n} images publiées')
+        elif args.mode == 'viewer':
+            if args.name == '?':
+                for cam in asyncio.run(list_cameras(args.host, args.viewer_port)):
+                    print(cam)
+                return
+            try:
+                res = asyncio.run(viewer(args.host, args.viewer_port, args.name, args.seconds, args.delay, args.show))
+            except UnknownCamera as e:
+                raise SystemExit(str(e))
+            print(res)
+        else:
+            results = asyncio.run(loopback(args.cameras, args.viewers, args.slow_viewers, args.slow_delay, args.fps,
+                                           args.frame_kb, args.source, args.seconds or 5, args.host))
+            print(f"{'caméra':<8} {'lent':<5} {'publiées':>9} {'reçues':>7} {'trous':>6} {'p50 ms':>8} {'p95 ms':>8} {'max ms':>8}")
+            for r in results:
+                print(f"{r['camera']:<8} {'oui' if r['slow'] else 'non':<5} {r['published']:>9} {r['frames']:>7} "
+                      f"{r['seq_gaps']:>6} {fmt_ms(r['latency_ms_p50']):>8} {fmt_ms(r['latency_ms_p95']):>8} "
+                      f"{fmt_ms(r['latency_ms_max']):>8}")
+            if args.json:
+                with open(args.json, 'w', encoding='utf-8') as f:
+                    json.dump(results, f, ensure_ascii=False, indent=2)
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    sys.exit(main())
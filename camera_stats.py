@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+camera_stats.py
+
+Mesures du lien caméra, partagées par "Camera test client.py" et "Camera test serveur.py" :
+durée de chaque étape (capture, encodage, envoi / réception, décodage, affichage), latence depuis
+l'horodatage de capture embarqué dans chaque en-tête (camera_protocol), images/s, octets/s et
+compteurs d'images perdues.
+
+Toutes les `interval` secondes : une ligne de bilan sur la sortie standard et, si demandé, un
+objet JSON par ligne dans un fichier (JSONL ; client et serveur peuvent écrire dans le même
+fichier, champ "role"). À la fin, close() écrit le bilan global ("summary": true).
+
+La latence "de bout en bout" va de l'horodatage de capture (juste après la lecture de l'image)
+jusqu'à l'affichage : exposition du capteur et rafraîchissement de l'écran non compris. Entre
+deux machines, elle n'a de sens qu'avec des horloges synchronisées (NTP).
+"""
+
+import json
+import time
+import threading
+from collections import Counter, defaultdict, deque
+
+SUMMARY_SAMPLES = 10000   # échantillons gardés pour les percentiles du bilan global
+
+
+def percentile(samples, p):
+    if not samples:
+        return None
+    samples = sorted(samples)
+    return samples[min(len(samples) - 1, int(p / 100 * len(samples)))]
+
+
+def describe(samples):
+    """{'mean', 'p50', 'p95', 'max'} en ms, arrondis ; None sans échantillon."""
+    if not samples:
+        return None
+    return {'mean': round(sum(samples) / len(samples), 2), 'p50': round(percentile(samples, 50), 2),
+            'p95': round(percentile(samples, 95), 2), 'max': round(max(samples), 2)}
+
+
+class LinkStats:
+    """Compteurs et durées d'un côté du lien ; utilisable depuis plusieurs threads."""
+
+    def __init__(self, role, interval=5.0, log_path=None):
+        self.role = role
+        self.interval = interval
+        self.log = open(log_path, 'a', encoding='utf-8', buffering=1) if log_path else None
+        self.lock = threading.Lock()
+        self.started = self.window_start = time.monotonic()
+        self.total = Counter()
+        self.window = Counter()
+        self.stages = defaultdict(list)            # fenêtre courante, ms
+        self.latencies = []
+        self.gauges = {}                           # dernière valeur (qualité JPEG...)
+        self.all_stages = defaultdict(lambda: deque(maxlen=SUMMARY_SAMPLES))
+        self.all_latencies = deque(maxlen=SUMMARY_SAMPLES)
+
+    def count(self, name, n=1):
+        with self.lock:
+            self.window[name] += n
+            self.total[name] += n
+
+    def stage(self, name, seconds):
+        ms = seconds * 1000
+        with self.lock:
+            self.stages[name].append(ms)
+            self.all_stages[name].append(ms)
+
+    def gauge(self, name, value):
+        self.gauges[name] = value
+
+    def latency(self, ms):
+        with self.lock:
+            self.latencies.append(ms)
+            self.all_latencies.append(ms)
+
+    def tick(self):
+        """À appeler à chaque image : bilan si l'intervalle est écoulé."""
+        if self.interval and time.monotonic() - self.window_start >= self.interval:
+            self.report()
+
+    def _record(self, counters, stages, latencies, elapsed):
+        elapsed = max(elapsed, 1e-9)
+        rec = {'role': self.role, 'time': round(time.time(), 3), 'elapsed': round(elapsed, 3),
+               'fps': round(counters['frames'] / elapsed, 2), 'bytes_per_s': round(counters['bytes'] / elapsed),
+               'counters': dict(counters), 'stages_ms': {k: describe(v) for k, v in stages.items() if v},
+               'latency_ms': describe(latencies)}
+        if self.gauges:
+            rec['gauges'] = dict(self.gauges)
+        return rec
+
+    def report(self):
+        with self.lock:
+            now = time.monotonic()
+            rec = self._record(self.window, self.stages, self.latencies, now - self.window_start)
+            self.window = Counter()
+            self.stages = defaultdict(list)
+            self.latencies = []
+            self.window_start = now
+        self._emit(rec)
+        return rec
+
+    def close(self):
+        """Bilan global (toute la durée) ; le renvoie."""
+        with self.lock:
+            rec = self._record(self.total, self.all_stages, list(self.all_latencies),
+                               time.monotonic() - self.started)
+        rec['summary'] = True
+        self._emit(rec)
+        if self.log:
+            self.log.close()
+            self.log = None
+        return rec
+
+    def _emit(self, rec):
+        print(format_record(rec), flush=True)
+        if self.log:
+            self.log.write(json.dumps(rec, ensure_ascii=False) + '\n')
+
+
+def format_record(rec):
+    """Ligne lisible : [client] 29.9 i/s 6.2 Mo/s | encode 8.1 ms ... | latence p50 4.4 p95 9.0 ms | ..."""
+    parts = [f"[{rec['role']}{' bilan' if rec.get('summary') else ''}] {rec['fps']:.1f} i/s "
+             f"{rec['bytes_per_s'] / 1e6:.2f} Mo/s"]
+    stages = ' '.join(f"{name} {d['mean']:.1f}" for name, d in rec['stages_ms'].items())
+    if stages:
+        parts.append(f'{stages} ms')
+    lat = rec['latency_ms']
+    if lat:
+        parts.append(f"latence p50 {lat['p50']:.1f} p95 {lat['p95']:.1f} max {lat['max']:.1f} ms")
+    others = ' '.join(f'{k}={v}' for k, v in sorted(rec['counters'].items()) if k not in ('frames', 'bytes'))
+    others += ''.join(f' {k}={v}' for k, v in rec.get('gauges', {}).items())
+    if others.strip():
+        parts.append(others.strip())
+    return ' | '.join(parts)
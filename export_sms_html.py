@@ -5,13 +5,18 @@ import os
 import re
 import sys
 import csv
-import base64
+import json
+import shutil
 import html
 import time
+import sqlite3
 import argparse
-import xml.etree.ElementTree as ET
+from collections import OrderedDict
 from datetime import datetime, timezone
 
+from sms_commun import (DEFAULT_THUMB_PX, MediaStore, ThumbnailPool, run_pipeline, parse_chunk, message_fields,
+                        render_text, thumbnails_supported)
+
 # ----------------------------
 # Utils
 # ----------------------------
@@ -54,7 +59,7 @@ def append(path: str, content: str):
     with open(path, "a", encoding="utf-8") as f:
         f.write(content)
 
-def guess_part_filename(idx: int, ct: str, suggested: str = None):
+def guess_part_ext(ct: str, suggested: str = None):
     ext_map = {
         "image/jpeg": ".jpg",
         "image/jpg": ".jpg",
@@ -70,7 +75,6 @@ def guess_part_filename(idx: int, ct: str, suggested: str = None):
         "text/plain": ".txt",
         "application/pdf": ".pdf",
     }
-    base = f"media_{idx:09d}"
     ext = ""
     if suggested:
         _, ext0 = os.path.splitext(suggested)
@@ -82,7 +86,7 @@ def guess_part_filename(idx: int, ct: str, suggested: str = None):
         ext = "." + ct.split("/")[-1].lower()
     if not ext:
         ext = ".bin"
-    return base + ext
+    return ext
 
 CSS = """
 <style>
@@ -130,33 +134,326 @@ INDEX_INTRO = """
 <hr>
 """
 
-def open_contact_page(path_html: str, title: str, split_by_year=False):
-    # créer page si absente, avec entête
-    write_if_new(path_html, HTML_HEADER.replace("{title}", html.escape(title)) +
-                 f'<div class="header"><h1 class="h1">💬 {html.escape(title)}</h1></div>\n<div class="thread">\n')
+class ContactWriters:
+    """Cache LRU de pages contact ouvertes en ajout, avec tampon d'écriture.
+
+    Évite un open/close (et un stat) par message : un fichier n'est vérifié qu'à sa première
+    utilisation dans le run, puis reste ouvert tant qu'il fait partie des max_open plus récents.
+    """
+
+    def __init__(self, max_open=256, buffering=64 * 1024):
+        self.max_open = max(1, max_open)
+        self.buffering = buffering
+        self.handles = OrderedDict()  # path -> fichier ouvert, du moins au plus récemment utilisé
+        self.seen = set()             # pages déjà ouvertes/créées pendant ce run
+        self.opens = 0
+        self.evictions = 0
+
+    def get(self, path: str):
+        f = self.handles.get(path)
+        if f is not None:
+            self.handles.move_to_end(path)
+            return f
+        if len(self.handles) >= self.max_open:
+            _, old = self.handles.popitem(last=False)
+            old.close()
+            self.evictions += 1
+        f = open(path, "a", encoding="utf-8", buffering=self.buffering)
+        self.opens += 1
+        self.handles[path] = f
+        return f
+
+    def write(self, path: str, content: str):
+        self.get(path).write(content)
+
+    def close_all(self):
+        while self.handles:
+            _, f = self.handles.popitem()
+            f.close()
+
+
+def has_footer(path_html: str) -> bool:
+    # ne lit que la fin du fichier
+    with open(path_html, "rb") as ck:
+        ck.seek(0, os.SEEK_END)
+        ck.seek(max(0, ck.tell() - 2000))
+        return b"</html>" in ck.read()
+
+def open_contact_page(writers: ContactWriters, path_html: str, title: str, split_by_year=False):
+    # créer page si absente, avec entête (vérifié une seule fois par run)
+    if path_html in writers.seen:
+        return
+    writers.seen.add(path_html)
+    if not os.path.exists(path_html):
+        writers.write(path_html, HTML_HEADER.replace("{title}", html.escape(title)) +
+                      f'<div class="header"><h1 class="h1">💬 {html.escape(title)}</h1></div>\n<div class="thread">\n')
     # si split_by_year, on insérera des séparateurs lors de l’écriture
     return
 
 def close_contact_page(path_html: str):
     append(path_html, "</div>\n" + HTML_FOOTER)
 
-def write_msg(path_html: str, direction: str, date_str: str, who: str, body_html: str, year_sep: str = None):
+def write_msg(writers: ContactWriters, path_html: str, direction: str, date_str: str, who: str, body_html: str, year_sep: str = None):
     # year_sep => si fourni, insère un séparateur d'année
+    block = ""
     if year_sep:
-        append(path_html, f'<div class="separator">— {html.escape(year_sep)} —</div>\n')
+        block = f'<div class="separator">— {html.escape(year_sep)} —</div>\n'
     bubble_class = "out" if direction == "out" else "in"
     who_txt = f"{who}" if who else ("Moi" if bubble_class=="out" else "Contact")
-    block = f'<div class="msg {bubble_class}">{body_html}<span class="small">{html.escape(who_txt)} • {html.escape(date_str)}</span></div>\n'
-    append(path_html, block)
+    block += f'<div class="msg {bubble_class}">{body_html}<span class="small">{html.escape(who_txt)} • {html.escape(date_str)}</span></div>\n'
+    writers.write(path_html, block)
+
+def media_block(fname: str, ct: str, thumb: str = None) -> str:
+    # Affichage selon type ; rien n'est téléchargé avant d'arriver à l'écran (loading/preload)
+    if ct.startswith("image/"):
+        if thumb:
+            # miniature en page, original au clic ; repli sur l'original si la miniature manque
+            return (f'<div class="media"><a href="../media/{fname}" target="_blank"><img src="../media/{thumb}" loading="lazy" decoding="async" '
+                    f'onerror="this.onerror=null;this.src=\'../media/{fname}\'" alt="{html.escape(ct)}"></a></div>')
+        return f'<div class="media"><a href="../media/{fname}" target="_blank"><img src="../media/{fname}" loading="lazy" decoding="async" alt="{html.escape(ct)}"></a></div>'
+    if ct.startswith("video/"):
+        return f'<div class="media"><video controls preload="none" src="../media/{fname}"></video></div>'
+    if ct.startswith("audio/"):
+        return f'<div class="media"><audio controls preload="none" src="../media/{fname}"></audio></div>'
+    return f'<div class="media"><a href="../media/{fname}" download>Télécharger {html.escape(ct)}</a></div>'
+
+def export_worker(chunk: bytes) -> list:
+    """Worker du pipeline : parse un paquet d'enregistrements, décode les médias, rend le texte et les dates."""
+    out = []
+    for elem in parse_chunk(chunk):
+        f = message_fields(elem)
+        date_str = ms_to_local_str(f["date_ms"])
+        try:
+            date_ms = int(f["date_ms"])
+        except (TypeError, ValueError):
+            date_ms = None
+        rec = {
+            "typ": f["typ"],
+            "key": contact_key(f["address"], f["name"]),
+            "date_ms": date_ms,
+            "direction": f["direction"],
+            "date_str": date_str,
+            "year": date_str[:4] if date_str else None,
+        }
+        if f["typ"] == "sms":
+            rec["body_html"] = render_text(f["body"])
+        else:
+            rec["body_html"] = "<br>".join(render_text(p[1]) for p in f["parts"] if p[0] == "text")
+            rec["parts"] = [p for p in f["parts"] if p[0] != "text"]
+        out.append(rec)
+    return out
+
+def build_body_html(rec: dict, media_store: MediaStore, thumbs: ThumbnailPool = None) -> str:
+    """HTML final d'un message ; pour un MMS, range les médias dans media_store (et planifie leurs miniatures)."""
+    if rec["typ"] == "sms":
+        return rec["body_html"]
+    # Construire contenu MMS
+    media_html = []
+    for part in rec["parts"]:
+        if part[0] == "media":
+            _, ct, name_attr, blob, digest = part
+            # stockage par contenu : un média déjà vu n'est pas réécrit
+            digest, fname = media_store.put(blob, guess_part_ext(ct, name_attr), digest)
+            thumb = None
+            if thumbs is not None and ct.startswith("image/") and ct != "image/svg+xml":
+                thumb = thumbs.submit(digest, fname)
+            media_html.append(media_block(fname, ct, thumb))
+        else:
+            # Pas de base64 -> on laisse un lien symbolique si nom connu
+            media_html.append(f'<div class="media"><em>(Pièce jointe non incluse dans le backup : {html.escape(part[1])})</em></div>')
+
+    body_html = rec["body_html"] or "<em>(MMS sans texte)</em>"
+    if media_html:
+        body_html += "<br>" + "\n".join(media_html)
+    return body_html
+
+def contact_card(key: str, count: int, files: list, out_dir: str, overwrite: bool = False, summary: str = None) -> str:
+    """Carte d'un contact pour index.html ; crée la page sommaire si le contact a plusieurs fichiers
+    (sauf si summary désigne un sommaire déjà écrit)."""
+    # si split par année, on pointe vers une "page sommaire" auto : on crée une nav
+    # autrement, un seul fichier.
+    files = sorted(files)
+    if len(files) == 1:
+        rel = os.path.relpath(files[0], out_dir)
+        return (f'<div class="contact"><h3>{html.escape(key)}</h3><div class="meta">{count} messages</div>'
+                f'<p><a href="{html.escape(rel)}">Ouvrir la conversation</a></p></div>\n')
+    # Créer une page sommaire par contact listant les années
+    contact_summary = summary or os.path.join(os.path.dirname(files[0]), safe_filename(key) + "__SOMMAIRE.html")
+    if not summary and (overwrite or not os.path.exists(contact_summary)):
+        with open(contact_summary, "w", encoding="utf-8") as f:
+            f.write(HTML_HEADER.replace("{title}", f"Sommaire — {html.escape(key)}") +
+                    f'<div class="header"><h1 class="h1">📂 {html.escape(key)} — Sommaire</h1></div>\n<div class="nav">\n')
+            # ajouter liens vers fichiers (année)
+            for fp in files:
+                label = os.path.splitext(os.path.basename(fp))[0]
+                # extraire l'année depuis le suffixe __YYYY
+                m = re.search(r"__([12][0-9]{3})$", label)
+                lab = m.group(1) if m else label
+                relf = os.path.relpath(fp, os.path.dirname(contact_summary))
+                f.write(f'<a href="{html.escape(relf)}">{html.escape(lab)}</a>\n')
+            f.write("</div>\n" + HTML_FOOTER)
+    rel = os.path.relpath(contact_summary, out_dir)
+    return (f'<div class="contact"><h3>{html.escape(key)}</h3><div class="meta">{count} messages</div>'
+            f'<p><a href="{html.escape(rel)}">Voir les années</a></p></div>\n')
+
+def write_index_and_stats(out_dir: str, index_path: str, contacts, overwrite: bool = False):
+    """contacts : itérable de (clé, nb messages, fichiers[, sommaire]), déjà trié ; écrit les cartes au fil de l'eau."""
+    with open(index_path, "a", encoding="utf-8") as idx, \
+         open(os.path.join(out_dir, "contacts_stats.csv"), "w", newline="", encoding="utf-8") as f:
+        w = csv.writer(f)
+        w.writerow(["contact", "messages", "fichiers_html"])
+        for key, count, files, *summary in contacts:
+            idx.write(contact_card(key, count, files, out_dir, overwrite=overwrite, summary=summary[0] if summary else None))
+            w.writerow([key, count, " | ".join(sorted(os.path.relpath(p, out_dir) for p in files))])
+        idx.write("</div>\n" + HTML_FOOTER)
 
-def render_text(text: str) -> str:
-    if not text:
-        return ""
-    # echappe HTML et transforme liens en <a>
-    t = html.escape(text)
-    # URLs -> liens
-    t = re.sub(r'(https?://[^\s<]+)', r'<a href="\1" target="_blank" rel="noopener">\1</a>', t)
-    return t.replace("\n", "<br>")
+def close_thumbs(thumbs: ThumbnailPool):
+    if thumbs is not None:
+        thumbs.close()
+        print(f"[+] Miniatures : {thumbs.made} créées, {thumbs.cached} déjà présentes, {thumbs.failed} images illisibles")
+
+# ----------------------------
+# Export en deux passes
+# ----------------------------
+
+def load_intermediate(db, pipeline, media_store: MediaStore, limit: int = 0, thumbs: ThumbnailPool = None) -> int:
+    """Passe 1 : messages rendus -> table SQLite (clé, date, n° d'ordre). Renvoie le nombre de messages."""
+    db.execute("CREATE TABLE msgs (key TEXT, date_ms INTEGER, seq INTEGER, year TEXT, direction TEXT,"
+               " date_str TEXT, body_html TEXT)")
+    total = 0
+    for _, _, records in pipeline:
+        if limit:
+            records = records[:limit - total]
+        rows = [(rec["key"], rec["date_ms"], total + i, rec["year"], rec["direction"], rec["date_str"],
+                 build_body_html(rec, media_store, thumbs)) for i, rec in enumerate(records)]
+        db.execute("BEGIN")
+        db.executemany("INSERT INTO msgs VALUES (?,?,?,?,?,?,?)", rows)
+        db.execute("COMMIT")
+        prev = total
+        total += len(rows)
+        if total // 10000 > prev // 10000:
+            print(f"[+] {total} messages traités...")
+        if limit and total >= limit:
+            break
+    # tri externe fait par SQLite (mémoire bornée par cache_size), une fois pour toutes
+    db.execute("CREATE INDEX msgs_order ON msgs(key, date_ms, seq)")
+    return total
+
+def page_nav(prev_path: str, next_path: str, summary_path: str, here: str) -> str:
+    links = []
+    if prev_path:
+        links.append(f'<a href="{html.escape(os.path.relpath(prev_path, os.path.dirname(here)))}">← Précédente</a>')
+    if summary_path:
+        links.append(f'<a href="{html.escape(os.path.relpath(summary_path, os.path.dirname(here)))}">Sommaire</a>')
+    if next_path:
+        links.append(f'<a href="{html.escape(os.path.relpath(next_path, os.path.dirname(here)))}">Suivante →</a>')
+    return f'<div class="nav">{"".join(links)}</div>\n' if links else ""
+
+def render_conversations(db, contact_file_path, split_by_year: bool, page_size: int = 0, page_bytes: int = 0):
+    """Passe 2 : un seul parcours trié par contact puis par date ; un fichier ouvert à la fois.
+
+    Avec page_size (messages) et/ou page_bytes (octets de HTML), chaque conversation est coupée en
+    pages numérotées, écrites au fil du parcours et reliées par des liens précédente/suivante.
+    Renvoie le nombre de fichiers écrits ; ils sont notés dans la table pages.
+    """
+    paginated = bool(page_size or page_bytes)
+    db.execute("CREATE TABLE pages (key TEXT, path TEXT, year TEXT, page INTEGER, messages INTEGER,"
+               " bytes INTEGER, first_date TEXT, last_date TEXT)")
+    cur = None  # page en cours : dict(key, year, page, path, prev, f, messages, bytes, first, last)
+    written = 0
+
+    def close(next_path=None):
+        if cur is None:
+            return
+        summary = contact_file_path(cur["key"], summary=True) if paginated else None
+        cur["f"].write("</div>\n" + (page_nav(cur["prev"], next_path, summary, cur["path"]) if paginated else "") + HTML_FOOTER)
+        cur["f"].close()
+        db.execute("INSERT INTO pages VALUES (?,?,?,?,?,?,?,?)", (cur["key"], cur["path"], cur["year"], cur["page"],
+                   cur["messages"], cur["bytes"], cur["first"], cur["last"]))
+
+    def open_page(key, year, page, prev):
+        path = contact_file_path(key, year if split_by_year else None, page if paginated else None)
+        # pages réécrites en entier : l'ordre chronologique ne permet pas d'ajouter à l'existant
+        f = open(path, "w", encoding="utf-8", buffering=64 * 1024)
+        title = f"{key} — page {page}" if paginated else key
+        head = (HTML_HEADER.replace("{title}", html.escape(title)) +
+                f'<div class="header"><h1 class="h1">💬 {html.escape(key)}</h1>'
+                + (f'<span class="badge">page {page}</span>' if paginated else "") + '</div>\n')
+        if paginated:
+            head += page_nav(prev, None, contact_file_path(key, summary=True), path)
+        f.write(head + '<div class="thread">\n')
+        return {"key": key, "year": year, "page": page, "path": path, "prev": prev, "f": f,
+                "messages": 0, "bytes": 0, "first": None, "last": None, "last_year": None}
+
+    db.execute("BEGIN")
+    rows = db.execute("SELECT key, year, direction, date_str, body_html FROM msgs ORDER BY key, date_ms, seq")
+    for key, year, direction, date_str, body_html in rows:
+        bubble_class = "out" if direction == "out" else "in"
+        who = "Moi" if bubble_class == "out" else key
+        block = f'<div class="msg {bubble_class}">{body_html}<span class="small">{html.escape(who)} • {html.escape(date_str)}</span></div>\n'
+        size = len(block.encode("utf-8"))
+
+        if cur is None or key != cur["key"]:
+            close()
+            cur = open_page(key, year, 1, None)
+            written += 1
+        elif split_by_year and year != cur["year"]:
+            # fichier de l'année suivante : la page courante y mène
+            nxt = open_page(key, year, 1, cur["path"])
+            close(nxt["path"])
+            cur = nxt
+            written += 1
+        elif cur["messages"] and ((page_size and cur["messages"] >= page_size) or
+                                  (page_bytes and cur["bytes"] + size > page_bytes)):
+            nxt = open_page(key, year, cur["page"] + 1, cur["path"])
+            close(nxt["path"])
+            cur = nxt
+            written += 1
+
+        # séparateur d'année éventuel (inutile si un fichier par année ; répété en tête de chaque page)
+        if not split_by_year and year and year != cur["last_year"]:
+            cur["last_year"] = year
+            sep = f'<div class="separator">— {html.escape(year)} —</div>\n'
+            block = sep + block
+            size += len(sep.encode("utf-8"))
+        cur["f"].write(block)
+        cur["messages"] += 1
+        cur["bytes"] += size
+        cur["first"] = cur["first"] or date_str
+        cur["last"] = date_str
+    close()
+    db.execute("COMMIT")
+    db.execute("CREATE INDEX pages_key ON pages(key)")
+    return written
+
+def write_page_manifest(key: str, count: int, pages: list, summary_path: str, out_dir: str):
+    """Sommaire HTML + manifeste JSON des pages d'un contact ; pages : lignes (path, year, page, messages, bytes, first, last)."""
+    manifest = {"contact": key, "messages": count, "pages": []}
+    with open(summary_path, "w", encoding="utf-8") as f:
+        f.write(HTML_HEADER.replace("{title}", f"Sommaire — {html.escape(key)}") +
+                f'<div class="header"><h1 class="h1">📂 {html.escape(key)} — Sommaire</h1>'
+                f'<span class="badge">{count} messages, {len(pages)} pages</span></div>\n')
+        year_open = False
+        prev_year = object()
+        for path, year, page, messages, nbytes, first, last in pages:
+            if year != prev_year:
+                if year_open:
+                    f.write("</div>\n")
+                if year:
+                    f.write(f'<div class="year">{html.escape(year)}</div>\n')
+                f.write('<div class="nav">\n')
+                year_open = True
+                prev_year = year
+            relf = os.path.relpath(path, os.path.dirname(summary_path))
+            span = f"{(first or '')[:10]} → {(last or '')[:10]}"
+            f.write(f'<a href="{html.escape(relf)}" title="{messages} messages">{html.escape(span)}</a>\n')
+            manifest["pages"].append({"file": os.path.relpath(path, out_dir).replace(os.sep, "/"), "year": year,
+                                      "page": page, "messages": messages, "bytes": nbytes, "first": first, "last": last})
+        if year_open:
+            f.write("</div>\n")
+        f.write(HTML_FOOTER)
+    with open(os.path.splitext(summary_path)[0] + ".json", "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=1)
 
 # ----------------------------
 # Parsing principal
@@ -168,6 +465,13 @@ def main():
     ap.add_argument("--out", default="export", help="Dossier de sortie (par défaut: ./export)")
     ap.add_argument("--split-by-year", action="store_true", help="Découper chaque contact par année (recommandé pour très longues conversations).")
     ap.add_argument("--limit", type=int, default=0, help="Limiter le nombre de messages (debug). 0 = pas de limite.")
+    ap.add_argument("--max-open-files", type=int, default=256, help="Pages contact gardées ouvertes en même temps (cache LRU).")
+    ap.add_argument("--workers", type=int, default=1, help="Processus de décodage (base64, rendu texte). 1 = tout dans le processus principal.")
+    ap.add_argument("--two-pass", action="store_true", help="Passe par une base SQLite temporaire : mémoire bornée, conversations triées par date même si le XML ne l'est pas (pages réécrites).")
+    ap.add_argument("--page-size", type=int, default=0, help="Pagination : messages par page (implique --two-pass). 0 = pas de limite.")
+    ap.add_argument("--page-kb", type=int, default=0, help="Pagination : taille max d'une page HTML en Ko, hors médias (implique --two-pass).")
+    ap.add_argument("--thumb-size", type=int, default=DEFAULT_THUMB_PX, help="Côté max des miniatures d'images (px, nécessite Pillow). 0 = images en pleine résolution.")
+    ap.add_argument("--tmp-dir", help="Dossier de la base temporaire de --two-pass (par défaut: dossier de sortie).")
     args = ap.parse_args()
 
     xml_path = args.xml
@@ -179,256 +483,146 @@ def main():
     ensure_dir(media_dir)
     ensure_dir(contacts_dir)
 
-    # Stats & index
-    contact_stats = {}      # key -> {"count": int, "files": set()}
-    known_contacts = set()  # keys
-    media_counter = 0
-    total_msgs = 0
-
-    # Index header
+    media_store = MediaStore(media_dir)
+    thumbs = None
+    if args.thumb_size:
+        if thumbnails_supported():
+            # miniatures calculées par un pool séparé pendant que le pipeline continue
+            thumbs = ThumbnailPool(media_dir, size=args.thumb_size, workers=args.workers)
+        else:
+            print("[!] Pillow absent : pas de miniatures, les pages chargeront les images originales (pip install pillow)")
     index_path = os.path.join(out_dir, "index.html")
-    write_if_new(index_path, HTML_HEADER.replace("{title}", "Archive SMS/MMS/RCS") + INDEX_INTRO + '<div class="contact-list">\n')
-
-    # Streaming parse
-    context = ET.iterparse(xml_path, events=("start", "end"))
-    _, root = next(context)
 
-    # util pour écrire une carte contact dans index (définitif à la fin aussi)
-    index_cards_buffer = []  # on tamponne puis on ajoutera en fin
+    paginated = bool(args.page_size or args.page_kb)
+    if paginated:
+        args.two_pass = True
 
-    # Mémoire pour séparateur d'années par contact
-    last_year_by_contact = {}
-
-    def contact_file_path(key: str, year: str = None):
+    def contact_file_path(key: str, year: str = None, page: int = None, summary: bool = False):
         fname = safe_filename(key)
+        if summary:
+            fname = f"{fname}__SOMMAIRE"
         if args.split_by_year and year:
             fname = f"{fname}__{year}"
+        if page:
+            fname = f"{fname}__p{page:04d}"
         return os.path.join(contacts_dir, f"{fname}.html")
 
-    # Boucle
-    for event, elem in context:
-        if event != "end":
-            continue
-
-        tag = elem.tag.lower()
-
-        # ---------------- SMS ----------------
-        if tag == "sms":
-            address = elem.attrib.get("address", "") or elem.attrib.get("address_email", "")
-            name = elem.attrib.get("contact_name", "") or elem.attrib.get("name", "")
-            body = elem.attrib.get("body", "")
-            date_ms = elem.attrib.get("date")
-            type_ = elem.attrib.get("type")  # 1=inbox,2=sent (convention Android)
-            direction = "in" if type_ == "1" else "out"
-
-            key = contact_key(address, name)
-            date_str = ms_to_local_str(date_ms)
-            year = date_str[:4] if date_str else None
-
-            # fiche contact
-            if key not in known_contacts:
-                known_contacts.add(key)
-                contact_stats[key] = {"count": 0, "files": set()}
-
-            cfile = contact_file_path(key, year if args.split_by_year else None)
-            open_contact_page(cfile, key, split_by_year=args.split_by_year)
-
-            # séparateur année si changé
-            ysep = None
-            if args.split_by_year:
-                # pas besoin de séparateur, car fichier par année
-                pass
-            else:
-                prev = last_year_by_contact.get(key)
-                if year and prev != year:
-                    ysep = year
-                    last_year_by_contact[key] = year
-
-            write_msg(
-                cfile,
-                direction,
-                date_str,
-                "Moi" if direction == "out" else key,
-                render_text(body),
-                year_sep=ysep
-            )
-
-            contact_stats[key]["count"] += 1
-            contact_stats[key]["files"].add(cfile)
-            total_msgs += 1
-
-            if total_msgs % 10000 == 0:
-                print(f"[+] {total_msgs} messages traités...")
-
+    # Boucle : lecteur (paquets XML) -> workers (base64, render_text, dates) -> écriture ici, dans l'ordre du fichier
+    # pièces jointes volumineuses décodées en flux par le lecteur, puis déplacées dans media/
+    spool_dir = os.path.join(media_dir, ".spool")
+    ensure_dir(spool_dir)
+    pipeline = run_pipeline(xml_path, export_worker, workers=args.workers, spool_dir=spool_dir)
+
+    if args.two_pass:
+        # Passe 1 : tout dans une base SQLite temporaire ; passe 2 : une conversation après l'autre, triée par date
+        tmp_db = os.path.join(args.tmp_dir or out_dir, ".export_tmp.sqlite")
+        if os.path.exists(tmp_db):
+            os.remove(tmp_db)
+        db = sqlite3.connect(tmp_db, isolation_level=None)
+        db.execute("PRAGMA journal_mode=OFF")
+        db.execute("PRAGMA synchronous=OFF")
+        try:
+            total_msgs = load_intermediate(db, pipeline, media_store, limit=args.limit, thumbs=thumbs)
+            pipeline.close()
+            close_thumbs(thumbs)
+            shutil.rmtree(spool_dir, ignore_errors=True)
+            print(f"[+] Médias : {media_store.written} fichiers écrits, {media_store.reused} contenus dédoublonnés")
+            n_files = render_conversations(db, contact_file_path, args.split_by_year,
+                                           page_size=args.page_size, page_bytes=args.page_kb * 1024)
+            print(f"[+] Pages contact : {n_files} fichiers écrits")
+
+            def contact_rows(key, count):
+                if not paginated:
+                    return key, count, [r[0] for r in db.execute("SELECT path FROM pages WHERE key = ?", (key,))]
+                pages = db.execute("SELECT path, year, page, messages, bytes, first_date, last_date FROM pages"
+                                   " WHERE key = ? ORDER BY year, page", (key,)).fetchall()
+                summary = contact_file_path(key, summary=True)
+                write_page_manifest(key, count, pages, summary, out_dir)
+                return key, count, [p[0] for p in pages], summary
+
+            # index réécrit entièrement, cartes triées par nb messages décroissant
+            with open(index_path, "w", encoding="utf-8") as f:
+                f.write(HTML_HEADER.replace("{title}", "Archive SMS/MMS/RCS") + INDEX_INTRO + '<div class="contact-list">\n')
+            counts = db.execute("SELECT key, COUNT(*) FROM msgs GROUP BY key ORDER BY COUNT(*) DESC, key").fetchall()
+            write_index_and_stats(out_dir, index_path, (contact_rows(key, count) for key, count in counts),
+                                  overwrite=True)
+            n_contacts = len(counts)
+        finally:
+            db.close()
+            os.remove(tmp_db)
+    else:
+        # Index header
+        write_if_new(index_path, HTML_HEADER.replace("{title}", "Archive SMS/MMS/RCS") + INDEX_INTRO + '<div class="contact-list">\n')
+        contact_stats = {}      # key -> {"count": int, "files": set()}
+        # Mémoire pour séparateur d'années par contact
+        last_year_by_contact = {}
+        writers = ContactWriters(max_open=args.max_open_files)
+        total_msgs = 0
+        for _, _, records in pipeline:
+            for rec in records:
+                key = rec["key"]
+                direction = rec["direction"]
+                date_str = rec["date_str"]
+                year = rec["year"]
+
+                # fiche contact
+                if key not in contact_stats:
+                    contact_stats[key] = {"count": 0, "files": set()}
+
+                cfile = contact_file_path(key, year if args.split_by_year else None)
+                open_contact_page(writers, cfile, key, split_by_year=args.split_by_year)
+
+                body_html = build_body_html(rec, media_store, thumbs)
+
+                # séparateur d'année éventuel (inutile si un fichier par année)
+                ysep = None
+                if not args.split_by_year:
+                    prev = last_year_by_contact.get(key)
+                    if year and prev != year:
+                        ysep = year
+                        last_year_by_contact[key] = year
+
+                write_msg(
+                    writers,
+                    cfile,
+                    direction,
+                    date_str,
+                    "Moi" if direction == "out" else key,
+                    body_html,
+                    year_sep=ysep
+                )
+
+                contact_stats[key]["count"] += 1
+                contact_stats[key]["files"].add(cfile)
+                total_msgs += 1
+
+                if total_msgs % 10000 == 0:
+                    print(f"[+] {total_msgs} messages traités...")
+
+                if args.limit and total_msgs >= args.limit:
+                    break
             if args.limit and total_msgs >= args.limit:
-                root.clear()
                 break
-
-            root.clear()
-
-        # ---------------- MMS ----------------
-        elif tag == "mms":
-            address = elem.attrib.get("address", "") or elem.attrib.get("address_email", "")
-            name = elem.attrib.get("contact_name", "") or elem.attrib.get("name", "")
-            date_ms = elem.attrib.get("date")
-            # type MMS: box="1" (inbox), "2" (sent) souvent
-            box = elem.attrib.get("msg_box") or elem.attrib.get("box") or elem.attrib.get("m_type")
-            # Heuristique direction
-            direction = "in" if (box == "1") else "out"
-
-            key = contact_key(address, name)
-            if key not in known_contacts:
-                known_contacts.add(key)
-                contact_stats[key] = {"count": 0, "files": set()}
-
-            date_str = ms_to_local_str(date_ms)
-            year = date_str[:4] if date_str else None
-
-            cfile = contact_file_path(key, year if args.split_by_year else None)
-            open_contact_page(cfile, key, split_by_year=args.split_by_year)
-
-            # Construire contenu MMS
-            parts_parent = elem.find("parts")
-            body_chunks = []
-            media_html = []
-
-            if parts_parent is None:
-                # ancien format: parts au même niveau ?
-                parts = elem.findall("part")
-            else:
-                parts = parts_parent.findall("part")
-
-            for part in parts:
-                ct = part.attrib.get("ct", "")  # content-type
-                text = part.attrib.get("text")  # texte éventuel
-                data = part.attrib.get("data")  # base64 éventuel
-                name_attr = part.attrib.get("name") or part.attrib.get("cl")
-
-                if ct.startswith("text"):
-                    if text:
-                        body_chunks.append(render_text(text))
-                    continue
-
-                # Media
-                if data:
-                    try:
-                        blob = base64.b64decode(data, validate=False)
-                    except Exception:
-                        blob = base64.b64decode(data + "==")
-                    media_counter += 1
-                    fname = guess_part_filename(media_counter, ct, name_attr)
-                    fpath = os.path.join(media_dir, fname)
-                    with open(fpath, "wb") as mf:
-                        mf.write(blob)
-
-                    # Affichage selon type
-                    if ct.startswith("image/"):
-                        media_html.append(f'<div class="media"><a href="../media/{fname}" target="_blank"><img src="../media/{fname}" alt="{html.escape(ct)}"></a></div>')
-                    elif ct.startswith("video/"):
-                        media_html.append(f'<div class="media"><video controls src="../media/{fname}"></video></div>')
-                    elif ct.startswith("audio/"):
-                        media_html.append(f'<div class="media"><audio controls src="../media/{fname}"></audio></div>')
-                    else:
-                        media_html.append(f'<div class="media"><a href="../media/{fname}" download>Télécharger {html.escape(ct)}</a></div>')
-                else:
-                    # Pas de base64 -> on laisse un lien symbolique si nom connu
-                    if name_attr:
-                        media_html.append(f'<div class="media"><em>(Pièce jointe non incluse dans le backup : {html.escape(name_attr)})</em></div>')
-
-            body_html = "<br>".join(body_chunks) if body_chunks else "<em>(MMS sans texte)</em>"
-            if media_html:
-                body_html += "<br>" + "\n".join(media_html)
-
-            # séparateur d'année éventuel
-            ysep = None
-            if not args.split_by_year:
-                prev = last_year_by_contact.get(key)
-                if year and prev != year:
-                    ysep = year
-                    last_year_by_contact[key] = year
-
-            write_msg(
-                cfile,
-                direction,
-                date_str,
-                "Moi" if direction == "out" else key,
-                body_html,
-                year_sep=ysep
-            )
-
-            contact_stats[key]["count"] += 1
-            contact_stats[key]["files"].add(cfile)
-            total_msgs += 1
-
-            if total_msgs % 10000 == 0:
-                print(f"[+] {total_msgs} messages traités...")
-
-            if args.limit and total_msgs >= args.limit:
-                root.clear()
-                break
-
-            root.clear()
-
-        # d'autres balises : <rcs> n’est pas standardisé dans ce backup ; souvent intégrés comme <sms> ou <mms>.
-        else:
-            root.clear()
-
-    # Clore toutes les pages contact
-    for key in known_contacts:
-        for cfile in contact_stats[key]["files"]:
-            # n’ajoute le footer qu’une fois par fichier (si absent)
-            with open(cfile, "rb") as ck:
-                tail = ck.read()[-2000:]
-            if b"</html>" not in tail:
-                close_contact_page(cfile)
-
-    # Générer les cartes contacts dans l'index
-    # tri par nb messages décroissant
-    sorted_contacts = sorted(known_contacts, key=lambda k: contact_stats[k]["count"], reverse=True)
-    for key in sorted_contacts:
-        count = contact_stats[key]["count"]
-        # si split par année, on pointe vers une "page sommaire" auto : on crée une nav
-        # autrement, un seul fichier.
-        files = sorted(list(contact_stats[key]["files"]))
-        if len(files) == 1:
-            rel = os.path.relpath(files[0], out_dir)
-            index_cards_buffer.append(
-                f'<div class="contact"><h3>{html.escape(key)}</h3><div class="meta">{count} messages</div>'
-                f'<p><a href="{html.escape(rel)}">Ouvrir la conversation</a></p></div>\n'
-            )
-        else:
-            # Créer une page sommaire par contact listant les années
-            contact_summary = os.path.join(os.path.dirname(files[0]), safe_filename(key) + "__SOMMAIRE.html")
-            if not os.path.exists(contact_summary):
-                write_if_new(contact_summary, HTML_HEADER.replace("{title}", f"Sommaire — {html.escape(key)}") +
-                             f'<div class="header"><h1 class="h1">📂 {html.escape(key)} — Sommaire</h1></div>\n<div class="nav">\n')
-                # ajouter liens vers fichiers (année)
-                for fp in sorted(files):
-                    label = os.path.splitext(os.path.basename(fp))[0]
-                    # extraire l'année depuis le suffixe __YYYY
-                    m = re.search(r"__([12][0-9]{3})$", label)
-                    lab = m.group(1) if m else label
-                    relf = os.path.relpath(fp, os.path.dirname(contact_summary))
-                    append(contact_summary, f'<a href="{html.escape(relf)}">{html.escape(lab)}</a>\n')
-                append(contact_summary, "</div>\n" + HTML_FOOTER)
-
-            rel = os.path.relpath(contact_summary, out_dir)
-            index_cards_buffer.append(
-                f'<div class="contact"><h3>{html.escape(key)}</h3><div class="meta">{count} messages</div>'
-                f'<p><a href="{html.escape(rel)}">Voir les années</a></p></div>\n'
-            )
-
-    append(index_path, "".join(index_cards_buffer))
-    append(index_path, "</div>\n" + HTML_FOOTER)
-
-    # Petit CSV de stats
-    with open(os.path.join(out_dir, "contacts_stats.csv"), "w", newline="", encoding="utf-8") as f:
-        w = csv.writer(f)
-        w.writerow(["contact", "messages", "fichiers_html"])
-        for key in sorted_contacts:
-            w.writerow([key, contact_stats[key]["count"], " | ".join(sorted(os.path.relpath(p, out_dir) for p in contact_stats[key]["files"]))])
-
-    print(f"✅ Terminé : {total_msgs} messages traités, {len(known_contacts)} contacts.")
+        pipeline.close()
+        close_thumbs(thumbs)
+        shutil.rmtree(spool_dir, ignore_errors=True)
+
+        # Clore toutes les pages contact : vider les tampons, puis footer une fois par fichier (si absent)
+        writers.close_all()
+        print(f"[+] Médias : {media_store.written} fichiers écrits, {media_store.reused} contenus dédoublonnés")
+        print(f"[+] Pages contact : {writers.opens} ouvertures, {writers.evictions} évictions du cache (max {writers.max_open} ouvertes)")
+        for stats in contact_stats.values():
+            for cfile in stats["files"]:
+                if not has_footer(cfile):
+                    close_contact_page(cfile)
+
+        # Générer les cartes contacts dans l'index, tri par nb messages décroissant, + petit CSV de stats
+        sorted_contacts = sorted(contact_stats, key=lambda k: contact_stats[k]["count"], reverse=True)
+        write_index_and_stats(out_dir, index_path, (
+            (key, contact_stats[key]["count"], contact_stats[key]["files"]) for key in sorted_contacts))
+        n_contacts = len(contact_stats)
+
+    print(f"✅ Terminé : {total_msgs} messages traités, {n_contacts} contacts.")
     print(f"→ Ouvre {index_path}")
 
 if __name__ == "__main__":
@@ -0,0 +1,94 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+generer_sms_xml.py
+
+Génère une fausse sauvegarde "SMS Backup & Restore" (XML) pour les benchmarks.
+
+Usage:
+  python3 generer_sms_xml.py --out /tmp/bench.xml --count 200000 --contacts 500 --skew 1.1 \
+      --mms-ratio 0.1 --attachment-kb 200 --repeat-ratio 0.3
+
+- --skew : répartition des messages entre contacts (loi de Zipf, 0 = uniforme)
+- --mms-ratio : part de MMS (avec une pièce jointe base64) parmi les messages
+- --repeat-ratio : part des pièces jointes reprises d'un petit stock (memes transférés, photos de groupe)
+- --unsorted : dates mélangées (le XML n'est plus dans l'ordre chronologique)
+"""
+
+import random
+import base64
+import argparse
+from itertools import accumulate
+from xml.sax.saxutils import quoteattr
+
+WORDS = ("bonjour salut ça va merci demain soir ce midi on se voit quand tu rentres "
+         "d'accord super photo regarde rendez-vous gare train bisous à plus tard "
+         "réunion projet vacances anniversaire café resto ciné").split()
+URLS = ["https://exemple.fr/article", "http://maps.example.com/?q=gare", "https://youtu.be/dQw4w9WgXcQ"]
+START_MS = 1_400_000_000_000
+SPAN_MS = 10 * 365 * 24 * 3600 * 1000
+
+
+def random_body(rnd):
+    words = rnd.choices(WORDS, k=rnd.randint(2, 30))
+    if rnd.random() < 0.05:
+        words.insert(rnd.randrange(len(words)), rnd.choice(URLS))
+    return ' '.join(words)
+
+
+def generate(out, count, contacts=200, skew=1.0, mms_ratio=0.1, attachment_kb=100, repeat_ratio=0.2,
+             unsorted=False, seed=42):
+    """Écrit count messages dans out ; renvoie le nombre d'octets écrits."""
+    rnd = random.Random(seed)
+    addresses = [f'+336{rnd.randrange(10**8):08d}' for _ in range(contacts)]
+    names = [f'Contact {i:04d}' for i in range(contacts)]
+    cum_weights = list(accumulate(1.0 / (i + 1) ** skew for i in range(contacts)))
+    attach_bytes = max(1, int(attachment_kb * 1024))
+    pool = [base64.b64encode(rnd.randbytes(attach_bytes)).decode('ascii') for _ in range(8)]
+    step = SPAN_MS // max(1, count)
+
+    with open(out, 'w', encoding='utf-8') as f:
+        f.write("<?xml version='1.0' encoding='UTF-8' standalone='yes' ?>\n")
+        f.write(f'<smses count="{count}" backup_set="bench" backup_date="{START_MS + SPAN_MS}">\n')
+        for i in range(count):
+            c = rnd.choices(range(contacts), cum_weights=cum_weights)[0]
+            date = START_MS + (rnd.randrange(SPAN_MS) if unsorted else i * step + rnd.randrange(max(1, step)))
+            inbound = rnd.random() < 0.5
+            if rnd.random() < mms_ratio:
+                if rnd.random() < repeat_ratio:
+                    data = rnd.choice(pool)
+                else:
+                    data = base64.b64encode(rnd.randbytes(attach_bytes)).decode('ascii')
+                f.write(f'  <mms date="{date}" msg_box="{1 if inbound else 2}" address={quoteattr(addresses[c])} '
+                        f'contact_name={quoteattr(names[c])}>\n    <parts>\n'
+                        f'      <part seq="0" ct="text/plain" name="null" text={quoteattr(random_body(rnd))} />\n'
+                        f'      <part seq="1" ct="image/jpeg" name="IMG_{i:07d}.jpg" data="{data}" />\n'
+                        f'    </parts>\n  </mms>\n')
+            else:
+                f.write(f'  <sms protocol="0" address={quoteattr(addresses[c])} date="{date}" '
+                        f'type="{1 if inbound else 2}" body={quoteattr(random_body(rnd))} '
+                        f'contact_name={quoteattr(names[c])} />\n')
+        f.write('</smses>\n')
+        return f.tell()
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Génère un XML SMS Backup & Restore synthétique.")
+    ap.add_argument('--out', required=True, help='Fichier XML à écrire')
+    ap.add_argument('--count', type=int, default=100000, help='Nombre de messages')
+    ap.add_argument('--contacts', type=int, default=200, help='Nombre de correspondants')
+    ap.add_argument('--skew', type=float, default=1.0, help='Exposant de Zipf de la répartition par contact (0 = uniforme)')
+    ap.add_argument('--mms-ratio', type=float, default=0.1, help='Part de MMS avec pièce jointe')
+    ap.add_argument('--attachment-kb', type=float, default=100, help='Taille de chaque pièce jointe (Ko, avant base64)')
+    ap.add_argument('--repeat-ratio', type=float, default=0.2, help='Part des pièces jointes identiques à une précédente')
+    ap.add_argument('--unsorted', action='store_true', help='Dates dans le désordre')
+    ap.add_argument('--seed', type=int, default=42)
+    args = ap.parse_args()
+    size = generate(args.out, args.count, contacts=args.contacts, skew=args.skew, mms_ratio=args.mms_ratio,
+                    attachment_kb=args.attachment_kb, repeat_ratio=args.repeat_ratio, unsorted=args.unsorted,
+                    seed=args.seed)
+    print(f'{args.count} messages, {size / 1e6:.1f} Mo -> {args.out}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,403 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+serveur_async.py
+
+Mode de service "production" de l'archive (python3 "Sms Sqlite Flask Exporter.py" --serve --server async) :
+
+- boucle asyncio (HTTP/1.1, keep-alive) : une connexion lente ne bloque personne
+- /media/... servi directement par la boucle : os.sendfile (zéro copie) + requêtes Range (206/416),
+  ETag / Cache-Control (immutable pour les médias nommés par sha256) et réponses 304
+- le reste (recherche, conversations...) délégué à l'application Flask (WSGI) dans un pool de
+  threads borné : les requêtes SQLite ne bloquent jamais la boucle, et au plus threads * 4
+  requêtes attendent leur tour
+- --workers N : N processus (fork), chacun avec sa boucle, sa propre application et ses connexions
+  SQLite, sur le même port (SO_REUSEPORT si disponible, sinon socket d'écoute partagée)
+
+Aucune dépendance hors bibliothèque standard (Flask n'est utilisé que par l'application déléguée,
+qui gère elle-même ETag et compression gzip de ses pages).
+"""
+
+import io
+import os
+import sys
+import socket
+import asyncio
+import mimetypes
+import email.utils
+import urllib.parse
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+
+from sms_commun import media_validators, etag_matches
+
+MAX_HEADER_BYTES = 64 * 1024
+MAX_BODY_BYTES = 1024 * 1024
+STREAM_FLUSH_BYTES = 64 * 1024  # réponses en flux envoyées par paquets de cette taille
+HEADER_TIMEOUT = 30      # secondes pour recevoir les en-têtes d'une requête
+KEEPALIVE_TIMEOUT = 15   # secondes d'inactivité avant de fermer une connexion
+
+REASONS = {200: 'OK', 206: 'Partial Content', 304: 'Not Modified', 400: 'Bad Request', 404: 'Not Found',
+           405: 'Method Not Allowed', 413: 'Payload Too Large', 416: 'Range Not Satisfiable',
+           500: 'Internal Server Error', 503: 'Service Unavailable'}
+
+
+def parse_range(value, size):
+    """En-tête Range (une seule plage "bytes=a-b", "a-" ou "-n") -> (début, fin incluse).
+
+    None si absent ou syntaxiquement invalide ("a-b" avec a > b compris : ignoré, réponse complète),
+    ValueError si la plage est insatisfaisable (début au-delà du fichier, suffixe "-0") : 416.
+    """
+    if not value or not value.startswith('bytes=') or ',' in value:
+        return None
+    first, _, last = value[6:].strip().partition('-')
+    try:
+        if first:
+            start = int(first)
+            end = int(last) if last else size - 1
+        else:
+            n = int(last)
+    except ValueError:
+        return None
+    if first and last and start > end:
+        return None
+    if not first:
+        if n <= 0:
+            raise ValueError(value)
+        start, end = max(0, size - n), size - 1
+    if start >= size:
+        raise ValueError(value)
+    return start, min(end, size - 1)
+
+
+class Request:
+    __slots__ = ('method', 'target', 'path', 'query', 'version', 'headers', 'body')
+
+    def __init__(self, method, target, version, headers):
+        self.method = method
+        self.target = target
+        self.version = version
+        self.headers = headers  # noms en minuscules
+        path, _, self.query = target.partition('?')
+        self.path = path
+        self.body = b''
+
+    @property
+    def keep_alive(self):
+        conn = self.headers.get('connection', '').lower()
+        if self.version == 'HTTP/1.1':
+            return conn != 'close'
+        return conn == 'keep-alive'
+
+
+class AsyncServer:
+    """Serveur HTTP asyncio : médias en sendfile dans la boucle, reste délégué à une application WSGI."""
+
+    def __init__(self, wsgi_app, media_dir, threads=8, media_prefix='/media/', multiprocess=False):
+        self.app = wsgi_app
+        self.media_root = os.path.realpath(media_dir)
+        self.media_prefix = media_prefix
+        self.executor = ThreadPoolExecutor(max_workers=threads, thread_name_prefix='wsgi')
+        # au-delà, les nouvelles requêtes attendent dans la boucle au lieu de remplir la file du pool
+        self.slots = asyncio.Semaphore(threads * 4)
+        self.multiprocess = multiprocess
+        self.server_name = socket.gethostname()
+        self.server_port = '0'
+
+    # ---------- lecture des requêtes ----------
+
+    async def read_request(self, reader):
+        head = await reader.readuntil(b'\r\n\r\n')
+        lines = head.decode('latin-1').split('\r\n')
+        method, target, version = lines[0].split(' ', 2)
+        headers = {}
+        for line in lines[1:]:
+            if not line:
+                continue
+            name, _, value = line.partition(':')
+            name = name.strip().lower()
+            value = value.strip()
+            headers[name] = f'{headers[name]}, {value}' if name in headers else value
+        req = Request(method.upper(), target, version.strip(), headers)
+        length = int(headers.get('content-length') or 0)
+        if length > MAX_BODY_BYTES:
+            raise OverflowError(length)
+        if length:
+            req.body = await reader.readexactly(length)
+        return req
+
+    async def handle(self, reader, writer):
+        try:
+            first = True
+            while True:
+                try:
+                    req = await asyncio.wait_for(self.read_request(reader), HEADER_TIMEOUT if first else KEEPALIVE_TIMEOUT)
+                except (asyncio.IncompleteReadError, asyncio.TimeoutError, ConnectionError):
+                    return
+                except asyncio.LimitOverrunError:
+                    await self.send_simple(writer, 400, keep_alive=False)
+                    return
+                except OverflowError:
+                    await self.send_simple(writer, 413, keep_alive=False)
+                    return
+                except ValueError:
+                    await self.send_simple(writer, 400, keep_alive=False)
+                    return
+                first = False
+                keep_alive = req.keep_alive
+                if req.path.startswith(self.media_prefix) and req.method in ('GET', 'HEAD'):
+                    await self.send_media(writer, req, keep_alive)
+                else:
+                    async with self.slots:
+                        keep_alive = await self.run_wsgi(writer, req, keep_alive)
+                if not keep_alive:
+                    return
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+
+    # ---------- réponses ----------
+
+    @staticmethod
+    def head_bytes(status, headers, version='HTTP/1.1'):
+        reason = REASONS.get(status, '')
+        lines = [f'{version} {status} {reason}'] + [f'{k}: {v}' for k, v in headers] + ['', '']
+        return '\r\n'.join(lines).encode('latin-1')
+
+    async def send_simple(self, writer, status, keep_alive=True, headers=(), body=None):
+        body = body if body is not None else f'{status} {REASONS.get(status, "")}\n'.encode()
+        hdrs = [('Content-Type', 'text/plain; charset=utf-8'), ('Content-Length', str(len(body))),
+                ('Connection', 'keep-alive' if keep_alive else 'close'), *headers]
+        writer.write(self.head_bytes(status, hdrs) + body)
+        await writer.drain()
+
+    def media_path(self, req):
+        rel = urllib.parse.unquote(req.path[len(self.media_prefix):])
+        path = os.path.realpath(os.path.join(self.media_root, rel))
+        if not path.startswith(self.media_root + os.sep) or not os.path.isfile(path):
+            return None
+        return path
+
+    @staticmethod
+    def not_modified(req, etag, mtime):
+        """Requête conditionnelle satisfaite (304) ? If-None-Match prime sur If-Modified-Since."""
+        if_none_match = req.headers.get('if-none-match')
+        if if_none_match:
+            return etag_matches(if_none_match, etag)
+        since = req.headers.get('if-modified-since')
+        if not since:
+            return False
+        try:
+            return int(mtime) <= email.utils.parsedate_to_datetime(since).timestamp()
+        except (TypeError, ValueError):
+            return False
+
+    async def send_media(self, writer, req, keep_alive):
+        path = self.media_path(req)
+        if path is None:
+            await self.send_simple(writer, 404, keep_alive)
+            return
+        with open(path, 'rb') as f:
+            st = os.fstat(f.fileno())
+            size = st.st_size
+            tag, cache_control = media_validators(os.path.relpath(path, self.media_root), st)
+            etag = f'"{tag}"'
+            validators = [('ETag', etag), ('Cache-Control', cache_control),
+                          ('Last-Modified', email.utils.formatdate(st.st_mtime, usegmt=True))]
+            if self.not_modified(req, etag, st.st_mtime):
+                head = validators + [('Connection', 'keep-alive' if keep_alive else 'close')]
+                writer.write(self.head_bytes(304, head))
+                await writer.drain()
+                return
+            range_header = req.headers.get('range')
+            if_range = req.headers.get('if-range')
+            if if_range and if_range != etag:
+                # If-Range périmé : le fichier a changé depuis le premier morceau, on renvoie tout
+                range_header = None
+            try:
+                rng = parse_range(range_header, size)
+            except ValueError:
+                await self.send_simple(writer, 416, keep_alive, headers=[('Content-Range', f'bytes */{size}')], body=b'')
+                return
+            start, end = rng if rng else (0, size - 1)
+            length = end - start + 1 if size else 0
+            ctype = mimetypes.guess_type(path)[0] or 'application/octet-stream'
+            headers = [('Content-Type', ctype), ('Content-Length', str(length)), ('Accept-Ranges', 'bytes'),
+                       *validators, ('Connection', 'keep-alive' if keep_alive else 'close')]
+            if rng:
+                headers.append(('Content-Range', f'bytes {start}-{end}/{size}'))
+            writer.write(self.head_bytes(206 if rng else 200, headers))
+            await writer.drain()
+            if req.method == 'GET' and length:
+                # os.sendfile sur la socket : le contenu ne passe pas par Python
+                await asyncio.get_running_loop().sendfile(writer.transport, f, start, length)
+
+    def environ(self, req, writer):
+        path = urllib.parse.unquote_to_bytes(req.path).decode('latin-1')
+        peer = writer.get_extra_info('peername') or ('', 0)
+        env = {
+            'REQUEST_METHOD': req.method, 'SCRIPT_NAME': '', 'PATH_INFO': path, 'QUERY_STRING': req.query,
+            'SERVER_NAME': self.server_name, 'SERVER_PORT': self.server_port, 'SERVER_PROTOCOL': req.version,
+            'REMOTE_ADDR': peer[0], 'REMOTE_PORT': str(peer[1]),
+            'wsgi.version': (1, 0), 'wsgi.url_scheme': 'http', 'wsgi.input': io.BytesIO(req.body),
+            'wsgi.errors': sys.stderr, 'wsgi.multithread': True, 'wsgi.multiprocess': self.multiprocess,
+            'wsgi.run_once': False,
+        }
+        for name, value in req.headers.items():
+            key = name.upper().replace('-', '_')
+            if key in ('CONTENT_TYPE', 'CONTENT_LENGTH'):
+                env[key] = value
+            else:
+                env['HTTP_' + key] = value
+        return env
+
+    async def run_wsgi(self, writer, req, keep_alive):
+        """Exécute l'application dans le pool ; chaque morceau produit est écrit (avec contre-pression)
+        depuis le thread via la boucle. Renvoie False si la connexion doit être fermée."""
+        loop = asyncio.get_running_loop()
+        env = self.environ(req, writer)
+        http11 = req.version == 'HTTP/1.1'
+        head_only = req.method == 'HEAD'
+        state = {'status': None, 'headers': None, 'sent': False, 'chunked': False, 'keep_alive': keep_alive}
+
+        async def send(data):
+            writer.write(data)
+            await writer.drain()
+
+        def emit(data):
+            asyncio.run_coroutine_threadsafe(send(data), loop).result()
+
+        def start_response(status, headers, exc_info=None):
+            if exc_info and state['sent']:
+                raise exc_info[1].with_traceback(exc_info[2])
+            state['status'] = int(status.split(' ', 1)[0])
+            state['headers'] = list(headers)
+            return write
+
+        def send_headers(final_body=None):
+            headers = [(k, v) for k, v in state['headers'] if k.lower() != 'connection']
+            has_length = any(k.lower() == 'content-length' for k, _ in headers)
+            if not has_length and not head_only:
+                if final_body is not None:
+                    # réponse entière déjà connue : longueur exacte plutôt que chunked
+                    headers.append(('Content-Length', str(len(final_body))))
+                elif http11:
+                    state['chunked'] = not head_only
+                    headers.append(('Transfer-Encoding', 'chunked'))
+                else:
+                    state['keep_alive'] = False
+            headers.append(('Connection', 'keep-alive' if state['keep_alive'] else 'close'))
+            state['sent'] = True
+            return self.head_bytes(state['status'], headers, 'HTTP/1.1')
+
+        def write(data):
+            if not data:
+                return
+            head = b'' if state['sent'] else send_headers()
+            if head_only:
+                data = b''
+            elif state['chunked']:
+                data = b'%x\r\n%s\r\n' % (len(data), data)
+            emit(head + data)
+
+        def call():
+            result = self.app(env, start_response)
+            pending, size = [], 0
+            try:
+                # les générateurs (gabarits en flux) produisent beaucoup de petits morceaux :
+                # regroupés par STREAM_FLUSH_BYTES, un aller-retour vers la boucle par paquet
+                for chunk in result:
+                    if chunk:
+                        pending.append(chunk)
+                        size += len(chunk)
+                    if size >= STREAM_FLUSH_BYTES:
+                        write(b''.join(pending))
+                        pending, size = [], 0
+                body = b''.join(pending)
+                if not state['sent']:
+                    # réponse entière tenue en mémoire : un seul write, avec Content-Length
+                    emit(send_headers(final_body=body) + (b'' if head_only else body))
+                    return
+                write(body)
+                if state['chunked']:
+                    emit(b'0\r\n\r\n')
+            finally:
+                close = getattr(result, 'close', None)
+                if close:
+                    close()
+
+        try:
+            await loop.run_in_executor(self.executor, call)
+        except ConnectionError:
+            return False
+        except Exception:
+            import traceback
+            traceback.print_exc()
+            if not state['sent']:
+                await self.send_simple(writer, 500, keep_alive=False)
+            return False
+        return state['keep_alive']
+
+
+def listen_socket(host, port, reuse_port=False, backlog=1024):
+    family = socket.AF_INET6 if ':' in host else socket.AF_INET
+    sock = socket.socket(family, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    sock.listen(backlog)
+    sock.setblocking(False)
+    return sock
+
+
+def worker_main(app_factory, media_dir, sock, host, port, threads, multiprocess):
+    """Un processus de service : application créée ici (connexions SQLite propres au processus)."""
+    if sock is None:
+        sock = listen_socket(host, port, reuse_port=True)
+    server = AsyncServer(app_factory(), media_dir, threads=threads, multiprocess=multiprocess)
+    server.server_port = str(port)
+
+    async def main():
+        srv = await asyncio.start_server(server.handle, sock=sock, limit=MAX_HEADER_BYTES)
+        async with srv:
+            await srv.serve_forever()
+
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
+
+
+def serve(app_factory, media_dir, host='127.0.0.1', port=5000, workers=1, threads=8):
+    """Lance workers processus de service (app_factory() appelée dans chacun) sur host:port."""
+    workers = max(1, workers)
+    if workers > 1 and not hasattr(os, 'fork'):
+        print('--workers > 1 nécessite fork() : un seul processus')
+        workers = 1
+    reuse_port = workers > 1 and hasattr(socket, 'SO_REUSEPORT')
+    # vérifie le port (et le réserve) avant de démarrer quoi que ce soit
+    shared = listen_socket(host, port, reuse_port=reuse_port)
+    print(f'Serveur async sur http://{host}:{port} — {workers} processus × {threads} threads SQLite'
+          + (' (SO_REUSEPORT)' if reuse_port else ''))
+    if workers == 1:
+        worker_main(app_factory, media_dir, shared, host, port, threads, False)
+        return
+    ctx = multiprocessing.get_context('fork')
+    procs = []
+    for i in range(workers):
+        # avec SO_REUSEPORT chaque processus a sa propre file d'attente (répartition par le noyau)
+        sock = None if (reuse_port and i > 0) else shared
+        p = ctx.Process(target=worker_main, args=(app_factory, media_dir, sock, host, port, threads, True), daemon=True)
+        p.start()
+        procs.append(p)
+    shared.close()
+    try:
+        for p in procs:
+            p.join()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for p in procs:
+            p.terminate()
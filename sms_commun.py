@@ -0,0 +1,519 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+sms_commun.py
+
+Briques partagées par "Sms Sqlite Flask Exporter.py" et export_sms_html.py :
+
+- découpage du flux <smses> en paquets d'enregistrements <sms>/<mms> complets
+  (lecture binaire, sans construire l'arbre XML complet)
+- extraction normalisée des champs d'un <sms>/<mms> (dont décodage base64 des parts)
+- pipeline multi-processus ordonné : lecteur -> pool de workers -> un seul écrivain
+- stockage des médias adressé par contenu (sha256, sous-dossiers aa/bb/)
+- décodage base64 en flux des gros attributs data="..." (vidéos) vers un fichier, sans
+  jamais garder la chaîne complète en mémoire
+- miniatures JPEG des images, rangées par sha256 sous <médias>/thumbs/ (Pillow optionnel)
+- rendu HTML du texte d'un message (échappement + liens), commun au serveur et à l'export
+- validateurs HTTP des médias (ETag, Cache-Control), communs aux deux serveurs
+"""
+
+import os
+import re
+import html
+import base64
+import binascii
+import itertools
+import hashlib
+import collections
+import multiprocessing
+import xml.etree.ElementTree as ET
+
+DEFAULT_CHUNK_BYTES = 4 * 1024 * 1024
+# au-delà, une valeur data="..." est décodée en flux vers un fichier par le lecteur
+DEFAULT_SPOOL_BYTES = 1024 * 1024
+
+# début d'un enregistrement de premier niveau : <sms ...> ou <mms ...>
+RECORD_START = re.compile(rb'<(?:sms|mms)[\s/>]')
+
+
+def _last_record_start(buf, lo):
+    """Position du dernier début d'enregistrement strictement après lo (ou -1)."""
+    pos = len(buf)
+    while True:
+        i = max(buf.rfind(b'<sms', lo + 1, pos), buf.rfind(b'<mms', lo + 1, pos))
+        if i == -1:
+            return -1
+        if RECORD_START.match(buf, i):
+            return i
+        pos = i
+
+
+class SpooledBlob:
+    """Contenu d'une part déjà décodé sur disque par le lecteur (gros attribut data)."""
+
+    __slots__ = ('path', 'size')
+
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+
+    def __len__(self):
+        return self.size
+
+    def discard(self):
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+def discard_spooled(elem):
+    """Supprime les fichiers décodés par le lecteur pour un enregistrement qui ne sera pas stocké."""
+    for part in elem.iter('part'):
+        data_file = part.attrib.get('data_file')
+        if data_file:
+            SpooledBlob(data_file, 0).discard()
+
+
+DATA_ATTR = b' data="'
+# retours à la ligne (bruts ou en entités) qu'on peut trouver dans une valeur base64
+_B64_JUNK = re.compile(rb'\s+|&#(?:10|13|x[aAdD]);')
+_spool_ids = itertools.count()
+
+
+def _spool_b64(data, f, spool_dir, block=1024 * 1024):
+    """Décode la valeur base64 qui commence au début de data (suite lue dans f) vers un fichier.
+
+    Renvoie (SpooledBlob, sha256, octets lus après le guillemet fermant, longueur de la valeur).
+    """
+    path = os.path.join(spool_dir, f'{os.getpid()}-{next(_spool_ids)}.part')
+    h = hashlib.sha256()
+    size = 0
+    value_len = 0
+    carry = b''
+    with open(path, 'wb') as out:
+        while True:
+            q = data.find(b'"')
+            piece = data if q == -1 else data[:q]
+            value_len += len(piece)
+            piece = carry + piece
+            if q == -1:
+                # garder pour le tour suivant une entité coupée et les caractères hors multiple de 4
+                keep = b''
+                amp = piece.rfind(b'&')
+                if amp != -1 and b';' not in piece[amp:]:
+                    piece, keep = piece[:amp], piece[amp:]
+                piece = _B64_JUNK.sub(b'', piece)
+                n = len(piece) // 4 * 4
+                piece, carry = piece[:n], piece[n:] + keep
+            else:
+                piece = _B64_JUNK.sub(b'', piece)
+                if len(piece) % 4 == 1:
+                    piece = piece[:-1]
+                piece += b'=' * (-len(piece) % 4)
+            raw = binascii.a2b_base64(piece)
+            out.write(raw)
+            h.update(raw)
+            size += len(raw)
+            if q != -1:
+                return SpooledBlob(path, size), h.hexdigest(), data[q + 1:], value_len
+            data = f.read(block)
+            if not data:
+                raise ValueError('attribut data non terminé en fin de fichier')
+
+
+def _spool_large_values(buf, scan, f, spool_dir, threshold, splices):
+    """Remplace dans buf chaque valeur data="..." de plus de threshold octets par une référence
+    (data_file, data_sha256, data_size) vers son contenu décodé en flux.
+
+    splices reçoit (position, octets retirés) pour garder des offsets de fichier exacts.
+    Renvoie la position jusqu'où buf a été examiné.
+    """
+    while True:
+        i = buf.find(DATA_ATTR, scan)
+        if i == -1:
+            return max(scan, len(buf) - len(DATA_ATTR))
+        vstart = i + len(DATA_ATTR)
+        j = buf.find(b'"', vstart, vstart + threshold + 1)
+        if j != -1:
+            # petite valeur : laissée telle quelle
+            scan = j + 1
+            continue
+        if len(buf) - vstart <= threshold:
+            # valeur encore incomplète : attendre la suite du fichier
+            return i
+        spooled, digest, rest, value_len = _spool_b64(bytes(buf[vstart:]), f, spool_dir)
+        attr = (f' data_file="{html.escape(spooled.path)}" data_sha256="{digest}"'
+                f' data_size="{spooled.size}"').encode('utf-8')
+        buf[i:] = attr + rest
+        splices.append((i, len(DATA_ATTR) + value_len + 1 - len(attr)))
+        scan = i + len(attr)
+
+
+def iter_record_chunks(xml_path, chunk_bytes=DEFAULT_CHUNK_BYTES, start=0, spool_dir=None,
+                       spool_threshold=DEFAULT_SPOOL_BYTES):
+    """Découpe le fichier en paquets d'environ chunk_bytes contenant uniquement des enregistrements complets.
+
+    Produit des tuples (offset_debut, offset_fin, octets). start doit être 0 ou l'offset
+    d'un début d'enregistrement (ex: offset_fin d'un paquet précédent).
+    Avec spool_dir, les valeurs data="..." de plus de spool_threshold octets sont décodées
+    en flux dans ce dossier et remplacées dans le paquet par un attribut data_file :
+    la mémoire reste bornée quelle que soit la taille des pièces jointes.
+    """
+    with open(xml_path, 'rb') as f:
+        buf = bytearray()
+        base = start
+        scan = 0
+        splices = []  # (position dans buf, octets retirés) : buf est plus court que le fichier
+
+        def spool():
+            return _spool_large_values(buf, scan, f, spool_dir, spool_threshold, splices) if spool_dir else scan
+
+        f.seek(start)
+        if start == 0:
+            # sauter l'entête <?xml ...?><smses ...> jusqu'au premier enregistrement
+            while True:
+                data = f.read(chunk_bytes)
+                buf += data
+                m = RECORD_START.search(buf)
+                if m:
+                    base = m.start()
+                    del buf[:m.start()]
+                    break
+                if not data:
+                    return
+            scan = spool()
+        eof = False
+        while True:
+            if not eof and len(buf) < chunk_bytes:
+                data = f.read(chunk_bytes)
+                if data:
+                    buf += data
+                    scan = spool()
+                    continue
+                eof = True
+            if eof:
+                removed = sum(n for _, n in splices)
+                end = buf.rfind(b'</smses')
+                if end != -1:
+                    removed += len(buf) - end
+                    del buf[end:]
+                if buf.strip():
+                    yield base, base + len(buf) + removed, bytes(buf)
+                return
+            cut = _last_record_start(buf, 0)
+            if cut == -1:
+                # enregistrement plus gros que chunk_bytes : lire davantage
+                data = f.read(chunk_bytes)
+                if data:
+                    buf += data
+                    scan = spool()
+                else:
+                    eof = True
+                continue
+            removed = sum(n for p, n in splices if p < cut)
+            splices = [(p - cut, n) for p, n in splices if p >= cut]
+            yield base, base + cut + removed, bytes(buf[:cut])
+            del buf[:cut]
+            base += cut + removed
+            scan = max(0, scan - cut)
+
+
+# à incrémenter à chaque changement de render_text : les body_html stockés sont alors recalculés
+RENDER_VERSION = 1
+URL_RE = re.compile(r'(https?://[^\s<]+)')
+
+
+def render_text(text):
+    """Texte brut -> HTML sûr : échappement, URLs en liens (nouvel onglet, sans window.opener), sauts de ligne."""
+    if not text:
+        return ''
+    t = html.escape(text)
+    t = URL_RE.sub(r'<a href="\1" target="_blank" rel="noopener">\1</a>', t)
+    return t.replace('\n', '<br>')
+
+
+def parse_chunk(chunk):
+    """Éléments <sms>/<mms> d'un paquet produit par iter_record_chunks."""
+    root = ET.fromstring(b'<smses>' + chunk + b'</smses>')
+    return [e for e in root if e.tag.lower() in ('sms', 'mms')]
+
+
+def decode_b64(data):
+    try:
+        return base64.b64decode(data, validate=False)
+    except Exception:
+        return base64.b64decode(data + '==')
+
+
+def message_fields(elem):
+    """Champs normalisés d'un <sms> ou <mms>.
+
+    Renvoie un dict : typ, address, name, date_ms, direction, body (texte SMS) et
+    parts (MMS, dans l'ordre) : ('text', texte) | ('media', ct, nom, octets, sha256) | ('missing', nom).
+    """
+    a = elem.attrib
+    address = a.get('address') or a.get('address_email') or ''
+    name = a.get('contact_name') or a.get('name') or ''
+    date_ms = a.get('date')
+    if elem.tag.lower() == 'sms':
+        # 1=inbox, 2=sent (convention Android)
+        direction = 'in' if a.get('type') == '1' else 'out'
+        return {'typ': 'sms', 'address': address, 'name': name, 'date_ms': date_ms,
+                'direction': direction, 'body': a.get('body') or '', 'parts': []}
+
+    box = a.get('msg_box') or a.get('box') or a.get('m_type')
+    direction = 'in' if box == '1' else 'out'
+    parts_parent = elem.find('parts')
+    if parts_parent is None:
+        # ancien format: parts au même niveau
+        parts_elems = elem.findall('part')
+    else:
+        parts_elems = parts_parent.findall('part')
+    parts = []
+    for part in parts_elems:
+        ct = part.attrib.get('ct') or ''
+        text = part.attrib.get('text')
+        data = part.attrib.get('data')
+        name_attr = part.attrib.get('name') or part.attrib.get('cl')
+        if ct.startswith('text') or (ct == '' and text):
+            if text:
+                parts.append(('text', text))
+            continue
+        data_file = part.attrib.get('data_file')
+        if data_file:
+            # décodé en flux par le lecteur (iter_record_chunks avec spool_dir)
+            blob = SpooledBlob(data_file, int(part.attrib.get('data_size') or 0))
+            parts.append(('media', ct, name_attr or '', blob, part.attrib.get('data_sha256')))
+        elif data:
+            blob = decode_b64(data)
+            parts.append(('media', ct, name_attr or '', blob, hashlib.sha256(blob).hexdigest()))
+        elif name_attr:
+            parts.append(('missing', name_attr))
+    return {'typ': 'mms', 'address': address, 'name': name, 'date_ms': date_ms,
+            'direction': direction, 'body': '', 'parts': parts}
+
+
+class MediaStore:
+    """Médias nommés par leur sha256 et répartis en sous-dossiers : <root>/ab/cd/abcd...<ext>.
+
+    Un même contenu (meme transféré, photo de groupe) n'est écrit qu'une fois, et aucun
+    dossier ne dépasse quelques milliers d'entrées.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+        self.written = 0
+        self.reused = 0
+
+    @staticmethod
+    def relpath(digest, ext):
+        return f'{digest[:2]}/{digest[2:4]}/{digest}{(ext or "").lower()}'
+
+    def put(self, blob, ext, digest=None):
+        """Écrit blob (octets ou SpooledBlob, alors déplacé) s'il est absent ; renvoie (sha256, chemin relatif à root)."""
+        digest = digest or hashlib.sha256(blob).hexdigest()
+        rel = self.relpath(digest, ext)
+        path = os.path.join(self.root, rel)
+        if os.path.exists(path):
+            self.reused += 1
+            if isinstance(blob, SpooledBlob):
+                blob.discard()
+            return digest, rel
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        if isinstance(blob, SpooledBlob):
+            os.replace(blob.path, path)
+        else:
+            # écriture atomique : jamais de fichier tronqué sous le nom définitif
+            tmp = f'{path}.{os.getpid()}.tmp'
+            with open(tmp, 'wb') as f:
+                f.write(blob)
+            os.replace(tmp, path)
+        self.written += 1
+        return digest, rel
+
+    def remove(self, rel):
+        try:
+            os.remove(os.path.join(self.root, rel))
+        except FileNotFoundError:
+            pass
+
+    def iter_files(self):
+        """Chemins relatifs (séparateur '/') de tous les fichiers du stockage."""
+        for dirpath, _, files in os.walk(self.root):
+            for fn in files:
+                yield os.path.relpath(os.path.join(dirpath, fn), self.root).replace(os.sep, '/')
+
+
+THUMB_DIR = 'thumbs'
+DEFAULT_THUMB_PX = 320
+
+
+def thumb_relpath(digest):
+    """Chemin (relatif à la racine des médias) de la miniature d'un contenu : une par sha256."""
+    return f'{THUMB_DIR}/{digest[:2]}/{digest[2:4]}/{digest}.jpg'
+
+
+def thumbnails_supported():
+    try:
+        import PIL.Image  # noqa: F401
+        return True
+    except ImportError:
+        return False
+
+
+def make_thumbnail(src, dst, size=DEFAULT_THUMB_PX):
+    """Worker : miniature JPEG (côté max size) de src dans dst. Renvoie True si dst existe à la fin."""
+    if os.path.exists(dst):
+        return True
+    from PIL import Image, ImageOps
+    try:
+        with Image.open(src) as im:
+            # JPEG : décodage directement à une résolution réduite (bien plus rapide qu'un resize complet)
+            im.draft('RGB', (size, size))
+            im = ImageOps.exif_transpose(im)
+            im.thumbnail((size, size))
+            if im.mode not in ('RGB', 'L'):
+                im = im.convert('RGB')
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            tmp = f'{dst}.{os.getpid()}.tmp'
+            im.save(tmp, 'JPEG', quality=80, optimize=True)
+            os.replace(tmp, dst)
+        return True
+    except Exception:
+        # image tronquée, format non reconnu, bombe de décompression...
+        return False
+
+
+class ThumbnailPool:
+    """Génère les miniatures en arrière-plan (pool de processus) pendant que l'appelant continue.
+
+    Une miniature existante n'est jamais refaite (cache disque par sha256) ; au plus
+    4 * workers images sont en vol. on_done(sha256, chemin relatif ou None) est appelé
+    dans le processus appelant, au fil des résultats.
+    """
+
+    def __init__(self, media_root, size=DEFAULT_THUMB_PX, workers=1, on_done=None):
+        self.root = media_root
+        self.size = size
+        self.workers = max(1, workers)
+        self.on_done = on_done
+        self.pool = multiprocessing.Pool(self.workers) if self.workers > 1 else None
+        self.pending = collections.deque()
+        self.seen = set()
+        self.made = 0
+        self.cached = 0
+        self.failed = 0
+
+    def submit(self, digest, rel):
+        """Planifie la miniature de <root>/rel ; renvoie son chemin relatif (le fichier peut arriver plus tard)."""
+        trel = thumb_relpath(digest)
+        if digest in self.seen:
+            return trel
+        self.seen.add(digest)
+        if os.path.exists(os.path.join(self.root, trel)):
+            self.cached += 1
+            self._done(digest, trel, True)
+            return trel
+        args = (os.path.join(self.root, rel), os.path.join(self.root, trel), self.size)
+        if self.pool is None:
+            self._finish(digest, trel, make_thumbnail(*args))
+        else:
+            self.pending.append((digest, trel, self.pool.apply_async(make_thumbnail, args)))
+            while len(self.pending) >= 4 * self.workers:
+                self._finish(*self._pop())
+        return trel
+
+    def _pop(self):
+        digest, trel, res = self.pending.popleft()
+        return digest, trel, res.get()
+
+    def _finish(self, digest, trel, ok):
+        if ok:
+            self.made += 1
+        else:
+            self.failed += 1
+        self._done(digest, trel, ok)
+
+    def _done(self, digest, trel, ok):
+        if self.on_done:
+            self.on_done(digest, trel if ok else None)
+
+    def close(self):
+        try:
+            while self.pending:
+                self._finish(*self._pop())
+        finally:
+            if self.pool is not None:
+                self.pool.close()
+                self.pool.join()
+
+
+IMMUTABLE_CACHE = 'public, max-age=31536000, immutable'
+THUMB_CACHE = 'public, max-age=86400'
+HASHED_NAME_RE = re.compile(r'[0-9a-f]{64}')
+
+
+def media_validators(relpath, st):
+    """(ETag sans guillemets, Cache-Control) d'un fichier du stockage de médias.
+
+    Un média nommé par son sha256 ne change jamais : le nom sert d'ETag et le navigateur peut le
+    garder sans revalider. Les miniatures (nommées par le sha256 de l'original, refaites si le
+    dossier thumbs/ est vidé) et les anciens noms non hachés sont revalidés sur taille + date.
+    """
+    stem = os.path.splitext(os.path.basename(relpath))[0]
+    if HASHED_NAME_RE.fullmatch(stem) and not relpath.replace(os.sep, '/').startswith(THUMB_DIR + '/'):
+        return stem, IMMUTABLE_CACHE
+    return f'{st.st_mtime_ns:x}-{st.st_size:x}', THUMB_CACHE if HASHED_NAME_RE.fullmatch(stem) else 'no-cache'
+
+
+def etag_matches(if_none_match, etag):
+    """Comparaison faible (RFC 9110) d'un en-tête If-None-Match avec un ETag (entre guillemets, W/ ou non)."""
+    if not if_none_match:
+        return False
+    if if_none_match.strip() == '*':
+        return True
+    tag = etag[2:] if etag.startswith('W/') else etag
+    for candidate in if_none_match.split(','):
+        candidate = candidate.strip()
+        if (candidate[2:] if candidate.startswith('W/') else candidate) == tag:
+            return True
+    return False
+
+
+def run_pipeline(xml_path, worker, workers=1, chunk_bytes=DEFAULT_CHUNK_BYTES, start=0, spool_dir=None,
+                 spool_threshold=DEFAULT_SPOOL_BYTES):
+    """Lecteur -> workers -> écrivain unique.
+
+    worker(chunk_bytes) -> liste de résultats ; doit être une fonction de module (picklable).
+    Produit (offset_debut, offset_fin, résultats) dans l'ordre du fichier, quel que soit
+    l'ordre de fin des workers. Au plus 2 * workers paquets sont en vol (mémoire bornée).
+    spool_dir / spool_threshold : voir iter_record_chunks.
+    """
+    chunks = iter_record_chunks(xml_path, chunk_bytes=chunk_bytes, start=start, spool_dir=spool_dir,
+                                spool_threshold=spool_threshold)
+    if workers <= 1:
+        for lo, hi, chunk in chunks:
+            yield lo, hi, worker(chunk)
+        return
+    pool = multiprocessing.Pool(workers)
+    try:
+        pending = collections.deque()
+        for lo, hi, chunk in chunks:
+            pending.append((lo, hi, pool.apply_async(worker, (chunk,))))
+            if len(pending) >= 2 * workers:
+                lo0, hi0, res = pending.popleft()
+                yield lo0, hi0, res.get()
+        while pending:
+            lo0, hi0, res = pending.popleft()
+            yield lo0, hi0, res.get()
+    finally:
+        # close()/join() plutôt que terminate() : terminate() peut se bloquer si un worker
+        # inactif tient le verrou de la file d'entrée ; au plus 2 * workers paquets restent à finir.
+        pool.close()
+        pool.join()
+
+
+def default_workers():
+    return max(1, (os.cpu_count() or 1))